@@ -0,0 +1,91 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Benchmark of loading a poll's new rows to Carto. "insert" builds the single INSERT ... VALUES
+#statement the Carto sink used to send, "copy" sends the rows as CSV chunks through the COPY API
+#to a local stand-in. "copy ms" includes building the CSV bodies, the requests and the stand-in's
+#parsing. tests/test_carto.py checks that the copied values arrive intact.
+#Run from the repository root: python benchmarks/bench_carto.py --items 1000 10000
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feedgen import generateFeed
+from benchmarks.standins import CartoStandIn
+from waze import schemas, timeutil
+from waze.carto import CopySink
+from waze.extract import Extractor
+
+try:
+	from urllib import urlencode
+except ImportError:
+	from urllib.parse import urlencode
+
+#Carto columns of the jams tables, as listed in main.py
+columns = 'city,turntype,level,country,speedKMH,delay,length,street,ms,ts,endNode,type,id,speed,uuid,startNode,the_geom'.split(',')
+
+def jamRows(count):
+	extractor = Extractor('jams', schemas.jamsFields)
+	items, timestamps = timeutil.filterAndFormat(generateFeed(alerts=0, jams=count, irregularities=0)['jams'], extractor.timeFields, 0)
+	rows = [extractor.extract(item, itemTimestamps, True)[1] for item, itemTimestamps in zip(items, timestamps)]
+	#Values that need escaping
+	rows[0]['street'] = u'O\'Brien "Ave", Stra\u00dfe\nNorth'
+	rows[-1]['street'] = u''
+	return rows
+
+#The previous INSERT statement, urlencoded as it was posted
+def insertPayload(rows):
+	values = []
+	for row in rows:
+		rowValues = []
+		for column in columns:
+			if column == 'the_geom':
+				rowValues.append("ST_GeomFromText('" + row['geoWKT'] + "',4326)")
+			elif row.get(column) is None:
+				rowValues.append('null')
+			elif isinstance(row.get(column), type(u'')):
+				rowValues.append("'" + row.get(column).replace("'", "''") + "'")
+			else:
+				rowValues.append(str(row.get(column)))
+		values.append('(' + ','.join(rowValues) + ')')
+	query = 'INSERT INTO jams_bench (' + ','.join(columns) + ') VALUES ' + ','.join(values)
+	return urlencode({'q': query.encode('utf-8')})
+
+def main():
+	parser = argparse.ArgumentParser(description='Cost of loading rows to Carto with INSERT and with COPY')
+	parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000])
+	parser.add_argument('--max-bytes', type=int, default=1024 * 1024)
+	args = parser.parse_args()
+
+	print('%8s %14s %12s %14s %12s %9s %8s' % ('rows', 'insert bytes', 'insert ms', 'copy bytes', 'copy ms', 'requests', 'copied'))
+	for count in args.items:
+		rows = jamRows(count)
+		start = time.time()
+		payload = insertPayload(rows)
+		insertTime = time.time() - start
+		with CartoStandIn(maxBytes=args.max_bytes) as standIn:
+			sink = CopySink(standIn.url, 'key', maxBytes=args.max_bytes)
+			start = time.time()
+			copied, failures = sink.copyRows('jams_bench', columns, rows)
+			copyTime = time.time() - start
+			print('%8d %14d %12.1f %14d %12.1f %9d %8d' % (count, len(payload), insertTime * 1000, standIn.bytesReceived, copyTime * 1000, standIn.requests, copied))
+
+if __name__ == '__main__':
+	main()
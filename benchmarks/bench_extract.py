@@ -0,0 +1,187 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Micro-benchmark of the per-item cost of turning feed items into GeoJSON features and BigQuery rows.
+#"before" is the field-by-field extraction the process* functions used to do, "after" is the
+#compiled waze.extract.Extractor. Datastore, GCS and BigQuery are left out.
+#Run from the repository root: python benchmarks/bench_extract.py --items 20000
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feedgen import generateFeed
+from waze.extract import Extractor
+from waze import timeutil
+from waze.schemas import feedFields
+
+#The previous per-item extraction, kept here as the baseline
+def beforeAlerts(alerts,day):
+	features = []
+	bqRows = []
+	for item in alerts:
+		ms = item.get('pubMillis')
+		itemTimeStamp = datetime.datetime.fromtimestamp(ms/1000.0)
+		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
+		if itemTimeStamp >= caseTimeMinimum:
+			timestamp = datetime.datetime.fromtimestamp(ms/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			city = item.get('city')
+			street = item.get('street')
+			confidence = item.get('confidence')
+			nThumbsUp = item.get('nThumbsUp')
+			uuid = item.get('uuid')
+			country = item.get('country')
+			subtype = item.get('subtype')
+			roadType = item.get('roadType')
+			reliability = item.get('reliability')
+			magvar = item.get('magvar')
+			alertType = item.get('type')
+			reportRating = item.get('reportRating')
+			reportDescription = item.get('reportDescription')
+			longitude = item.get('location').get('x')
+			latitude = item.get('location').get('y')
+			properties = {"city": city, "street": street, "confidence": confidence, "nThumbsUp": nThumbsUp, "uuid": uuid,
+				"country": country, "subtype": subtype, "roadType": roadType, "reliability": reliability, "magvar": magvar,
+				"type": alertType, "reportRating": reportRating, "pubMillis": ms, "timestamp": timestamp, "reportDescription": reportDescription}
+			geometry = {"type": "Point", "coordinates": [longitude, latitude]}
+			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
+			bqRow = {"city": city, "street": street, "confidence": confidence, "nThumbsUp": nThumbsUp, "uuid": uuid,
+				"country": country, "subtype": subtype, "roadType": roadType, "reliability": reliability, "magvar": magvar,
+				"type": alertType, "reportRating": reportRating, "ms": ms, "ts": timestamp, "reportDescription": reportDescription,
+				"geo": "Point(" + str(longitude) + " " + str(latitude) + ")",
+				"geoWKT": "Point(" + str(longitude) + " " + str(latitude) + ")"}
+			bqRows.append(bqRow)
+	return features, bqRows
+
+def beforeJams(jams,day):
+	features = []
+	bqRows = []
+	for item in jams:
+		ms = item.get('pubMillis')
+		itemTimeStamp = datetime.datetime.fromtimestamp(ms/1000.0)
+		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
+		if itemTimeStamp >= caseTimeMinimum:
+			timestamp = datetime.datetime.fromtimestamp(ms/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			city = item.get('city')
+			turnType = item.get('turnType')
+			level = item.get('level')
+			country = item.get('country')
+			segments = item.get('segments')
+			speedKMH = item.get('speedKMH')
+			roadType = item.get('roadType')
+			delay = item.get('delay')
+			length = item.get('length')
+			street = item.get('street')
+			endNode = item.get('endNode')
+			jamType = item.get('type')
+			iD = item.get('id')
+			uuid = item.get('uuid')
+			speed = item.get('speed')
+			startNode = item.get('startNode')
+			properties = {"city": city, "turnType": turnType, "level": level, "country": country, "segments": segments,
+				"speedKMH": speedKMH, "roadType": roadType, "delay": delay, "length": length, "street": street,
+				"pubMillis": ms, "timestamp": timestamp, "endNode": endNode, "type": jamType, "id": iD, "speed": speed,
+				"uuid": uuid, "startNode": startNode}
+			coordinates = []
+			bqLineString = ''
+			for vertex in item.get('line'):
+				longitude = vertex.get('x')
+				latitude = vertex.get('y')
+				coordinate = [longitude, latitude]
+				bqLineString += str(longitude) + " " + str(latitude) + ', '
+				coordinates.append(coordinate)
+			geometry = {"type": "LineString", "coordinates": coordinates}
+			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
+			bqRow = {"city": city, "turnType": turnType, "level": level, "country": country, "segments": segments,
+				"speedKMH": speedKMH, "roadType": roadType, "delay": delay, "length": length, "street": street,
+				"ms": ms, "ts": timestamp, "endNode": endNode, "type": jamType, "id": iD, "speed": speed,
+				"uuid": uuid, "startNode": startNode,
+				"geo": "LineString(" + bqLineString[:-2] + ")",
+				"geoWKT": "LineString(" + bqLineString[:-2] + ")"}
+			bqRows.append(bqRow)
+	return features, bqRows
+
+def beforeIrregularities(irregularities,day):
+	features = []
+	bqRows = []
+	for item in irregularities:
+		detectionDateMS = item.get('detectionDateMillis')
+		itemTimeStamp = datetime.datetime.fromtimestamp(detectionDateMS/1000.0)
+		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
+		if itemTimeStamp >= caseTimeMinimum:
+			detectionDateTS = datetime.datetime.fromtimestamp(detectionDateMS/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			updateDateMS = item.get('updateDateMillis')
+			updateDateTS = datetime.datetime.fromtimestamp(updateDateMS/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			causeAlert = item.get('causeAlert')
+			causeAlertUUID = causeAlert.get('uuid') if causeAlert is not None else None
+			values = {}
+			for field in ['trend', 'street', 'endNode', 'nImages', 'speed', 'id', 'severity', 'type', 'highway', 'nThumbsUp',
+					'seconds', 'alertsCount', 'driversCount', 'startNode', 'regularSpeed', 'country', 'length',
+					'delaySeconds', 'jamLevel', 'nComments', 'city', 'causeType']:
+				values[field] = item.get(field)
+			properties = dict(values, detectionDateMS=detectionDateMS, detectionDateTS=detectionDateTS,
+				updateDateMS=updateDateMS, updateDateTS=updateDateTS, causeAlertUUID=causeAlertUUID)
+			coordinates = []
+			bqLineString = ''
+			for vertex in item.get('line'):
+				longitude = vertex.get('x')
+				latitude = vertex.get('y')
+				coordinate = [longitude, latitude]
+				bqLineString += str(longitude) + " " + str(latitude) + ', '
+				coordinates.append(coordinate)
+			geometry = {"type": "LineString", "coordinates": coordinates}
+			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
+			bqRow = dict(properties, geo="LineString(" + bqLineString[:-2] + ")", geoWKT="LineString(" + bqLineString[:-2] + ")")
+			bqRows.append(bqRow)
+	return features, bqRows
+
+before = {'alerts': beforeAlerts, 'jams': beforeJams, 'irregularities': beforeIrregularities}
+
+#The loop processFeed runs, with every item needing a row
+def after(extractor,items,day):
+	features = []
+	bqRows = []
+	items, itemTimestamps = timeutil.filterAndFormat(items, extractor.timeFields, timeutil.dayStartMillis(day))
+	for item, timestamps in zip(items, itemTimestamps):
+		feature, bqRow = extractor.extract(item, timestamps, True)
+		features.append(feature)
+		bqRows.append(bqRow)
+	return features, bqRows
+
+def main():
+	parser = argparse.ArgumentParser(description='Per-item extraction cost before and after the compiled extractors')
+	parser.add_argument('--items', type=int, default=20000, help='items of each feed type')
+	parser.add_argument('--vertices', type=int, default=20, help='vertices per jam and irregularity line')
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	feed = generateFeed(alerts=args.items, jams=args.items, irregularities=args.items, vertices=args.vertices)
+	day = '2000-01-01'
+	print('%-16s %8s %14s %14s %8s' % ('feed', 'items', 'before us/item', 'after us/item', 'speedup'))
+	for feedType in ['alerts', 'jams', 'irregularities']:
+		items = feed[feedType]
+		extractor = Extractor(feedType, feedFields[feedType])
+		beforeTime = min(timeit.repeat(lambda: before[feedType](items, day), number=1, repeat=args.repeat))
+		afterTime = min(timeit.repeat(lambda: after(extractor, items, day), number=1, repeat=args.repeat))
+		print('%-16s %8d %14.2f %14.2f %7.2fx' % (feedType, len(items), beforeTime / len(items) * 1e6,
+			afterTime / len(items) * 1e6, beforeTime / afterTime))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,147 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Timing and memory of the case pipeline (waze/pipeline.py, as used by updateCase and the process*
+#functions in main.py) against the in-memory stand-ins in benchmarks/standins.py, across feed sizes.
+#For each size it reports:
+#  process <feed type>  one feed type processed for a new case, every item deduplicated and written
+#  updateCase first     a whole snapshot for a new case
+#  updateCase same      the same snapshot again, so every item is unchanged
+#  updateCase churn     a snapshot where --churn of the items are new
+#Feeds are generated with fixed seeds, each timing is the best of --repeat runs, and peak memory is
+#measured with tracemalloc in one extra run (Python 3 only). Save a run with --save and compare a later one with
+#--compare to flag timings that got slower by more than --threshold percent.
+#Run from the repository root: python benchmarks/bench_pipeline.py --sizes 1000 10000
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feedgen import generateFeed
+from benchmarks.standins import MemoryServices
+from waze import schemas
+from waze.extract import Extractor
+from waze.geometry import geometryEncoder
+from waze.pipeline import CasePipeline
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+feedTypes = ['alerts', 'jams', 'irregularities']
+
+Case = collections.namedtuple('Case', 'uid day ingestMode area')
+
+extractors = dict((feedType, Extractor(feedType, schemas.feedFields[feedType])) for feedType in feedTypes)
+
+def newPipeline(args):
+	services = MemoryServices(geometryEncoder(args.encoding, 5))
+	precision = None if args.encoding == 'full' else 5
+	return CasePipeline(services, extractors, feedTypes, args.tile_zooms, precision, args.lifecycles), services
+
+#Replace a share of each feed type's items with new ones
+def churned(data,share,seed):
+	fresh = generateFeed(alerts=len(data['alerts']), jams=len(data['jams']), irregularities=len(data['irregularities']),
+		vertices=len(data['jams'][0]['line']) if data['jams'] else 2, seed=seed)
+	result = dict(data)
+	for feedType in feedTypes:
+		keep = len(data[feedType]) - int(len(data[feedType]) * share)
+		result[feedType] = data[feedType][:keep] + fresh[feedType][keep:]
+	return result
+
+#Best time of run(setup()) over repeat runs, and its peak memory in one more, traced, run
+def measure(setup,run,repeat):
+	best = None
+	for n in range(repeat):
+		state = setup()
+		start = time.time()
+		run(state)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	peak = None
+	if tracemalloc is not None:
+		state = setup()
+		tracemalloc.start()
+		run(state)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return best, peak
+
+def benchmarks(args,size):
+	data = generateFeed(alerts=size, jams=size, irregularities=max(1, size // 10), vertices=args.vertices, seed=1)
+	second = churned(data, args.churn, 2)
+	case = Case('bench-case', '2000-01-01', 'stream', None)
+	results = collections.OrderedDict()
+
+	for feedType in feedTypes:
+		results['process ' + feedType] = measure(lambda: newPipeline(args)[0],
+			lambda pipeline: pipeline.processFeed(feedType, data[feedType], case.uid, case.day), args.repeat)
+
+	results['updateCase first'] = measure(lambda: newPipeline(args)[0],
+		lambda pipeline: pipeline.updateCase(case, data), args.repeat)
+
+	def afterFirst():
+		pipeline, services = newPipeline(args)
+		pipeline.updateCase(case, data)
+		return pipeline
+	results['updateCase same'] = measure(afterFirst, lambda pipeline: pipeline.updateCase(case, data), args.repeat)
+	results['updateCase churn'] = measure(afterFirst, lambda pipeline: pipeline.updateCase(case, second), args.repeat)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='Timing and memory of the case pipeline against in-memory stand-ins')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='alerts and jams per snapshot (irregularities are a tenth)')
+	parser.add_argument('--vertices', type=int, default=20, help='vertices per jam and irregularity line')
+	parser.add_argument('--churn', type=float, default=0.1)
+	parser.add_argument('--encoding', default='full', choices=['full', 'quantized', 'polyline'])
+	parser.add_argument('--tile-zooms', type=int, nargs='*', default=[])
+	parser.add_argument('--lifecycles', action='store_true', help='also track item lifecycles and write closed events')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--save', help='write the results to this JSON file')
+	parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+	parser.add_argument('--threshold', type=float, default=20.0, help='slowdown in percent reported as a regression')
+	args = parser.parse_args()
+
+	baseline = json.load(open(args.compare)) if args.compare else {}
+	saved = {}
+	regressions = []
+	print('%8s %-24s %10s %12s %10s' % ('size', 'benchmark', 'ms', 'peak MB', 'change'))
+	for size in args.sizes:
+		for name, (seconds, peak) in benchmarks(args, size).items():
+			key = '%d %s' % (size, name)
+			saved[key] = {'seconds': seconds, 'peakBytes': peak}
+			change = ''
+			if key in baseline:
+				percent = (seconds / baseline[key]['seconds'] - 1) * 100
+				change = '%+.1f%%' % percent
+				if percent > args.threshold:
+					regressions.append(key)
+			print('%8d %-24s %10.1f %12s %10s' % (size, name, seconds * 1000, '%.1f' % (peak / 1e6) if peak is not None else 'n/a', change))
+	if args.save:
+		with open(args.save, 'w') as results:
+			json.dump(saved, results, indent=1, sort_keys=True)
+	if regressions:
+		print('Slower than the baseline by more than %.0f%%: %s' % (args.threshold, ', '.join(regressions)))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,78 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Benchmark of the case cutoff filter and timestamp formatting for a snapshot.
+#"per item" is the datetime based code the process* functions used to run for every item,
+#"batch" is waze.timeutil.filterAndFormat with the pure Python formatter, and "numpy" is
+#the same call using NumPy datetime64 arrays (skipped when NumPy isn't installed).
+#Run from the repository root: python benchmarks/bench_time.py --items 10000 50000
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feedgen import generateFeed
+from waze import timeutil
+
+timeFields = ['detectionDateMillis', 'updateDateMillis']
+
+#The previous per-item filter and formatting of an irregularity's two time fields
+def perItem(items,day):
+	kept = []
+	for item in items:
+		detectionDateMS = item.get('detectionDateMillis')
+		itemTimeStamp = datetime.datetime.fromtimestamp(detectionDateMS/1000.0)
+		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
+		if itemTimeStamp >= caseTimeMinimum:
+			detectionDateTS = datetime.datetime.fromtimestamp(detectionDateMS/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			updateDateTS = datetime.datetime.fromtimestamp(item.get('updateDateMillis')/1000.0).strftime("%Y-%m-%d %H:%M:%S")
+			kept.append((item, (detectionDateTS, updateDateTS)))
+	return kept
+
+def batch(items,day,useNumpy):
+	numpy = timeutil.numpy
+	if not useNumpy:
+		timeutil.numpy = None
+	try:
+		return timeutil.filterAndFormat(items, timeFields, timeutil.dayStartMillis(day))
+	finally:
+		timeutil.numpy = numpy
+
+def main():
+	parser = argparse.ArgumentParser(description='Cost of filtering and formatting snapshot timestamps')
+	parser.add_argument('--items', type=int, nargs='+', default=[10000, 50000])
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	day = '2000-01-01'
+	print('%8s %16s %16s %16s' % ('items', 'per item us/item', 'batch us/item', 'numpy us/item'))
+	for count in args.items:
+		items = generateFeed(alerts=0, jams=0, irregularities=count, vertices=2)['irregularities']
+		perItemTime = min(timeit.repeat(lambda: perItem(items, day), number=1, repeat=args.repeat))
+		batchTime = min(timeit.repeat(lambda: batch(items, day, False), number=1, repeat=args.repeat))
+		if timeutil.numpy is not None:
+			numpyTime = min(timeit.repeat(lambda: batch(items, day, True), number=1, repeat=args.repeat))
+			numpyColumn = '%16.2f' % (numpyTime / count * 1e6)
+		else:
+			numpyColumn = '%16s' % 'n/a'
+		print('%8d %16.2f %16.2f %s' % (count, perItemTime / count * 1e6, batchTime / count * 1e6, numpyColumn))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Generator of synthetic Waze CCP feeds, shaped like the partner feed JSON.
+#The same seed always gives the same feed, so timings are comparable between runs.
+
+import random
+import time
+import uuid
+
+alertTypes = [('ACCIDENT', 'ACCIDENT_MINOR'), ('JAM', 'JAM_HEAVY_TRAFFIC'), ('WEATHERHAZARD', 'HAZARD_ON_ROAD_POT_HOLE'), ('ROAD_CLOSED', 'ROAD_CLOSED_EVENT')]
+streets = [u'Main St', u'Broadway', u'Avenida Paulista', u'Rue de Rivoli', u'Calle Mayor', u'K\u00f6nigstra\u00dfe']
+
+def _uuid(rng):
+	return str(uuid.UUID(int=rng.getrandbits(128)))
+
+def _line(rng,center,vertices):
+	x = center[0] + rng.uniform(-0.2, 0.2)
+	y = center[1] + rng.uniform(-0.2, 0.2)
+	line = []
+	for n in range(vertices):
+		x += rng.uniform(-0.001, 0.001)
+		y += rng.uniform(-0.001, 0.001)
+		line.append({"x": x, "y": y})
+	return line
+
+def generateAlert(rng,center,nowMillis):
+	alertType, subtype = rng.choice(alertTypes)
+	return {
+		"country": "US",
+		"nThumbsUp": rng.randint(0, 20),
+		"city": u"Springfield",
+		"reportRating": rng.randint(0, 6),
+		"confidence": rng.randint(0, 10),
+		"reliability": rng.randint(0, 10),
+		"type": alertType,
+		"uuid": _uuid(rng),
+		"roadType": rng.choice([1, 2, 3, 6, 7]),
+		"magvar": rng.randint(0, 359),
+		"subtype": subtype,
+		"street": rng.choice(streets),
+		"reportDescription": rng.choice([None, u"Stalled vehicle", u"Debris on road"]),
+		"location": {"x": center[0] + rng.uniform(-0.2, 0.2), "y": center[1] + rng.uniform(-0.2, 0.2)},
+		"pubMillis": nowMillis - rng.randint(0, 4 * 3600 * 1000),
+	}
+
+def generateJam(rng,center,nowMillis,vertices):
+	line = _line(rng, center, vertices)
+	return {
+		"country": "US",
+		"city": u"Springfield",
+		"level": rng.randint(1, 5),
+		"line": line,
+		"speedKMH": rng.uniform(0, 40),
+		"length": rng.randint(50, 5000),
+		"turnType": "NONE",
+		"type": "NONE",
+		"uuid": _uuid(rng),
+		"endNode": rng.choice(streets),
+		"speed": rng.uniform(0, 11),
+		"segments": [{"fromNode": rng.randint(0, 10 ** 8), "ID": rng.randint(0, 10 ** 8), "toNode": rng.randint(0, 10 ** 8), "isForward": True} for n in range(vertices // 4)],
+		"roadType": rng.choice([1, 2, 3, 6, 7]),
+		"delay": rng.randint(0, 900),
+		"street": rng.choice(streets),
+		"id": rng.getrandbits(40),
+		"pubMillis": nowMillis - rng.randint(0, 2 * 3600 * 1000),
+		"startNode": rng.choice(streets),
+	}
+
+def generateIrregularity(rng,center,nowMillis,vertices):
+	detection = nowMillis - rng.randint(0, 6 * 3600 * 1000)
+	return {
+		"trend": rng.choice([-1, 0, 1]),
+		"street": rng.choice(streets),
+		"line": _line(rng, center, vertices),
+		"endNode": rng.choice(streets),
+		"nImages": rng.randint(0, 3),
+		"speed": rng.uniform(0, 40),
+		"id": str(rng.getrandbits(40)),
+		"severity": rng.randint(0, 5),
+		"type": rng.choice(["Small", "Medium", "Large"]),
+		"highway": rng.random() < 0.3,
+		"nThumbsUp": rng.randint(0, 10),
+		"seconds": rng.randint(0, 3600),
+		"alertsCount": rng.randint(0, 5),
+		"detectionDateMillis": detection,
+		"driversCount": rng.randint(0, 200),
+		"startNode": rng.choice(streets),
+		"updateDateMillis": detection + rng.randint(0, 3600 * 1000),
+		"regularSpeed": rng.uniform(20, 80),
+		"country": "US",
+		"length": rng.randint(100, 10000),
+		"delaySeconds": rng.randint(0, 1800),
+		"jamLevel": rng.randint(1, 5),
+		"nComments": rng.randint(0, 5),
+		"city": u"Springfield",
+		"causeType": rng.choice([None, "ACCIDENT"]),
+		"causeAlert": rng.choice([None, {"uuid": _uuid(rng), "type": "ACCIDENT"}]),
+	}
+
+#Build a feed dict with the given number of items of each type
+def generateFeed(alerts=1000,jams=1000,irregularities=100,vertices=20,seed=0,nowMillis=None,center=(-73.98, 40.75)):
+	rng = random.Random(seed)
+	if nowMillis is None:
+		nowMillis = int(time.time() * 1000)
+	return {
+		"startTimeMillis": nowMillis - 60000,
+		"endTimeMillis": nowMillis,
+		"alerts": [generateAlert(rng, center, nowMillis) for n in range(alerts)],
+		"jams": [generateJam(rng, center, nowMillis, vertices) for n in range(jams)],
+		"irregularities": [generateIrregularity(rng, center, nowMillis, vertices) for n in range(irregularities)],
+	}
@@ -0,0 +1,327 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Local stand-ins for the services the pipeline writes to, for benchmarks and for trying changes
+#without a cloud project.
+
+import gzip
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+
+from benchmarks.feedgen import generateFeed
+from waze import bqstream
+from waze.geojson import FeatureCollectionWriter
+from waze.lifecycle import eventID
+from waze.tiles import changedTiles
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from urlparse import urlparse, parse_qs
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from urllib.parse import urlparse, parse_qs
+
+#Parse PostgreSQL CSV COPY data: unquoted empty fields are null, quoted ones are strings
+def parseCopyCSV(text):
+	rows = []
+	row = []
+	field = []
+	quoted = False
+	inQuotes = False
+	n = 0
+	while n < len(text):
+		char = text[n]
+		if inQuotes:
+			if char == '"' and text[n + 1:n + 2] == '"':
+				field.append('"')
+				n += 1
+			elif char == '"':
+				inQuotes = False
+			else:
+				field.append(char)
+		elif char == '"':
+			inQuotes = True
+			quoted = True
+		elif char in ',\n':
+			row.append(''.join(field) if field or quoted else None)
+			field = []
+			quoted = False
+			if char == '\n':
+				rows.append(row)
+				row = []
+		else:
+			field.append(char)
+		n += 1
+	if field or quoted or row:
+		row.append(''.join(field) if field or quoted else None)
+		rows.append(row)
+	return rows
+
+#Local HTTP server answering Carto's COPY API (POST /api/v2/sql/copyfrom?q=COPY ... FROM STDIN).
+#Copied rows are kept in .tables as lists of {column: value} dicts; bodies larger than maxBytes
+#are refused like an oversized request would be, and the first failFirst requests get a 503.
+class CartoStandIn(object):
+	def __init__(self,maxBytes=None,port=0,failFirst=0):
+		standIn = self
+		self.tables = {}
+		self.requests = 0
+		self.bytesReceived = 0
+		self.maxBytes = maxBytes
+		self.failFirst = failFirst
+
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self,*args):
+				pass
+
+			def do_POST(self):
+				url = urlparse(self.path)
+				body = self.rfile.read(int(self.headers['Content-Length']))
+				status, response = standIn.copy(url.path, parse_qs(url.query), body)
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.end_headers()
+				self.wfile.write(json.dumps(response).encode('utf-8'))
+
+		self.server = HTTPServer(('127.0.0.1', port), Handler)
+		self.url = 'http://127.0.0.1:%d/api/v2/sql/copyfrom' % self.server.server_address[1]
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+
+	def copy(self,path,query,body):
+		self.requests += 1
+		self.bytesReceived += len(body)
+		if self.requests <= self.failFirst:
+			return 503, {'error': ['Service unavailable']}
+		match = re.match(r'COPY (\w+) \(([\w,]+)\) FROM STDIN WITH \(FORMAT csv\)$', query.get('q', [''])[0])
+		if not path.endswith('/copyfrom') or not match:
+			return 400, {'error': ['Invalid COPY statement']}
+		if self.maxBytes is not None and len(body) > self.maxBytes:
+			return 400, {'error': ['Request too large']}
+		columns = match.group(2).split(',')
+		rows = parseCopyCSV(body.decode('utf-8'))
+		if any(len(row) != len(columns) for row in rows):
+			return 400, {'error': ['Wrong number of columns']}
+		self.tables.setdefault(match.group(1), []).extend(dict(zip(columns, row)) for row in rows)
+		return 200, {'time': 0, 'total_rows': len(rows)}
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self,*args):
+		self.server.shutdown()
+		self.server.server_close()
+
+#Local HTTP server standing in for a Waze CCP feed. The snapshot changes every changeEvery seconds,
+#with a churn share of each feed type's items replaced; it is sent gzipped when asked, with an ETag,
+#and a request carrying the current ETag gets 304 Not Modified.
+class WazeFeedStandIn(object):
+	def __init__(self,alerts=1000,jams=1000,irregularities=100,vertices=20,churn=0.1,changeEvery=60,port=0):
+		standIn = self
+		self.counts = (alerts, jams, irregularities, vertices)
+		self.churn = churn
+		self.changeEvery = changeEvery
+		self.requests = 0
+		self.period = None
+		self.lock = threading.Lock()
+
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self,*args):
+				pass
+
+			def do_GET(self):
+				body, etag = standIn.snapshot()
+				standIn.requests += 1
+				if self.headers.get('If-None-Match') == etag:
+					self.send_response(304)
+					self.end_headers()
+					return
+				if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+					compressed = io.BytesIO()
+					with gzip.GzipFile(fileobj=compressed, mode='wb') as gzipFile:
+						gzipFile.write(body)
+					body = compressed.getvalue()
+					encoding = 'gzip'
+				else:
+					encoding = None
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('ETag', etag)
+				if encoding:
+					self.send_header('Content-Encoding', encoding)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+		self.server = HTTPServer(('127.0.0.1', port), Handler)
+		self.url = 'http://127.0.0.1:%d/feed' % self.server.server_address[1]
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+
+	#The current snapshot as JSON bytes and its ETag, regenerated when a new period starts
+	def snapshot(self):
+		period = int(time.time() // self.changeEvery)
+		with self.lock:
+			if period != self.period:
+				alerts, jams, irregularities, vertices = self.counts
+				stable = generateFeed(alerts, jams, irregularities, vertices, seed=0, nowMillis=period * self.changeEvery * 1000)
+				fresh = generateFeed(alerts, jams, irregularities, vertices, seed=period, nowMillis=period * self.changeEvery * 1000)
+				for feedType in ('alerts', 'jams', 'irregularities'):
+					keep = len(stable[feedType]) - int(len(stable[feedType]) * self.churn)
+					stable[feedType] = stable[feedType][:keep] + fresh[feedType][keep:]
+				self.body = json.dumps(stable).encode('utf-8')
+				self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+				self.period = period
+			return self.body, self.etag
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self,*args):
+		self.server.shutdown()
+		self.server.server_close()
+
+#File object keeping what is written in a MemoryStorage once closed
+class MemoryFile(object):
+	def __init__(self,storage,path):
+		self.storage = storage
+		self.path = path
+		self.parts = []
+
+	def write(self,data):
+		self.parts.append(data)
+
+	def close(self):
+		data = ''.join(self.parts) if self.parts and isinstance(self.parts[0], type('')) else b''.join(self.parts)
+		self.storage.put(self.path, data)
+
+#In-memory stand-in for Cloud Storage
+class MemoryStorage(object):
+	def __init__(self):
+		self.files = {}
+		self.writes = 0
+		self.bytesWritten = 0
+		self.lock = threading.Lock()
+
+	def open(self,path):
+		return MemoryFile(self, path)
+
+	def put(self,path,data):
+		with self.lock:
+			self.files[path] = data
+			self.writes += 1
+			self.bytesWritten += len(data)
+
+	def copy(self,source,destination):
+		with self.lock:
+			self.files[destination] = self.files[source]
+
+	def delete(self,path):
+		with self.lock:
+			self.files.pop(path, None)
+
+#In-memory stand-in for the Datastore entities of the pipeline: feed states, tile hashes and the
+#unique ids of each case. rpcs counts the batched calls the App Engine services would make.
+class MemoryDatastore(object):
+	def __init__(self):
+		self.entities = {}
+		self.rpcs = 0
+		self.lock = threading.Lock()
+
+	def getMulti(self,keys):
+		with self.lock:
+			self.rpcs += 1
+			return [self.entities.get(key) for key in keys]
+
+	def putMulti(self,entities):
+		with self.lock:
+			self.rpcs += 1
+			self.entities.update(entities)
+
+#Stand-in for a BigQuery client's insert_rows, keeping the rows of each table
+class MemoryBigQuery(object):
+	def __init__(self):
+		self.tables = {}
+		self.requests = 0
+		self.lock = threading.Lock()
+
+	def insert_rows(self,table,rows,row_ids=None):
+		with self.lock:
+			self.requests += 1
+			self.tables.setdefault(table, []).extend(rows)
+		return []
+
+#The services of waze.pipeline.CasePipeline on top of the in-memory stand-ins, following what the
+#App Engine services in main.py do with the real ones (dedup without the memcache layers)
+class MemoryServices(object):
+	def __init__(self,encoder=None):
+		self.storage = MemoryStorage()
+		self.datastore = MemoryDatastore()
+		self.bigquery = MemoryBigQuery()
+		self.encoder = encoder
+
+	def loadFeedStates(self,uid,feedTypes,stats):
+		stats.add('datastoreRPCs')
+		return self.datastore.getMulti(['caseFeedState:' + uid + ':' + feedType for feedType in feedTypes])
+
+	def saveFeedStates(self,uid,states,stats):
+		stats.add('datastoreRPCs')
+		self.datastore.putMulti(dict(('caseFeedState:' + uid + ':' + feedType, state) for feedType, state in states.items()))
+
+	def _timestampedPath(self,uid,feedType,now):
+		return uid + '/' + uid + '-' + now + '-' + feedType + '.geojson'
+
+	def openGeoJSON(self,uid,feedType,now):
+		return FeatureCollectionWriter(self.storage.open(self._timestampedPath(uid, feedType, now)), self.encoder)
+
+	def publishGeoJSON(self,uid,feedType,now):
+		self.storage.copy(self._timestampedPath(uid, feedType, now), uid + '/' + uid + '-' + feedType + '.geojson')
+
+	def filterUnique(self,feedType,uid,itemIDs,stats):
+		stats.add('datastoreRPCs',2)
+		keys = ['unique:' + feedType + ':' + uid + ':' + itemID for itemID in itemIDs]
+		existing = self.datastore.getMulti(keys)
+		newIndexes = []
+		seen = set()
+		for n, (key, entity) in enumerate(zip(keys, existing)):
+			if entity is None and key not in seen:
+				newIndexes.append(n)
+			seen.add(key)
+		self.datastore.putMulti(dict((keys[n], True) for n in newIndexes))
+		return newIndexes
+
+	def writeRows(self,feedType,uid,now,rows,ingestMode='stream',stats=None):
+		table = feedType + '_' + uid.replace('-', '_')
+		with stats.timed('bigqueryMillis',feedType):
+			bqstream.streamRows(self.bigquery, table, rows, [uid + ':' + str(n) for n in range(len(rows))])
+		stats.add('bigqueryRows',len(rows),feedType)
+
+	def writeEvents(self,uid,now,rows,ingestMode='stream',stats=None):
+		bqstream.streamRows(self.bigquery, 'events_' + uid.replace('-', '_'), rows, [uid + ':' + eventID(row) for row in rows])
+
+	def writeTiles(self,feedType,uid,tiles,stats):
+		stats.add('datastoreRPCs',2)
+		key = 'caseTileState:' + uid + ':' + feedType
+		changed, removed, hashes = changedTiles(tiles, self.datastore.getMulti([key])[0])
+		for name, content in changed:
+			self.storage.put(uid + '/tiles/' + feedType + '/' + name + '.geojson', content)
+		stats.add('tilesWritten',len(changed),feedType)
+		for name in removed:
+			self.storage.delete(uid + '/tiles/' + feedType + '/' + name + '.geojson')
+		self.datastore.putMulti({key: hashes})
@@ -16,106 +16,120 @@ import json
 import webapp2
 import datetime
 import logging
+import hashlib
+import time
+import re
 from google.appengine.api import urlfetch
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 import urllib
 import uuid
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import deferred
 import cloudstorage as gcs
 from google.cloud import bigquery
+from google.cloud.exceptions import Conflict
 import unidecode
+from waze.cache import LRUCache
+from waze.extract import Extractor
+from waze import schemas
+from waze.geojson import FeatureCollectionWriter
+from waze.geometry import geometryEncoder
+from waze import bqstream
+from waze.parallel import runParallel, runBounded
+from waze import feed
+from waze import stats as runstats
+from waze.tiles import changedTiles
+from waze.spatial import parseArea, Area, GridIndex
+from waze.columnar import ArchiveWriter, ArchiveReader
+from waze.carto import CopySink
+from waze.pipeline import CasePipeline, extractRows
+from waze.lifecycle import eventID
+from waze.shards import mergeShards
+from waze.schedule import planShards, smoothedDuration
 
 # Your Waze CCP URL
 wazeURL= '{waze-url}'
+#Every CCP feed cases can be built from, by name. Cases use the 'default' feed unless they are created
+#with &feeds=name1,name2: their feeds are then merged, and items found in more than one are kept once.
+wazeFeeds = {'default': wazeURL}
+#Seconds to wait for the feed, and how many times to try it per cron tick
+fetchDeadline = 30
+fetchAttempts = 3
+fetchBackoff = 2
 
 """ **** Remove this line and the quotes here and at the bottom of this block if using Carto ***
 cartoURLBase = 'https://{your-carto-server}/user/{your-user}/api/v2/sql?'
+cartoCopyURL = 'https://{your-carto-server}/user/{your-user}/api/v2/sql/copyfrom'
 cartoAPIKey = '{your-carto-api-key}'
 """
 
 #GCS Params
 writeRetryParams = gcs.RetryParams(backoff_factor=1.1)
 gcsPath = '/{gcsPath}/'
+#Geometry in the GeoJSON files: 'full' precision as in the feed, 'quantized' to coordinatePrecision
+#decimals, or 'polyline' to store lines as encoded polylines (see waze/geometry.py)
+geometryEncoding = 'full'
+coordinatePrecision = 5
+#Zoom levels to also cut each GeoJSON into z/x/y tiles at, under {gcsPath}/{uid}/tiles/{feed type}/,
+#e.g. [10, 13]. Only the tiles whose content changed since the previous poll are rewritten.
+tileZooms = []
+tileWriteConcurrency = 16
 
 #BigQuery Params
 bqDataset = '{bqDataset}'
+#Set sharedTables to True to write every case to one table per feed type (alerts, jams and
+#irregularities) with a case_id column, instead of three tables per case. The shared tables are
+#clustered on case_id and type, and partitioned by day on their timestamp column ('column') or
+#on ingestion time ('ingestion').
+sharedTables = False
+sharedTablePartitioning = 'column'
+#Most staged files loaded by one batch mode load job (BigQuery allows 10,000 URIs per job)
+loadJobMaxFiles = 5000
+
+#Set trackLifecycles to True to also follow every alert, jam and irregularity across polls, and write
+#one consolidated row per item to an events table once it leaves the feed: first and last seen,
+#duration, and its highest level, delay and length and lowest speed (see waze/lifecycle.py)
+trackLifecycles = False
+#Largest compressed size of one entity of fingerprint or lifecycle state, well under Datastore's 1MB
+#entity limit
+stateShardBytes = 500000
+
+#Case scheduling Params: each cron tick packs the cases to update into shards of about
+#shardBudgetMillis of recent run time, updated by one task each, on caseQueue (defined in queue.yaml).
+#Cases that haven't run yet count as defaultRunMillis. A case is leased for caseLeaseSeconds while
+#it is updated, and ticks skip the cases still leased. Ticks are skipped altogether while more than
+#maxQueuedTasks tasks are waiting in the queue.
+shardBudgetMillis = 60000
+defaultRunMillis = 10000
+caseLeaseSeconds = 15 * 60
+caseQueue = 'cases'
+maxQueuedTasks = 50
+
+#Dedup cache Params: ids seen per case kept in instance memory, backed by memcache,
+#in front of the uniqueAlerts/uniqueJams/uniqueIrregularities Datastore entities.
+dedupCacheSize = 20000
+dedupCacheTTL = 6 * 60 * 60
+#Days the dedup entities of an item are kept after the day it was published. Items still in the
+#case's feed by then, such as closures that last for weeks, keep theirs until they leave it.
+dedupRetentionDays = 7
+#Keys read per purge task
+purgePageSize = 5000
+#Hours the feed snapshots and their payloads in {gcsPath}/snapshots/ are kept. Case tasks read the
+#snapshot of their own tick, so this only has to outlast the task retries.
+snapshotRetentionHours = 24
+
+#Size in degrees of the grid cells used to find the items inside each case's study area
+spatialIndexCellSize = 0.01
 
 #BigQuery Schemas for the three tables that need to be recreated.
-#These are also referenced with each write.
-
-jamsSchema = [
- 			bigquery.SchemaField('city','STRING',mode='Nullable'),
- 			bigquery.SchemaField('turntype','STRING',mode='Nullable'),
- 			bigquery.SchemaField('level','INT64',mode='Nullable'),
- 			bigquery.SchemaField('country','STRING',mode='Nullable'),
- 			bigquery.SchemaField('speedKMH','FLOAT64',mode='Nullable'),
- 			bigquery.SchemaField('delay','INT64',mode='Nullable'),
- 			bigquery.SchemaField('length','INT64',mode='Nullable'),
- 			bigquery.SchemaField('street','STRING',mode='Nullable'),
- 			bigquery.SchemaField('ms','INT64',mode='Nullable'),
- 			bigquery.SchemaField('ts','TIMESTAMP',mode='Nullable'),
- 			bigquery.SchemaField('endNode','STRING',mode='Nullable'),
- 			bigquery.SchemaField('geo','GEOGRAPHY',mode='Nullable'),
- 			bigquery.SchemaField('geoWKT','STRING',mode='Nullable'),
- 			bigquery.SchemaField('type','STRING',mode='Nullable'),
- 			bigquery.SchemaField('id','INT64',mode='Nullable'),
- 			bigquery.SchemaField('speed','FLOAT64',mode='Nullable'),
- 			bigquery.SchemaField('uuid','STRING',mode='Nullable'),
- 			bigquery.SchemaField('startNode','STRING',mode='Nullable'),
- 		]
-
-
-alertsSchema = [
- 			bigquery.SchemaField('city','STRING',mode='Nullable'),
- 			bigquery.SchemaField('confidence','INT64',mode='Nullable'),
- 			bigquery.SchemaField('nThumbsUp','INT64',mode='Nullable'),
- 			bigquery.SchemaField('street','STRING',mode='Nullable'),
- 			bigquery.SchemaField('uuid','STRING',mode='Nullable'),
- 			bigquery.SchemaField('country','STRING',mode='Nullable'),
- 			bigquery.SchemaField('type','STRING',mode='Nullable'),
- 			bigquery.SchemaField('subtype','STRING',mode='Nullable'),
- 			bigquery.SchemaField('roadType','INT64',mode='Nullable'),
- 			bigquery.SchemaField('reliability','INT64',mode='Nullable'),
- 			bigquery.SchemaField('magvar','INT64',mode='Nullable'),
- 			bigquery.SchemaField('reportRating','INT64',mode='Nullable'),
- 			bigquery.SchemaField('ms','INT64',mode='Nullable'),
- 			bigquery.SchemaField('ts','TIMESTAMP',mode='Nullable'),
- 			bigquery.SchemaField('reportDescription','STRING',mode='Nullable'),
- 			bigquery.SchemaField('geo','GEOGRAPHY',mode='Nullable'),
- 			bigquery.SchemaField('geoWKT','STRING',mode='Nullable')
- 		]
-irregularitiesSchema =[
- 			bigquery.SchemaField('trend','INT64',mode='Nullable'),
- 			bigquery.SchemaField('street','STRING',mode='Nullable'),
- 			bigquery.SchemaField('endNode','STRING',mode='Nullable'),
- 			bigquery.SchemaField('nImages','INT64',mode='Nullable'),
- 			bigquery.SchemaField('speed','FLOAT64',mode='Nullable'),
- 			bigquery.SchemaField('id','STRING',mode='Nullable'),
- 			bigquery.SchemaField('severity','INT64',mode='Nullable'),
- 			bigquery.SchemaField('type','STRING',mode='Nullable'),
- 			bigquery.SchemaField('highway','BOOL',mode='Nullable'),
- 			bigquery.SchemaField('nThumbsUp','INT64',mode='Nullable'),
- 			bigquery.SchemaField('seconds','INT64',mode='Nullable'),
- 			bigquery.SchemaField('alertsCount','INT64',mode='Nullable'),
- 			bigquery.SchemaField('detectionDateMS','INT64',mode='Nullable'),
- 			bigquery.SchemaField('detectionDateTS','TIMESTAMP',mode='Nullable'),
- 			bigquery.SchemaField('driversCount','INT64',mode='Nullable'),
- 			bigquery.SchemaField('geo','GEOGRAPHY',mode='Nullable'),
- 			bigquery.SchemaField('geoWKT','STRING',mode='Nullable'),
- 			bigquery.SchemaField('startNode','STRING',mode='Nullable'),
- 			bigquery.SchemaField('updateDateMS','INT64',mode='Nullable'),
- 			bigquery.SchemaField('updateDateTS','TIMESTAMP',mode='Nullable'),
- 			bigquery.SchemaField('regularSpeed','FLOAT64',mode='Nullable'),
- 			bigquery.SchemaField('country','STRING',mode='Nullable'),
- 			bigquery.SchemaField('length','INT64',mode='Nullable'),
- 			bigquery.SchemaField('delaySeconds','INT64',mode='Nullable'),
- 			bigquery.SchemaField('jamLevel','INT64',mode='Nullable'),
- 			bigquery.SchemaField('nComments','INT64',mode='Nullable'),
- 			bigquery.SchemaField('city','STRING',mode='Nullable'),
- 			bigquery.SchemaField('causeType','STRING',mode='Nullable'),
- 			bigquery.SchemaField('causeAlertUUID','STRING',mode='Nullable'),
-
- 		]
+#These are also referenced with each write. The columns are listed in waze/schemas.py
+jamsSchema = [bigquery.SchemaField(name,fieldType,mode='Nullable') for name, fieldType in schemas.jamsFields]
+alertsSchema = [bigquery.SchemaField(name,fieldType,mode='Nullable') for name, fieldType in schemas.alertsFields]
+irregularitiesSchema = [bigquery.SchemaField(name,fieldType,mode='Nullable') for name, fieldType in schemas.irregularitiesFields]
+eventsSchema = [bigquery.SchemaField(name,fieldType,mode='Nullable') for name, fieldType in schemas.eventsFields]
+caseIDField = bigquery.SchemaField(schemas.caseIDField[0],schemas.caseIDField[1],mode='Nullable')
 
 """ **** Remove this line and the quotes here and at the bottom of this block if using Carto ***
 
@@ -194,11 +208,133 @@ cartoIrregularitiesScehma = "(trend int,\
 
 cartoIrregularitiesFields = "(trend,street,endNode,nImages,speed,id,severity,type,highway,nThumbsUp,seconds,alertsCount,detectionDateMS,detectionDateTS,driversCount,startNode,updateDateMS,updateDateTS,regularSpeed,country,length,delaySeconds,jamLevel,nComments,city,causeType,causeAlertUUID,the_geom)"
 """
+#One BigQuery client per instance, shared by every request and task it serves
+_bqClient = None
+
+def bigqueryClient():
+	global _bqClient
+	if _bqClient is None:
+		_bqClient = bigquery.Client()
+	return _bqClient
+
+#Name of the BigQuery table that receives a case's rows of one feed type
+def bqTableName(feedType,uid):
+	if sharedTables:
+		return feedType
+	return feedType + '_' + str(uid).replace('-','_')
+
+#Schema of the BigQuery table that receives rows of one feed type
+def bqTableSchema(feedType):
+	if sharedTables:
+		return bqSchemas[feedType] + [caseIDField]
+	return bqSchemas[feedType]
+
+#Create the shared table of a feed type, unless another case already did
+def createSharedTable(client,feedType):
+	table = bigquery.Table(client.dataset(bqDataset).table(feedType),schema=bqTableSchema(feedType))
+	partitionField = schemas.partitionFields[feedType] if sharedTablePartitioning == 'column' else None
+	table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,field=partitionField)
+	table.clustering_fields = schemas.clusteringFields
+	try:
+		client.create_table(table)
+	except Conflict:
+		logging.info('Shared table ' + feedType + ' already exists')
+
+#Create the events table of a case, for cases created before lifecycles were tracked. Each instance
+#only tries once per case.
+_eventTables = set()
+def createEventsTable(client,uid):
+	if uid in _eventTables:
+		return
+	if sharedTables:
+		createSharedTable(client,'events')
+	else:
+		try:
+			client.create_table(bigquery.Table(client.dataset(bqDataset).table(bqTableName('events',uid)),schema=eventsSchema))
+		except Conflict:
+			pass
+	_eventTables.add(uid)
+
+#How a case's new rows reach BigQuery: streamed as they arrive, or staged in GCS for load jobs
+ingestModes = ['stream', 'batch']
+
 #Define a Datastore ndb Model for each Waze "case" (Study area) that you want to monitor
 class caseModel(ndb.Model):
   uid = ndb.StringProperty()
   name = ndb.StringProperty()
   day = ndb.StringProperty()
+  lastSnapshot = ndb.StringProperty()
+  #When the tick that scheduled lastSnapshot ran, which orders the snapshots a case is updated from
+  lastScheduled = ndb.DateTimeProperty(indexed=False)
+  ingestMode = ndb.StringProperty(default='stream', choices=ingestModes)
+  #GeoJSON Polygon or MultiPolygon the case is limited to, or None for the whole feed
+  area = ndb.JsonProperty()
+  #Names of the wazeFeeds the case is built from, empty for the 'default' feed
+  feeds = ndb.StringProperty(repeated=True)
+  #Smoothed duration of the case's recent updates, used to spread cases over shards
+  runMillis = ndb.IntegerProperty(indexed=False)
+  #The update holding the case, and until when
+  leaseID = ndb.StringProperty(indexed=False)
+  leaseUntil = ndb.DateTimeProperty(indexed=False)
+
+#Define a Datastore ndb Model remembering, per feed URL, the validators and content hash of the
+#last successful fetch, used to make the next fetch conditional.
+class feedFetchState(ndb.Model):
+	etag = ndb.StringProperty(indexed=False)
+	lastModified = ndb.StringProperty(indexed=False)
+	snapshotHash = ndb.StringProperty(indexed=False)
+	fetched = ndb.DateTimeProperty(auto_now=True)
+
+#Define a Datastore ndb Model for each distinct Waze feed payload, keyed by its content hash.
+#The cron handler fetches the feed once per tick and stores the raw payload in GCS, every
+#case task then reads that one copy instead of fetching and parsing the feed itself.
+#Snapshots older than snapshotRetentionHours are deleted daily, with their payloads.
+#A snapshot merged from several feeds has no payload of its own, only the hashes of its parts.
+class feedSnapshot(ndb.Model):
+	gcsFile = ndb.StringProperty()
+	parts = ndb.StringProperty(repeated=True,indexed=False)
+	size = ndb.IntegerProperty()
+	fetchMillis = ndb.IntegerProperty()
+	wireBytes = ndb.IntegerProperty()
+	fetched = ndb.DateTimeProperty(auto_now_add=True)
+
+#Define a Datastore ndb Model recording the state a case was left with by its last processed
+#snapshot, one entity per case and feed type keyed by '<uid>:<feed type>': the number of
+#caseFingerprintShard entities holding the fingerprint of every item it saw, used to work out which
+#items were added, changed or removed since the previous poll, and with trackLifecycles, the number
+#of caseLifecycleShard entities its lifecycles are in. fingerprints is only read, from entities
+#written before the fingerprints were sharded.
+class caseFeedState(ndb.Model):
+	fingerprints = ndb.JsonProperty(compressed=True)
+	fingerprintShards = ndb.IntegerProperty(indexed=False)
+	lifecycleShards = ndb.IntegerProperty(indexed=False)
+	updated = ndb.DateTimeProperty(auto_now=True)
+
+#Define Datastore ndb Models holding part of the fingerprints, or of the running aggregates (see
+#waze/lifecycle.py), of a case and feed type, keyed by '<uid>:<feed type>:<shard>'. A large case's
+#state would not fit in one entity, so it is spread over shards of stateShardBytes (see waze/shards.py).
+class caseFingerprintShard(ndb.Model):
+	fingerprints = ndb.JsonProperty(compressed=True)
+
+class caseLifecycleShard(ndb.Model):
+	lifecycles = ndb.JsonProperty(compressed=True)
+
+#Keys of the shard entities of a case and feed type
+def stateShardKeys(model,uid,feedType,count):
+	return [ndb.Key(model, uid + ':' + feedType + ':' + str(n)) for n in range(count or 0)]
+
+#The fingerprint shards a caseFeedState points to, read from the entities already loaded
+def fingerprintShards(state,uid,feedType,entities):
+	if state.fingerprintShards is None:
+		return [state.fingerprints]
+	keys = stateShardKeys(caseFingerprintShard,uid,feedType,state.fingerprintShards)
+	return [entities[key].fingerprints for key in keys if entities.get(key)]
+
+#Define a Datastore ndb Model holding the content hash of every tile written for a case and feed
+#type, keyed by '<uid>:<feed type>', so that unchanged tiles are not written again.
+class caseTileState(ndb.Model):
+	hashes = ndb.JsonProperty(compressed=True)
+	updated = ndb.DateTimeProperty(auto_now=True)
 
 #This application will track unique entities for Jams, Alerts, and Irregularities.
 #We don't want to write duplicate events to BigQuery if they persist through the refresh window.
@@ -218,6 +354,211 @@ class uniqueIrregularities(ndb.Model):
 	tableUUID = ndb.StringProperty()
 	irregularitiesUUID = ndb.StringProperty()
 
+#Unique entities are keyed by '<tableUUID>:<day bucket>:<item id>', so a whole snapshot can be checked
+#with one batched get instead of one query per item, and expired days deleted as one key range.
+#The day bucket is the item's publication day (see waze/extract.py).
+uniqueModels = {
+	'uniqueAlerts': (uniqueAlerts, 'alertsUUID'),
+	'uniqueJams': (uniqueJams, 'jamsUUID'),
+	'uniqueIrregularities': (uniqueIrregularities, 'irregularitiesUUID'),
+}
+
+#Build the deterministic key of a unique entity for a case and bucketed item id ('YYYYMMDD:<id>')
+def uniqueKey(model,uid,itemID):
+	return ndb.Key(model, str(uid) + ':' + itemID)
+
+#Recently seen unique ids, one bounded cache per case
+_dedupCaches = {}
+
+def dedupCache(uid):
+	cache = _dedupCaches.get(uid)
+	if cache is None:
+		cache = _dedupCaches.setdefault(uid, LRUCache(dedupCacheSize, dedupCacheTTL))
+	return cache
+
+#Count where each dedup lookup was answered, across all instances
+def countDedupLookups(localHits,memcacheHits,datastoreHits,misses):
+	return memcache.Client().offset_multi_async({'localHits': localHits, 'memcacheHits': memcacheHits, 'datastoreHits': datastoreHits, 'misses': misses},
+		key_prefix='dedupStats:', initial_value=0)
+
+#Check a snapshot's item ids against the instance cache, then memcache, then Datastore with one
+#batched get, and record the unseen ones with one batched put. Returns the indexes of the item ids
+#that were not seen before.
+def filterUnique(model,idField,uid,itemIDs,stats=None):
+	cache = dedupCache(uid)
+	keyIDs = [model.__name__ + ':' + str(uid) + ':' + itemID for itemID in itemIDs]
+	pending = [n for n in range(len(itemIDs)) if not cache.contains(keyIDs[n])]
+	localHits = len(itemIDs) - len(pending)
+
+	memcacheLookups = 1 if pending else 0
+	cached = memcache.get_multi([keyIDs[n] for n in pending], namespace='dedup') if pending else {}
+	cache.addMany(cached)
+	memcacheHits = len(cached)
+	pending = [n for n in pending if keyIDs[n] not in cached]
+
+	existing = ndb.get_multi([uniqueKey(model,uid,itemIDs[n]) for n in pending])
+	newIndexes = []
+	newEntities = []
+	foundIDs = set()
+	seenIDs = set()
+	for n, entity in zip(pending, existing):
+		isNew = entity is None and keyIDs[n] not in seenIDs
+		seenIDs.add(keyIDs[n])
+		if entity is not None:
+			foundIDs.add(keyIDs[n])
+		if not isNew:
+			continue
+		newIndexes.append(n)
+		newEntities.append(model(key=uniqueKey(model,uid,itemIDs[n]),tableUUID=str(uid),**{idField: itemIDs[n].split(':',1)[1]}))
+
+	#The caches only learn of ids that are in Datastore, so they are updated once the put has
+	#succeeded: if it fails, the task is retried and the new items are looked up again rather than
+	#taken for duplicates
+	putFuture = ndb.put_multi_async(newEntities)
+	rpcs = [countDedupLookups(localHits, memcacheHits, len(pending) - len(newIndexes), len(newIndexes))]
+	storedIDs = set(foundIDs)
+	for n, future in zip(newIndexes, putFuture):
+		future.get_result()
+		storedIDs.add(keyIDs[n])
+	if storedIDs:
+		rpcs.append(memcache.Client().set_multi_async(dict.fromkeys(storedIDs, 1), time=dedupCacheTTL, namespace='dedup'))
+	for rpc in rpcs:
+		rpc.get_result()
+	cache.addMany(storedIDs)
+	if stats:
+		stats.add('memcacheRPCs',len(rpcs) + memcacheLookups)
+		stats.add('datastoreRPCs',(1 if pending else 0) + (1 if newEntities else 0))
+	logging.info(model.__name__ + ' dedup: ' + json.dumps(dict(cache.stats(), memcacheHits=memcacheHits, datastoreLookups=len(pending), new=len(newIndexes))))
+	return newIndexes
+
+#App Request Handler reporting the dedup cache counters, to help tune dedupCacheSize and dedupCacheTTL.
+#Counters are summed across instances, cache sizes are for the instance serving the request.
+class dedupStats(webapp2.RequestHandler):
+	def get(self):
+		counters = memcache.get_multi(['localHits', 'memcacheHits', 'datastoreHits', 'misses', 'purged', 'purgeMillis'], key_prefix='dedupStats:')
+		caches = dict((uid, cache.stats()) for uid, cache in _dedupCaches.items())
+		self.response.headers['Content-Type'] = 'application/json'
+		self.response.write(json.dumps({"counters": counters, "instanceCaches": caches}))
+
+#Unique entity keys in the current '<tableUUID>:<day bucket>:<item id>' format
+bucketedKeyPattern = re.compile(r'^[^:]+:\d{8}:')
+
+#The bucketed dedup keys of the items in a case's latest snapshot, by dedup id
+def snapshotDedupKeys(case,feedType):
+	snapshot = loadSnapshot(case.lastSnapshot) if case.lastSnapshot else None
+	if snapshot is None:
+		return {}
+	data, fetchInfo = snapshot
+	keys, rows = extractRows(extractors[feedType],data.get(feedType) or [],0)
+	return dict((key.split(':',1)[1], key) for key in keys)
+
+#Re-key the unique entities of a case written before they were kept in day buckets: with
+#auto-generated ids, or keyed by case and item id only. Their publication day is only known for the
+#items still in the case's latest snapshot, which are moved to their day bucket; the other items left
+#the feed and won't be seen again, so their entities are deleted. Runs as a chain of deferred tasks,
+#one page of one model and case per task.
+def migrateUniqueEntities(modelName,uid,cursor=None,migrated=0,deleted=0):
+	model, idField = uniqueModels[modelName]
+	startCursor = Cursor(urlsafe=cursor) if cursor else None
+	entities, nextCursor, more = model.query(model.tableUUID == uid).fetch_page(500, start_cursor=startCursor)
+	legacy = [entity for entity in entities if not isinstance(entity.key.id(), basestring) or not bucketedKeyPattern.match(entity.key.id())]
+	if legacy:
+		case = caseModel.query(caseModel.uid == uid).get()
+		feedType = [feedType for feedType, name in feedUniqueModels.items() if name == modelName][0]
+		dedupKeys = snapshotDedupKeys(case,feedType) if case else {}
+		live = [(entity, dedupKeys[getattr(entity,idField)]) for entity in legacy if getattr(entity,idField) in dedupKeys]
+		ndb.put_multi([model(key=uniqueKey(model,uid,dedupKey),tableUUID=uid,**{idField: getattr(entity,idField)}) for entity, dedupKey in live])
+		ndb.delete_multi([entity.key for entity in legacy])
+		migrated += len(live)
+		deleted += len(legacy) - len(live)
+	if more and nextCursor:
+		deferred.defer(migrateUniqueEntities,modelName,uid,nextCursor.urlsafe(),migrated,deleted)
+		return
+	logging.info(json.dumps({'migrated': modelName, 'case': uid, 'rekeyed': migrated, 'deleted': deleted}))
+
+#Called daily from cron.yaml, this handler adds a task per case and unique model deleting the day
+#buckets older than dedupRetentionDays, except for the items still in the case's feed
+class purgeDedup(webapp2.RequestHandler):
+	def get(self):
+		cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=dedupRetentionDays)).strftime('%Y%m%d')
+		for case in caseModel.query():
+			for modelName in uniqueModels:
+				deferred.defer(purgeDedupBuckets,modelName,case.uid,cutoff)
+
+#Whether a dedup id belongs to an item still in the feed. Dedup ids start with the item's key
+#(irregularities append their update time to it), so the prefixes of the id are looked up among the
+#keys the case's feed state holds, of the given lengths.
+def inFeed(dedupID,itemKeys,keyLengths):
+	return any(dedupID[:length] in itemKeys for length in keyLengths)
+
+#Delete the unique entities of a case in the buckets before cutoff ('YYYYMMDD'). Bucketed keys sort
+#by day within a case, so the expired ones are one key range, read keys-only a page at a time and
+#deleted in batches, leaving out the items still in the case's feed. Each task chains the next until
+#the range is empty, carrying the throughput counters.
+def purgeDedupBuckets(modelName,uid,cutoff,cursor=None,deleted=0,elapsedMillis=0,kept=0):
+	model, idField = uniqueModels[modelName]
+	start = time.time()
+	query = model.query(model.key >= ndb.Key(model, uid + ':'), model.key < ndb.Key(model, uid + ':' + cutoff))
+	startCursor = Cursor(urlsafe=cursor) if cursor else None
+	keys, nextCursor, more = query.fetch_page(purgePageSize, start_cursor=startCursor, keys_only=True)
+	feedType = [feedType for feedType, name in feedUniqueModels.items() if name == modelName][0]
+	state = ndb.Key(caseFeedState, uid + ':' + feedType).get()
+	itemKeys = set()
+	if state:
+		shardKeys = stateShardKeys(caseFingerprintShard,uid,feedType,state.fingerprintShards)
+		itemKeys = set(mergeShards(fingerprintShards(state,uid,feedType,dict(zip(shardKeys, ndb.get_multi(shardKeys))))) or {})
+	keyLengths = set(len(key) for key in itemKeys)
+	expired = [key for key in keys if not inFeed(key.id().split(':',2)[2],itemKeys,keyLengths)]
+	kept += len(keys) - len(expired)
+	keys = expired
+	futures = [ndb.delete_multi_async(keys[n:n + 500]) for n in range(0, len(keys), 500)]
+	for batch in futures:
+		for future in batch:
+			future.get_result()
+	pageMillis = int((time.time() - start) * 1000)
+	memcache.offset_multi({'purged': len(keys), 'purgeMillis': pageMillis}, key_prefix='dedupStats:', initial_value=0)
+	deleted += len(keys)
+	elapsedMillis += pageMillis
+	if more and nextCursor:
+		deferred.defer(purgeDedupBuckets,modelName,uid,cutoff,nextCursor.urlsafe(),deleted,elapsedMillis,kept)
+		return
+	logging.info(json.dumps({'purged': modelName, 'case': uid, 'before': cutoff, 'deleted': deleted, 'kept': kept,
+		'millis': elapsedMillis, 'perSecond': round(deleted * 1000.0 / elapsedMillis, 1) if elapsedMillis else None}))
+
+#Called daily from cron.yaml, this handler adds a task deleting the feed snapshots older than snapshotRetentionHours
+class purgeSnapshots(webapp2.RequestHandler):
+	def get(self):
+		deferred.defer(purgeOldSnapshots,datetime.datetime.utcnow() - datetime.timedelta(hours=snapshotRetentionHours))
+
+#Delete the feed snapshots fetched before cutoff and their payloads, a page at a time. The latest
+#snapshot of each feed is kept, since ticks reuse it for as long as the feed doesn't change.
+def purgeOldSnapshots(cutoff,cursor=None,deleted=0):
+	current = set(state.snapshotHash for state in feedFetchState.query())
+	startCursor = Cursor(urlsafe=cursor) if cursor else None
+	snapshots, nextCursor, more = feedSnapshot.query(feedSnapshot.fetched < cutoff).fetch_page(500, start_cursor=startCursor)
+	expired = [snapshot for snapshot in snapshots if snapshot.key.id() not in current]
+	for snapshot in expired:
+		if snapshot.gcsFile:
+			try:
+				gcs.delete(snapshot.gcsFile)
+			except gcs.NotFoundError:
+				pass
+	ndb.delete_multi([snapshot.key for snapshot in expired])
+	deleted += len(expired)
+	if more and nextCursor:
+		deferred.defer(purgeOldSnapshots,cutoff,nextCursor.urlsafe(),deleted)
+		return
+	logging.info(json.dumps({'purged': 'snapshots', 'before': cutoff.isoformat(), 'deleted': deleted}))
+
+#App Request Handler to move the unique entities left from earlier versions to day buckets, with a
+#task per case and unique model.
+#Call ONCE after deploying as: {your-app}.appspot.com/{guid}/migrateUnique/
+class migrateUnique(webapp2.RequestHandler):
+	def get(self):
+		for case in caseModel.query():
+			for modelName in uniqueModels:
+				deferred.defer(migrateUniqueEntities,modelName,case.uid)
+
 #App Request Handler to create a new Case.
 #Called ONCE as: {your-app}.appspot.com/newCase/?name={your-case-name}
 #This handler can be disabled after you create your first case if you
@@ -227,40 +568,69 @@ class newCase(webapp2.RequestHandler):
 		uid = uuid.uuid4()
 		name = self.request.get("name")
 		day = datetime.datetime.now().strftime("%Y-%m-%d")
+		#'stream' inserts rows as they arrive, 'batch' stages them in GCS for periodic load jobs
+		ingestMode = self.request.get("ingest", "stream")
+		if ingestMode not in ingestModes:
+			self.response.set_status(400)
+			self.response.write('ingest must be one of: ' + ', '.join(ingestModes))
+			return
 		if not name:
 			name = ""
+		#Optional study area, as bbox=minLon,minLat,maxLon,maxLat or polygon={GeoJSON geometry}
+		try:
+			area = parseArea(self.request.get("bbox"),self.request.get("polygon"))
+		except ValueError as e:
+			self.response.set_status(400)
+			self.response.write(str(e))
+			return
+		#Optional feeds to merge, as feeds=name1,name2 from wazeFeeds
+		feeds = [feedName for feedName in self.request.get("feeds").split(',') if feedName]
+		unknownFeeds = [feedName for feedName in feeds if feedName not in wazeFeeds]
+		if unknownFeeds:
+			self.response.set_status(400)
+			self.response.write('Unknown feeds: ' + ', '.join(unknownFeeds))
+			return
 
  		#Write the new Case details to Datastore
- 		wazePut = caseModel(uid=str(uid),day=day,name=name)
+ 		wazePut = caseModel(uid=str(uid),day=day,name=name,ingestMode=ingestMode,area=area,feeds=feeds)
  		wazeKey = wazePut.put()
 
- 		#Create the BigQuery Client
- 		client = bigquery.Client()
- 		datasetRef = client.dataset(bqDataset)
- 		tableSuffix = str(uid).replace('-','_')
+		#Get the BigQuery Client
+		client = bigqueryClient()
+		datasetRef = client.dataset(bqDataset)
+		tableSuffix = str(uid).replace('-','_')
+		jamsTable = 'jams_' + tableSuffix
+		alertsTable = 'alerts_' + tableSuffix
+		irregularitiesTable = 'irregularities_' + tableSuffix
+
+		#With shared tables, the first case creates one partitioned and clustered table per feed type
+		if sharedTables:
+			for feedType in feedTypes:
+				createSharedTable(client,feedType)
+		else:
+			#Create the Jams Table
+			tableRef = datasetRef.table(jamsTable)
+			table = bigquery.Table(tableRef,schema=jamsSchema)
+			table = client.create_table(table)
+			assert table.table_id == jamsTable
 
- 		#Create the Jams Table
- 		jamsTable = 'jams_' + tableSuffix
- 		tableRef = datasetRef.table(jamsTable)
- 		table = bigquery.Table(tableRef,schema=jamsSchema)
- 		table = client.create_table(table)
- 		assert table.table_id == jamsTable
 
+			#Create the Alerts Table
+			tableRef = datasetRef.table(alertsTable)
+			table = bigquery.Table(tableRef,schema=alertsSchema)
+			table = client.create_table(table)
+			assert table.table_id == alertsTable
 
- 		#Create the Alerts Table
- 		alertsTable = 'alerts_' + tableSuffix
- 		tableRef = datasetRef.table(alertsTable)
- 		table = bigquery.Table(tableRef,schema=alertsSchema)
- 		table = client.create_table(table)
- 		assert table.table_id == alertsTable
 
+			#Create the Irregularities Table
+			tableRef = datasetRef.table(irregularitiesTable)
+			table = bigquery.Table(tableRef,schema=irregularitiesSchema)
+			table = client.create_table(table)
+			assert table.table_id == irregularitiesTable
 
- 		#Create the Irregularities Table
- 		irregularitiesTable = 'irregularities_' + tableSuffix
- 		tableRef = datasetRef.table(irregularitiesTable)
- 		table = bigquery.Table(tableRef,schema=irregularitiesSchema)
- 		table = client.create_table(table)
- 		assert table.table_id == irregularitiesTable
+		#Create the Events Table
+		if trackLifecycles:
+			createEventsTable(client,str(uid))
 
 """ **** Remove this line and the quotes here and at the bottom of this block to also register the Case Study to Carto using CartoSQL ***
 
@@ -326,529 +696,531 @@ class newCase(webapp2.RequestHandler):
 
 """
 
-#Called at your set cron interval, this function loops through all the cases in datastore
-#And adds a task to update the case's tables in Taskqeue
+#Called at your set cron interval, this function fetches every Waze feed once, concurrently, stores
+#them as snapshots, and adds tasks to update the cases' tables in Taskqeue, a shard of cases per task.
+#Cases built from several feeds are updated from a snapshot merging them.
+#Nothing is deferred when no feed changed since the previous tick, and cases that
+#already processed an identical snapshot, or are still being updated, are skipped.
 class updateCaseStudies(webapp2.RequestHandler):
 	def get(self):
-		caseStudies = caseModel.query()
-		for case in caseStudies:
-			result = deferred.defer(updateCase,case)
-
-#For each Case, update each table
-def updateCase(case):
-	url = wazeURL
-	try:
-		result = urlfetch.fetch(url)
-		if result.status_code == 200:
-			data = json.loads(result.content)
-			#Get the 3 components from the Waze CCP JSON Response
-			alerts = data.get('alerts')
-			jams = data.get('jams')
-			irregularities = data.get('irregularities')
-			if alerts is not None:
-				processAlerts(data['alerts'],case.uid,case.day)
-			if jams is not None:
-				processJams(data['jams'],case.uid,case.day)
-			if irregularities is not None:
-				processIrregularities(data['irregularities'],case.uid,case.day)
-		else:
-			logging.exception(result.status_code)
-	except urlfetch.Error:
-		logging.exception('Caught exception fetching Waze URL')
-
-#Process the Alerts
-def processAlerts(alerts,uid,day):
-	now = datetime.datetime.now().strftime("%s")
-	features = []
-	bqRows = []
-	cartoRows =[]
-	for item in alerts:
-		ms = item.get('pubMillis')
-		itemTimeStamp = datetime.datetime.fromtimestamp(ms/1000.0)
-		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
-		if itemTimeStamp >= caseTimeMinimum:
-			timestamp = datetime.datetime.fromtimestamp(ms/1000.0).strftime("%Y-%m-%d %H:%M:%S")
-			city = item.get('city')
-			street = item.get('street')
-			confidence = item.get('confidence')
-			nThumbsUp = item.get('nThumbsUp')
-			uuid = item.get('uuid')
-			country = item.get('country')
-			subtype = item.get('subtype')
-			roadType = item.get('roadType')
-			reliability = item.get('reliability')
-			magvar = item.get('magvar')
-			alertType = item.get('type')
-			reportRating = item.get('reportRating')
-			reportDescription = item.get('reportDescription')
-			longitude = item.get('location').get('x')
-			latitude = item.get('location').get('y')
-			#Create GCS GeoJSON Properties
-			properties = {"city": city,
-				"street": street,
-				"confidence": confidence,
-				"nThumbsUp": nThumbsUp,
-				"uuid": uuid,
-				"country": country,
-				"subtype": subtype,
-				"roadType": roadType,
-				"reliability": reliability,
-				"magvar": magvar,
-				"type": alertType,
-				"reportRating": reportRating,
-				"pubMillis": ms,
-				"timestamp": timestamp,
-				"reportDescription": reportDescription,
-			}
-			geometry = {"type": "Point",
-							"coordinates": [longitude, latitude]
-			}
-			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
-			#BigQuery Row Creation
-			datastoreQuery = uniqueAlerts.query(uniqueAlerts.tableUUID == uid, uniqueAlerts.alertsUUID == uuid)
-			datastoreCheck = datastoreQuery.get()
-			if not datastoreCheck:
-				bqRow = {"city": city,
-							"street": street,
-							"confidence": confidence,
-							"nThumbsUp": nThumbsUp,
-							"uuid": uuid,
-							"country": country,
-							"subtype": subtype,
-							"roadType": roadType,
-							"reliability": reliability,
-							"magvar": magvar,
-							"type": alertType,
-							"reportRating": reportRating,
-							"ms": ms,
-							"ts": timestamp,
-							"reportDescription": reportDescription,
-							"geo": "Point(" + str(longitude) + " " + str(latitude) + ")",
-							"geoWKT": "Point(" + str(longitude) + " " + str(latitude) + ")"
-				}
-				bqRows.append(bqRow)
-				""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-
-				# Create Carto Row
-				if city is not None:
-					city = unidecode.unidecode(city)
-				if street is not None:
-					street = unidecode.unidecode(street)
-				if uuid is not None:
-					uuid = unidecode.unidecode(uuid)
-				if country is not None:
-					country = unidecode.unidecode(country)
-				if alertType is not None:
-					alertType = unidecode.unidecode(alertType)
-				if subtype is not None:
-					subtype = unidecode.unidecode(subtype)
-				if reportDescription is not None:
-					reportDescription = unidecode.unidecode(reportDescription)
-
-				cartoRow = "('{city}',{confidence},{nThumbsUp},'{street}','{uuid}','{country}','{type}','{subtype}',{roadType},{reliability},{magvar},{reportRating},{ms},'{ts}','{reportDescription}',ST_GeomFromText({the_geom},4326))".format(
-					city=city, confidence=confidence, nThumbsUp=nThumbsUp, street=street, uuid=uuid, country=country,
-					type=alertType, subtype=subtype, roadType=roadType, reliability=reliability, magvar=magvar,
-					reportRating=reportRating, ms=ms, ts=timestamp, reportDescription=reportDescription, the_geom="'Point(" + str(longitude) + " " + str(latitude) + ")'")
-				cartoRows.append(cartoRow)
-				"""
-
-				#Add uuid to Datastore
-				alertPut = uniqueAlerts(tableUUID=str(uid), alertsUUID=str(uuid))
-	 			alertKey = alertPut.put()
-
- 	#Write GeoJSONs to GCS
-	alertGeoJSON = json.dumps({"type": "FeatureCollection", "features": features})
-	writeGeoJSON(alertGeoJSON,gcsPath  + uid + '/' + uid + '-alerts.geojson')
-	writeGeoJSON(alertGeoJSON,gcsPath  + uid + '/' + uid + '-' + now +'-alerts.geojson')
-
-	alertsTable = 'alerts_' + str(uid).replace('-','_')
-	#Stream new Rows to BigQuery
-	if bqRows:
-		client = bigquery.Client()
-		datasetRef = client.dataset(bqDataset)
-		tableRef = datasetRef.table(alertsTable)
-		table = bigquery.Table(tableRef,schema=alertsSchema)
-		errors = client.insert_rows(table, bqRows)
+		#Let the queue drain before adding to it, the next tick picks up the latest snapshot
+		queued = taskqueue.Queue(caseQueue).fetch_statistics().tasks
+		if queued > maxQueuedTasks:
+			logging.warning(json.dumps({"schedule": "backpressure", "queued": queued}))
+			return
+		snapshots = fetchSnapshots(wazeFeeds)
+		if not any(changed for snapshotHash, changed in snapshots.values()):
+			return
+		now = datetime.datetime.utcnow()
+		leased = 0
+		#Cases are sharded by snapshot, since cases built from different feeds don't share one
+		caseSnapshots = {}
+		for case in caseModel.query():
+			snapshotHash = caseSnapshot(case,snapshots)
+			if snapshotHash is None or case.lastSnapshot == snapshotHash:
+				continue
+			if case.leaseUntil and case.leaseUntil > now:
+				leased += 1
+				continue
+			caseSnapshots.setdefault(snapshotHash, []).append((case.key, case.runMillis or defaultRunMillis))
+		for snapshotHash, costs in caseSnapshots.items():
+			shards = planShards(costs,shardBudgetMillis)
+			#The lease id is fixed per task, so that retries of a task can take their cases back
+			for shard in shards:
+				deferred.defer(updateShard,shard,snapshotHash,str(uuid.uuid4()),now,_queue=caseQueue)
+			logging.info(json.dumps({"schedule": snapshotHash, "cases": len(costs), "shards": len(shards)}))
+		logging.info(json.dumps({"schedule": "tick", "snapshots": len(caseSnapshots), "leased": leased, "queued": queued}))
+
+#The snapshot a case is to be updated from: the latest snapshot of its feed, or a merge of the latest
+#snapshots of its feeds. None if none of them has been fetched yet.
+def caseSnapshot(case,snapshots):
+	feedNames = case.feeds or ['default']
+	parts = []
+	for feedName in feedNames:
+		if feedName not in wazeFeeds:
+			logging.warning('Case ' + case.uid + ' uses unknown feed ' + feedName)
+			continue
+		snapshotHash, changed = snapshots[feedName]
+		if snapshotHash is not None and snapshotHash not in parts:
+			parts.append(snapshotHash)
+	if not parts:
+		return None
+	if len(parts) == 1:
+		return parts[0]
+	return mergedSnapshot(parts)
+
+#Record a snapshot merging several feed snapshots, identified by the hashes of its parts, so that
+#every case built from the same feeds shares it. The merge itself happens in loadSnapshot.
+def mergedSnapshot(parts):
+	snapshotHash = feed.contentHash(','.join(parts))
+	snapshotKey = ndb.Key(feedSnapshot, snapshotHash)
+	if snapshotKey.get() is None:
+		feedSnapshot(key=snapshotKey,parts=parts).put()
+	return snapshotHash
+
+#Update the cases of a shard one after the other. A case leased by another update is skipped,
+#and a failing case doesn't hold up the rest of the shard: the task is retried once the others are
+#done, and the cases already at the snapshot are skipped then. So are the cases a later tick has
+#moved on to a newer snapshot in the meantime, which a retry would otherwise roll back.
+def updateShard(caseKeys,snapshotHash,leaseID,scheduled=None):
+	failed = []
+	for caseKey in caseKeys:
+		case = acquireCaseLease(caseKey,leaseID)
+		if case is None:
+			logging.info(json.dumps({"case": caseKey.id(), "skipped": "leased"}))
+			continue
+		if case.lastSnapshot == snapshotHash or (scheduled and case.lastScheduled and case.lastScheduled >= scheduled):
+			finishCaseRun(caseKey,leaseID)
+			continue
 		try:
-			assert errors == []
-			logging.info(errors)
-		except AssertionError, e:
-			logging.warning(e)
-	""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-	# Load Rows to Carto
-
-	if cartoRows:
-		cartoQuery = "INSERT INTO " + alertsTable + " " + cartoAlertsFields + "VALUES " + ",".join(cartoRows)
-		cartoQuery = cartoQuery.replace("'None'","null").replace("None","null")
-		cartoQueryEncoded = urllib.urlencode({"q":cartoQuery})
-		# logging.info(cartoQuery)
-		# logging.info(cartoQueryEncoded)
-
-
-		# url = cartoURLBase + cartoQueryEncoded + "&api_key=" + cartoAPIKey
-		url = cartoURLBase + "&api_key=" + cartoAPIKey
-		# logging.info(url)
-		try:
-			result = urlfetch.fetch(url, validate_certificate=True,method=urlfetch.POST,payload=cartoQueryEncoded)
-			if result.status_code == 200:
-				logging.info('Inserted Alerts Data to Carto')
+			updateCase(case,snapshotHash,leaseID,scheduled)
+		except Exception:
+			logging.exception('Updating case ' + case.uid + ' failed')
+			failed.append(case.uid)
+	if failed:
+		raise RuntimeError('Updating cases ' + ', '.join(failed) + ' failed')
+
+#Parsed snapshots kept in instance memory, so tasks landing on the same instance
+#within a tick only read and parse the payload once.
+_snapshotCache = {}
+_snapshotCacheSize = 2 * len(wazeFeeds) + 2
+_snapshotIndexes = {}
+
+#Start an asynchronous, compressed and conditional fetch of a feed
+def startFetch(url,state):
+	rpc = urlfetch.create_rpc(deadline=fetchDeadline)
+	headers = feed.requestHeaders(state.etag, state.lastModified) if state else feed.requestHeaders()
+	urlfetch.make_fetch_call(rpc, url, headers=headers)
+	return rpc
+
+#Fetch feeds concurrently, retrying errors and 5xx responses a bounded number of times with backoff,
+#all the feeds that need another attempt at once. Returns a waze.feed.FetchResult with the payload
+#bytes and timing metadata for each URL.
+def fetchFeeds(urls,states):
+	start = time.time()
+	results = {}
+	pending = list(urls)
+	for attempt in range(1, fetchAttempts + 1):
+		if attempt > 1:
+			time.sleep(fetchBackoff * 2 ** (attempt - 2))
+		rpcs = [(url, startFetch(url,states.get(url))) for url in pending]
+		pending = []
+		for url, rpc in rpcs:
+			try:
+				result = rpc.get_result()
+			except urlfetch.Error:
+				logging.exception('Caught exception fetching Waze URL ' + url + ', attempt ' + str(attempt))
+				pending.append(url)
+				continue
+			if result.status_code < 500:
+				results[url] = feed.fetchResult(result.status_code,result.content,result.headers,int((time.time() - start) * 1000),attempt)
 			else:
-				logging.exception(result.status_code)
-				logging.exception(cartoQuery)
-				writeSQLError(cartoQuery,gcsPath + 'carto_errors/' + uid + '-' + now + '-alerts.txt')
-		except urlfetch.Error:
-			logging.exception('Caught exception Inserting Data to Alerts Table ' + alertsTable)
-	"""
-#Process the Jams
-def processJams(jams,uid,day):
-	now = datetime.datetime.now().strftime("%s")
-	features = []
-	bqRows =[]
-	cartoRows = []
-	for item in jams:
-		ms = item.get('pubMillis')
-		itemTimeStamp = datetime.datetime.fromtimestamp(ms/1000.0)
-		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
-		if itemTimeStamp >= caseTimeMinimum:
-			timestamp = datetime.datetime.fromtimestamp(ms/1000.0).strftime("%Y-%m-%d %H:%M:%S")
-			city = item.get('city')
-			turnType = item.get('turnType')
-			level = item.get('level')
-			country = item.get('country')
-			segments = item.get('segments')
-			speedKMH = item.get('speedKMH')
-			roadType = item.get('roadType')
-			delay = item.get('delay')
-			length = item.get('length')
-			street = item.get('street')
-			endNode = item.get('endNode')
-			jamType = item.get('type')
-			iD = item.get('id')
-			uuid = item.get('uuid')
-			speed = item.get('speed')
-			startNode = item.get('startNode')
-			#Create GCS GeoJSON Properties
-			properties = {"city": city,
-				"turnType": turnType,
-				"level": level,
-				"country": country,
-				"segments": segments,
-				"speedKMH": speedKMH,
-				"roadType": roadType,
-				"delay": delay,
-				"length": length,
-				"street": street,
-				"pubMillis": ms,
-				"timestamp": timestamp,
-				"endNode": endNode,
-				"type": jamType,
-				"id": iD,
-				"speed": speed,
-				"uuid": uuid,
-				"startNode": startNode
-			}
-			#Create WKT Polyline for BigQuery
-			coordinates = []
-			bqLineString = ''
-			for vertex in item.get('line'):
-				longitude = vertex.get('x')
-				latitude = vertex.get('y')
-				coordinate = [longitude, latitude]
-				bqLineString += str(longitude) + " " + str(latitude) + ', '
-				coordinates.append(coordinate)
-			geometry = {"type": "LineString",
-							"coordinates": coordinates
-			}
-			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
-			#BigQuery Row Creation
-			datastoreQuery = uniqueJams.query(uniqueJams.tableUUID == str(uid), uniqueJams.jamsUUID == str(uuid))
-			datastoreCheck = datastoreQuery.get()
-			if not datastoreCheck:
-				bqRow = {"city": city,
-							"turnType": turnType,
-							"level": level,
-							"country": country,
-							"segments": segments,
-							"speedKMH": speedKMH,
-							"roadType": roadType,
-							"delay": delay,
-							"length": length,
-							"street": street,
-							"ms": ms,
-							"ts": timestamp,
-							"endNode": endNode,
-							"type": jamType,
-							"id": iD,
-							"speed": speed,
-							"uuid": uuid,
-							"startNode": startNode,
-							"geo": "LineString(" + bqLineString[:-2] + ")",
-							"geoWKT": "LineString(" + bqLineString[:-2] + ")"
-				}
-				bqRows.append(bqRow)
-				"""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-				# Create Carto Row
-
-				if city is not None:
-					city = unidecode.unidecode(city)
-				if turnType is not None:
-					turnType = unidecode.unidecode(turnType)
-				if country is not None:
-					country = unidecode.unidecode(country)
-				if street is not None:
-					street = unidecode.unidecode(street)
-				if endNode is not None:
-					endNode = unidecode.unidecode(endNode)
-				if jamType is not None:
-					jamType = unidecode.unidecode(jamType)
-				if startNode is not None:
-					startNode = unidecode.unidecode(startNode)
-
-				cartoRow = "('{city}','{turntype}',{level},'{country}',{speedKMH},{delay},{length},'{street}',{ms},'{ts}','{endNode}','{type}',{id},{speed},'{uuid}','{startNode}',ST_GeomFromText({the_geom},4326))".format(
-					city=city, turntype=turnType, level=level, country=country, speedKMH=speedKMH, delay=delay,
-					length=length, street=street, ms=ms, ts=timestamp, endNode=endNode,
-					type=jamType, id=iD, speed=speed, uuid=uuid, startNode=startNode, the_geom="'LineString(" + bqLineString[:-2] + ")'")
-				cartoRows.append(cartoRow)
-				"""
-
-				#Add uuid to Datastore
-				jamPut = uniqueJams(tableUUID=str(uid), jamsUUID=str(uuid))
-	 			jamKey = jamPut.put()
-	jamsGeoJSON = json.dumps({"type": "FeatureCollection", "features": features})
-	writeGeoJSON(jamsGeoJSON,gcsPath  + uid + '/' + uid + '-jams.geojson')
-	writeGeoJSON(jamsGeoJSON,gcsPath  + uid + '/' + uid + '-' + now +'-jams.geojson')
-
-	#Stream new Rows to BigQuery
-	if bqRows:
-		client = bigquery.Client()
-		datasetRef = client.dataset(bqDataset)
-		jamsTable = 'jams_' + str(uid).replace('-','_')
-		tableRef = datasetRef.table(jamsTable)
-		table = bigquery.Table(tableRef,schema=jamsSchema)
-		errors = client.insert_rows(table, bqRows)
-		try:
-			assert errors == []
-			logging.info(errors)
-		except AssertionError, e:
-			logging.warning(e)
-	""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-	# Load Rows to Carto
-
-	if cartoRows:
-		cartoQuery = "INSERT INTO " + jamsTable + " " + cartoJamsFields + "VALUES " + ",".join(cartoRows)
-		cartoQuery = cartoQuery.replace("'None'","null").replace("None","null")
-		cartoQueryEncoded = urllib.urlencode({"q":cartoQuery})
-		logging.info(len(cartoQueryEncoded))
-		# logging.info(cartoQuery)
-		# logging.info(cartoQueryEncoded)
-
-
-		url = cartoURLBase + "&api_key=" + cartoAPIKey
-		logging.info(url)
-		try:
-			result = urlfetch.fetch(url, validate_certificate=True,method=urlfetch.POST,payload=cartoQueryEncoded)
-			if result.status_code == 200:
-				logging.info('Inserted Jams Data to Carto')
-			else:
-				logging.exception(result.status_code)
-				logging.exception(cartoQuery)
-				writeSQLError(cartoQuery,gcsPath + 'carto_errors/' + uid + '-' + now + '-jams.txt')
-		except urlfetch.Error:
-			logging.exception('Caught exception Inserting Data to Jams Table ' + jamsTable)
-	"""
-
-#Process the Irregularities
-def processIrregularities(irregularities,uid,day):
-	now = datetime.datetime.now().strftime("%s")
-	features = []
-	bqRows = []
-	cartoRows = []
-
-	for item in irregularities:
-		detectionDateMS = item.get('detectionDateMillis')
-		itemTimeStamp = datetime.datetime.fromtimestamp(detectionDateMS/1000.0)
-		caseTimeMinimum = datetime.datetime.strptime(day, "%Y-%m-%d")
-		if itemTimeStamp >= caseTimeMinimum:
-			detectionDateTS = datetime.datetime.fromtimestamp(detectionDateMS/1000.0).strftime("%Y-%m-%d %H:%M:%S")
-			updateDateMS = item.get('updateDateMillis')
-			updateDateTS = datetime.datetime.fromtimestamp(updateDateMS/1000.0).strftime("%Y-%m-%d %H:%M:%S")
-			causeAlert = item.get('causeAlert')
-			if causeAlert is not None:
-				causeAlertUUID = causeAlert.get('uuid')
-			else:
-				causeAlertUUID = None
-			trend = item.get('trend')
-			street = item.get('street')
-			endNode =  item.get('endNode')
-			nImages = item.get('nImages')
-			speed = item.get('speed')
-			iD = item.get('id')
-			severity = item.get('severity')
-			irregularityType = item.get('type')
-			highway = item.get('highway')
-			nThumbsUp = item.get('nThumbsUp')
-			seconds = item.get('seconds')
-			alertsCount = item.get('alertsCount')
-			driversCount = item.get('driversCount')
-			startNode = item.get('startNode')
-			regularSpeed = item.get('regularSpeed')
-			country = item.get('country')
-			length = item.get('length')
-			delaySeconds = item.get('delaySeconds')
-			jamLevel = item.get('jamLevel')
-			nComments = item.get('nComments')
-			city = item.get('city')
-			causeType = item.get('causeType')
-			#Create GCS GeoJSON Properties
-			properties = {"trend": trend,
-				"street": street,
-				"endNode": endNode,
-				"nImages": nImages,
-				"speed": speed,
-				"id": iD,
-				"severity": severity,
-				"type": irregularityType,
-				"highway": highway,
-				"nThumbsUp": nThumbsUp,
-				"seconds": seconds ,
-				"alertsCount": alertsCount,
-				"driversCount": driversCount ,
-				"startNode": startNode,
-				"regularSpeed": regularSpeed,
-				"country": country,
-				"length": length,
-				"delaySeconds": delaySeconds,
-				"jamLevel": jamLevel ,
-				"nComments": nComments,
-				"city": city,
-				"causeType": causeType,
-				"detectionDateMS": detectionDateMS,
-				"detectionDateTS": detectionDateTS,
-				"updateDateMS": updateDateMS,
-				"updateDateTS": updateDateTS,
-				"causeAlertUUID": causeAlertUUID
-			}
-			#Create WKT Polyline for BigQuery
-			coordinates = []
-			bqLineString = ''
-			for vertex in item.get('line'):
-				longitude = vertex.get('x')
-				latitude = vertex.get('y')
-				coordinate = [longitude, latitude]
-				bqLineString += str(longitude) + " " + str(latitude) + ', '
-				coordinates.append(coordinate)
-			geometry = {"type": "LineString",
-							"coordinates": coordinates
-			}
-			features.append({"type": "Feature", "properties": properties, "geometry": geometry})
-
-			#BigQuery Row Creation
-			datastoreQuery = uniqueIrregularities.query(uniqueIrregularities.tableUUID == str(uid), uniqueIrregularities.irregularitiesUUID == str(iD)+str(updateDateMS))
-			datastoreCheck = datastoreQuery.get()
-			if not datastoreCheck:
-				bqRow = {"trend": trend,
-							"street": street,
-							"endNode": endNode,
-							"nImages": nImages,
-							"speed": speed,
-							"id": iD,
-							"severity": severity,
-							"type": irregularityType,
-							"highway": highway,
-							"nThumbsUp": nThumbsUp,
-							"seconds": seconds ,
-							"alertsCount": alertsCount,
-							"driversCount": driversCount ,
-							"startNode": startNode,
-							"regularSpeed": regularSpeed,
-							"country": country,
-							"length": length,
-							"delaySeconds": delaySeconds,
-							"jamLevel": jamLevel ,
-							"nComments": nComments,
-							"city": city,
-							"causeType": causeType,
-							"detectionDateMS": detectionDateMS,
-							"detectionDateTS": detectionDateTS,
-							"updateDateMS": updateDateMS,
-							"updateDateTS": updateDateTS,
-							"causeAlertUUID": causeAlertUUID,
-							"geo": "LineString(" + bqLineString[:-2] + ")",
-							"geoWKT": "LineString(" + bqLineString[:-2] + ")"
-				}
-				bqRows.append(bqRow)
-				""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-				# Create Carto Row
-
-				if street is not None:
-					street = unidecode.unidecode(street)
-				if endNode is not None:
-					endNode = unidecode.unidecode(endNode)
-				if irregularityType is not None:
-					irregularityType = unidecode.unidecode(irregularityType)
-				if startNode is not None:
-					startNode = unidecode.unidecode(startNode)
-				if city is not None:
-					city = unidecode.unidecode(city)
-				if causeType is not None:
-					causeType = unidecode.unidecode(causeType)
-				if causeAlertUUID is not None:
-					causeAlertUUID = unidecode.unidecode(causeAlertUUID)
-
-				cartoRow = "({trend},'{street}','{endNode}',{nImages},{speed},'{id}',{severity},'{type}',{highway},{nThumbsUp},{seconds},{alertsCount},{detectionDateMS},'{detectionDateTS}',{driversCount},'{startNode}',{updateDateMS},'{updateDateTS}',{regularSpeed},'{country}',{length},{delaySeconds},{jamLevel},{nComments},'{city}','{causeType}','{causeAlertUUID}',ST_GeomFromText({the_geom},4326))".format(
-					trend=trend, street=street, endNode=endNode, nImages=nImages,speed=speed,id=iD,severity=severity,type=irregularityType,
-					highway=highway, nThumbsUp=nThumbsUp,seconds=seconds,alertsCount=alertsCount,detectionDateMS=detectionDateMS,detectionDateTS=detectionDateTS,
-					driversCount=driversCount,startNode=startNode,updateDateMS=updateDateMS, updateDateTS=updateDateTS, regularSpeed=regularSpeed, country=country,length=length,
-					delaySeconds=delaySeconds, jamLevel=jamLevel,nComments=nComments, city=city, causeType=causeType, causeAlertUUID=causeAlertUUID, the_geom="'LineString(" + bqLineString[:-2] + ")'")
-				cartoRows.append(cartoRow)
-				"""
-
-				#Add uuid to Datastore
-				irregularityPut = uniqueIrregularities(tableUUID=str(uid), irregularitiesUUID=str(iD)+str(updateDateMS))
-	 			irregularityKey = irregularityPut.put()
-	irregularitiesGeoJSON = json.dumps({"type": "FeatureCollection", "features": features})
-	writeGeoJSON(irregularitiesGeoJSON,gcsPath  + uid + '/' + uid + '-irregularities.geojson')
-	writeGeoJSON(irregularitiesGeoJSON,gcsPath  + uid + '/' + uid + '-' + now +'-irregularities.geojson')
-	# logging.info(irregularitiesGeoJSON)
-
-	#Stream new Rows to BigQuery
-	if bqRows:
-		client = bigquery.Client()
-		datasetRef = client.dataset(bqDataset)
-		irregularitiesTable = 'irregularities_' + str(uid).replace('-','_')
-		tableRef = datasetRef.table(irregularitiesTable)
-		table = bigquery.Table(tableRef,schema=irregularitiesSchema)
-		errors = client.insert_rows(table, bqRows)
-		try:
-			assert errors == []
-			logging.info(errors)
-		except AssertionError, e:
-			logging.warning(e)
-
-	""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
-	# Load Rows to Carto
+				logging.warning('Waze URL ' + url + ' returned ' + str(result.status_code) + ', attempt ' + str(attempt))
+				pending.append(url)
+		if not pending:
+			break
+	for url in pending:
+		results[url] = feed.FetchResult(None,None,None,None,int((time.time() - start) * 1000),0,fetchAttempts)
+	return results
+
+#Fetch every feed, given as {name: URL}, and store each new payload once. Returns, for each feed name,
+#the content hash of its latest payload (None if it was never fetched) and whether it changed on this
+#tick: it didn't if the fetch failed, or the feed answered 304 Not Modified or returned the same
+#payload as on the previous tick.
+def fetchSnapshots(feeds):
+	urls = sorted(set(feeds.values()))
+	states = dict(zip(urls, ndb.get_multi([ndb.Key(feedFetchState, url) for url in urls])))
+	results = fetchFeeds(urls,states)
+	snapshots = dict((url, storeSnapshot(url,states[url],results[url])) for url in urls)
+	return dict((feedName, snapshots[url]) for feedName, url in feeds.items())
+
+#Store the payload of a feed fetch, unless an identical one is stored already, see fetchSnapshots
+def storeSnapshot(url,state,result):
+	logging.info(json.dumps({"feed": "fetch", "url": url, "status": result.statusCode, "elapsedMillis": result.elapsedMillis,
+		"wireBytes": result.wireBytes, "bytes": len(result.content or ''), "attempts": result.attempts}))
+	previousHash = state.snapshotHash if state else None
+	if result.statusCode == 304:
+		return previousHash, False
+	if result.statusCode != 200:
+		logging.error('Fetching Waze URL ' + url + ' failed with status ' + str(result.statusCode))
+		return previousHash, False
+	snapshotHash = feed.contentHash(result.content)
+	if snapshotHash != previousHash:
+		snapshotKey = ndb.Key(feedSnapshot, snapshotHash)
+		if snapshotKey.get() is None:
+			filename = gcsPath + 'snapshots/' + snapshotHash + '.json'
+			writeGeoJSON(result.content,filename)
+			feedSnapshot(key=snapshotKey,gcsFile=filename,size=len(result.content),fetchMillis=result.elapsedMillis,wireBytes=result.wireBytes).put()
+	#The validators are only kept once the snapshot is stored, so that a failed write is fetched again in full
+	feedFetchState(key=ndb.Key(feedFetchState, url),etag=result.etag,lastModified=result.lastModified,snapshotHash=snapshotHash).put()
+	return snapshotHash, snapshotHash != previousHash
+
+#Read a stored snapshot, parsing it at most once per instance. Returns the parsed snapshot and the
+#fetch that brought it in, as {'fetchMillis', 'wireBytes', 'payloadBytes'}.
+def loadSnapshot(snapshotHash,stats=None):
+	cached = _snapshotCache.get(snapshotHash)
+	if cached is not None:
+		return cached
+	snapshot = ndb.Key(feedSnapshot, snapshotHash).get()
+	if stats:
+		stats.add('datastoreRPCs')
+	if snapshot is None:
+		return None
+	if snapshot.parts:
+		#The feeds were fetched concurrently, so the merged snapshot took as long as its slowest feed
+		loaded = [loadSnapshot(part,stats) for part in snapshot.parts]
+		if None in loaded:
+			return None
+		data, duplicates = feed.mergeSnapshots([partData for partData, partInfo in loaded],feedTypes)
+		logging.info(json.dumps({"merged": snapshotHash, "parts": snapshot.parts, "duplicates": duplicates}))
+		fetchInfo = {'fetchMillis': max(partInfo['fetchMillis'] for partData, partInfo in loaded),
+			'wireBytes': sum(partInfo['wireBytes'] for partData, partInfo in loaded),
+			'payloadBytes': sum(partInfo['payloadBytes'] for partData, partInfo in loaded)}
+	else:
+		gcs_file = gcs.open(snapshot.gcsFile)
+		data = json.loads(gcs_file.read())
+		gcs_file.close()
+		fetchInfo = {'fetchMillis': snapshot.fetchMillis or 0, 'wireBytes': snapshot.wireBytes or 0, 'payloadBytes': snapshot.size or 0}
+	if len(_snapshotCache) >= _snapshotCacheSize:
+		_snapshotCache.clear()
+	_snapshotCache[snapshotHash] = (data, fetchInfo)
+	return data, fetchInfo
+
+#Grid index over a snapshot's items, built once per instance and shared by every case with a study area
+def snapshotIndex(snapshotHash,data):
+	index = _snapshotIndexes.get(snapshotHash)
+	if index is None:
+		if len(_snapshotIndexes) >= _snapshotCacheSize:
+			_snapshotIndexes.clear()
+		index = _snapshotIndexes[snapshotHash] = GridIndex(data,feedTypes,spatialIndexCellSize)
+	return index
+
+#Lease a case for an update, unless another update holds it. Returns the case, or None.
+@ndb.transactional
+def acquireCaseLease(caseKey,leaseID):
+	case = caseKey.get()
+	now = datetime.datetime.utcnow()
+	if case is None or (case.leaseUntil and case.leaseUntil > now and case.leaseID != leaseID):
+		return None
+	case.leaseID = leaseID
+	case.leaseUntil = now + datetime.timedelta(seconds=caseLeaseSeconds)
+	case.put()
+	return case
+
+#Release a case's lease, recording the snapshot it was updated from, the tick that scheduled it, and
+#how long that took, without overwriting other fields
+@ndb.transactional
+def finishCaseRun(caseKey,leaseID,snapshotHash=None,runMillis=None,scheduled=None):
+	case = caseKey.get()
+	if case is None:
+		return
+	if snapshotHash:
+		case.lastSnapshot = snapshotHash
+		case.lastScheduled = scheduled
+	if runMillis is not None:
+		case.runMillis = smoothedDuration(case.runMillis,runMillis)
+	if case.leaseID == leaseID:
+		case.leaseID = None
+		case.leaseUntil = None
+	case.put()
+
+#The 3 components of the Waze CCP JSON Response
+feedTypes = ['alerts', 'jams', 'irregularities']
+
+#For each Case, update each table from the shared feed snapshot through the pipeline in
+#waze/pipeline.py, then record the snapshot the case is now at and release its lease. Every run logs
+#one record of its counters and timings (see waze/stats.py), which are also summed up for the
+#runStats handler.
+def updateCase(case,snapshotHash,leaseID=None,scheduled=None):
+	stats = runstats.RunStats(case=case.uid,snapshot=snapshotHash)
+	snapshot = loadSnapshot(snapshotHash,stats)
+	if snapshot is None:
+		logging.error('Snapshot ' + snapshotHash + ' not found')
+		finishCaseRun(case.key,leaseID)
+		return
+	data, fetchInfo = snapshot
+	for name, value in fetchInfo.items():
+		stats.add(name,value)
+	#Cases with a study area only get the items inside it, looked up in the snapshot's grid index
+	area = Area(case.area) if case.area else None
+	index = snapshotIndex(snapshotHash,data) if area else None
+	pipeline.updateCase(case,data,area,index,stats)
+	stats.add('datastoreRPCs')
+	record = stats.record()
+	finishCaseRun(case.key,leaseID,snapshotHash,record['totalMillis'],scheduled)
+	stats.log(logging)
+	recordRunStats(record)
+
+#Add a run's counters to the totals kept in memcache across instances
+def recordRunStats(record):
+	memcache.Client().offset_multi(runstats.flatten(record),key_prefix='runStats:',initial_value=0)
+
+#App Request Handler reporting the counters of case updates summed across runs, and their average per run.
+#Add ?reset=1 to start counting again.
+class runStats(webapp2.RequestHandler):
+	def get(self):
+		names = runstats.counterNames(feedTypes)
+		if self.request.get("reset"):
+			memcache.delete_multi(names,key_prefix='runStats:')
+		totals = memcache.get_multi(names,key_prefix='runStats:')
+		self.response.headers['Content-Type'] = 'application/json'
+		self.response.write(json.dumps(runstats.summarize(totals),sort_keys=True))
+
+#Compiled extractors turning a feed item into its GeoJSON feature and BigQuery row in one pass
+extractors = {
+	'alerts': Extractor('alerts',alertsSchema),
+	'jams': Extractor('jams',jamsSchema),
+	'irregularities': Extractor('irregularities',irregularitiesSchema),
+}
+
+bqSchemas = {
+	'alerts': alertsSchema,
+	'jams': jamsSchema,
+	'irregularities': irregularitiesSchema,
+	'events': eventsSchema,
+}
+
+feedUniqueModels = {
+	'alerts': 'uniqueAlerts',
+	'jams': 'uniqueJams',
+	'irregularities': 'uniqueIrregularities',
+}
+
+#The timestamped GeoJSON of a case, feed type and poll
+def timestampedGeoJSONPath(uid,feedType,now):
+	return gcsPath  + uid + '/' + uid + '-' + now + '-' + feedType + '.geojson'
+
+#Datastore, GCS and BigQuery (and Carto), as the case pipeline writes to them
+class appEngineServices(object):
+	def loadFeedStates(self,uid,feedTypes,stats):
+		stats.add('datastoreRPCs')
+		states = ndb.get_multi([ndb.Key(caseFeedState, uid + ':' + feedType) for feedType in feedTypes])
+		shardKeys = []
+		for feedType, state in zip(feedTypes, states):
+			if state:
+				shardKeys += stateShardKeys(caseFingerprintShard,uid,feedType,state.fingerprintShards)
+				shardKeys += stateShardKeys(caseLifecycleShard,uid,feedType,state.lifecycleShards)
+		entities = {}
+		if shardKeys:
+			stats.add('datastoreRPCs')
+			entities = dict(zip(shardKeys, ndb.get_multi(shardKeys)))
+		loaded = []
+		for feedType, state in zip(feedTypes, states):
+			if state is None:
+				loaded.append(None)
+				continue
+			lifecycleKeys = stateShardKeys(caseLifecycleShard,uid,feedType,state.lifecycleShards)
+			loaded.append((fingerprintShards(state,uid,feedType,entities), [entities[key].lifecycles for key in lifecycleKeys if entities.get(key)]))
+		return loaded
+
+	#Shards left over from a time the state needed more of them are ignored, and overwritten
+	#once they are needed again
+	def saveFeedStates(self,uid,states,stats):
+		stats.add('datastoreRPCs')
+		entities = []
+		for feedType, (fingerprints, lifecycles) in states.items():
+			entities.append(caseFeedState(key=ndb.Key(caseFeedState, uid + ':' + feedType),fingerprints=None,
+				fingerprintShards=len(fingerprints),lifecycleShards=len(lifecycles or [])))
+			entities += [caseFingerprintShard(key=key,fingerprints=shard)
+				for key, shard in zip(stateShardKeys(caseFingerprintShard,uid,feedType,len(fingerprints)), fingerprints)]
+			entities += [caseLifecycleShard(key=key,lifecycles=shard)
+				for key, shard in zip(stateShardKeys(caseLifecycleShard,uid,feedType,len(lifecycles or [])), lifecycles or [])]
+		ndb.put_multi(entities)
+
+	def openGeoJSON(self,uid,feedType,now):
+		return openGeoJSON(timestampedGeoJSONPath(uid,feedType,now))
+
+	#Update the latest GeoJSON with a server-side copy of the timestamped one
+	def publishGeoJSON(self,uid,feedType,now):
+		gcs.copy2(timestampedGeoJSONPath(uid,feedType,now),gcsPath  + uid + '/' + uid + '-' + feedType + '.geojson',retry_params=writeRetryParams)
+
+	def filterUnique(self,feedType,uid,itemIDs,stats):
+		model, idField = uniqueModels[feedUniqueModels[feedType]]
+		return filterUnique(model,idField,uid,itemIDs,stats)
+
+	#Write new rows to BigQuery (and Carto), with the sinks running concurrently
+	def writeRows(self,feedType,uid,now,bqRows,ingestMode='stream',stats=None):
+		sinks = [lambda: writeBigQueryRows(feedType,uid,now,bqRows,ingestMode,stats)]
+		""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
+		sinks.append(lambda: writeCartoRows(feedType,uid,now,bqRows))
+		"""
+		runParallel(*sinks)
+
+	def writeTiles(self,feedType,uid,tiles,stats):
+		writeTiles(feedType,uid,tiles,stats)
+
+	def writeEvents(self,uid,now,rows,ingestMode='stream',stats=None):
+		createEventsTable(bigqueryClient(),uid)
+		writeBigQueryRows('events',uid,now,rows,ingestMode,stats)
+
+pipeline = CasePipeline(appEngineServices(),extractors,feedTypes,tileZooms,None if geometryEncoding == 'full' else coordinatePrecision,trackLifecycles,stateShardBytes)
+
+#Write the tiles whose content changed since the previous poll and delete the ones left empty
+def writeTiles(feedType,uid,tiles,stats=None):
+	stateKey = ndb.Key(caseTileState, uid + ':' + feedType)
+	state = stateKey.get()
+	changed, removed, hashes = changedTiles(tiles,state.hashes if state else None)
+	tilePath = gcsPath + uid + '/tiles/' + feedType + '/'
+	runBounded([lambda name=name, content=content: writeTile(tilePath + name + '.geojson',content) for name, content in changed]
+		+ [lambda name=name: deleteTile(tilePath + name + '.geojson') for name in removed],tileWriteConcurrency)
+	caseTileState(key=stateKey,hashes=hashes).put()
+	if stats:
+		stats.add('datastoreRPCs',2)
+		stats.add('tilesWritten',len(changed),feedType)
+	logging.info(json.dumps({'tiles': feedType, 'case': uid, 'total': len(hashes), 'written': len(changed), 'deleted': len(removed)}))
+
+#Write new rows to the case's BigQuery table: staged for the next load job in 'batch' mode, otherwise
+#streamed in size-bounded requests with retries of the rows that failed. Rows that still fail are kept
+#in GCS rather than lost.
+def writeBigQueryRows(feedType,uid,now,bqRows,ingestMode='stream',stats=None):
+	if sharedTables:
+		bqRows = [dict(row, **{caseIDField.name: str(uid)}) for row in bqRows]
+	if ingestMode == 'batch':
+		writeGeoJSON('\n'.join([json.dumps(row) for row in bqRows]),batchPath(uid,feedType) + now + '.json')
+		if stats:
+			stats.add('bigqueryRows',len(bqRows),feedType)
+		return
+	tableName = bqTableName(feedType,uid)
+	client = bigqueryClient()
+	tableRef = client.dataset(bqDataset).table(tableName)
+	table = bigquery.Table(tableRef,schema=bqTableSchema(feedType))
+	rowID = eventID if feedType == 'events' else extractors[feedType].dedupID
+	rowIDs = [str(uid) + ':' + rowID(row) for row in bqRows]
+	start = time.time()
+	failures = bqstream.streamRows(client,table,bqRows,rowIDs)
+	if stats:
+		stats.add('bigqueryMillis',int((time.time() - start) * 1000),feedType)
+		stats.add('bigqueryRows',len(bqRows) - len(failures),feedType)
+	logging.info('Streamed ' + str(len(bqRows) - len(failures)) + ' rows to ' + tableName)
+	if failures:
+		logging.warning(str(len(failures)) + ' rows failed to stream to ' + tableName + ': ' + repr(failures[0][1]))
+		writeGeoJSON('\n'.join([json.dumps(row) for row, errors in failures]),gcsPath + 'bq_errors/' + uid + '-' + now + '-' + feedType + '.json')
 
-	if cartoRows:
-		cartoQuery = "INSERT INTO " + irregularitiesTable + " " + cartoIrregularitiesFields + "VALUES " + ",".join(cartoRows)
-		cartoQuery = cartoQuery.replace("'None'","null").replace("None","null")
-		cartoQueryEncoded = urllib.urlencode({"q":cartoQuery})
-		# logging.info(cartoQuery)
-		# logging.info(cartoQueryEncoded)
+""" **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
+# Load Rows to Carto through the COPY API, as CSV in size-bounded requests. Chunks Carto refuses are kept in GCS.
+def writeCartoRows(feedType,uid,now,bqRows):
+	cartoTable = feedType + '_' + str(uid).replace('-','_')
+	sink = CopySink(cartoCopyURL,cartoAPIKey,cartoPost)
+	copied, failures = sink.copyRows(cartoTable,cartoColumns[feedType],bqRows)
+	logging.info('Copied ' + str(copied) + ' ' + feedType + ' rows to Carto')
+	for n, (body, status, content) in enumerate(failures):
+		logging.error('Carto COPY to ' + cartoTable + ' failed with ' + str(status) + ': ' + str(content))
+		writeSQLError(body,gcsPath + 'carto_errors/' + uid + '-' + now + '-' + feedType + '-' + str(n) + '.csv')
+
+#POST a request to Carto with urlfetch, returning (status code, content)
+def cartoPost(url,body,headers):
+	try:
+		result = urlfetch.fetch(url,payload=body,method=urlfetch.POST,headers=headers,validate_certificate=True,deadline=60)
+		return result.status_code, result.content
+	except urlfetch.Error as e:
+		logging.exception('Caught exception posting to Carto')
+		return None, str(e)
+"""
 
+#GCS folder holding the rows of a batch mode case that are waiting for a load job
+def batchPath(uid,feedType):
+	return gcsPath + uid + '/bq/' + feedType + '/'
 
-		url = cartoURLBase  + "&api_key=" + cartoAPIKey
-		# logging.info(url)
+#Called at the load interval set in cron.yaml, this function adds a task to load the
+#staged rows of each batch mode case into BigQuery
+class loadCaseStudies(webapp2.RequestHandler):
+	def get(self):
+		for case in caseModel.query(caseModel.ingestMode == 'batch'):
+			deferred.defer(loadCase,case.uid)
+
+#Load the staged rows of a case into its tables with one load job per feed type, then delete the
+#loaded files. The job id is derived from the files, so a retried task picks up the same job.
+def loadCase(uid):
+	client = bigqueryClient()
+	for feedType in feedTypes + (['events'] if trackLifecycles else []):
+		filenames = [stat.filename for stat in gcs.listbucket(batchPath(uid,feedType))][:loadJobMaxFiles]
+		if not filenames:
+			continue
+		tableName = bqTableName(feedType,uid)
+		jobID = 'load_' + tableName + '_' + hashlib.sha1(','.join(filenames)).hexdigest()[:16]
+		jobConfig = bigquery.LoadJobConfig()
+		jobConfig.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+		jobConfig.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+		jobConfig.schema = bqTableSchema(feedType)
 		try:
-			result = urlfetch.fetch(url, validate_certificate=True,method=urlfetch.POST,payload=cartoQueryEncoded)
-			if result.status_code == 200:
-				logging.info('Inserted Irregularities Data to Carto')
-			else:
-				logging.exception(result.status_code)
-				logging.exception(cartoQuery)
-				writeSQLError(cartoQuery,gcsPath + 'carto_errors/' + uid + '-' + now + '-irregularities.txt')
-		except urlfetch.Error:
-			logging.exception('Caught exception Inserting Data to Irregularities Table ' + irregularitiesTable)
-	"""
+			job = client.load_table_from_uri(['gs:/' + filename for filename in filenames],
+				client.dataset(bqDataset).table(tableName),job_id=jobID,job_config=jobConfig)
+		except Conflict:
+			job = client.get_job(jobID)
+		try:
+			job.result()
+		except Exception:
+			logging.exception('Load job ' + jobID + ' failed: ' + repr(job.errors))
+			continue
+		logging.info('Loaded ' + str(job.output_rows) + ' rows from ' + str(len(filenames)) + ' files into ' + tableName)
+		for filename in filenames:
+			gcs.delete(filename)
+
+#Compact every case's timestamped GeoJSONs of a day (by default yesterday, UTC) into daily archives
+class compactCaseStudies(webapp2.RequestHandler):
+	def get(self):
+		day = self.request.get("day") or (datetime.datetime.utcnow() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+		for case in caseModel.query():
+			for feedType in feedTypes:
+				deferred.defer(compactFeed,case.uid,day,feedType)
+
+#The daily archive of a case and feed type, see waze/columnar.py
+def archivePath(uid,day,feedType):
+	return gcsPath + uid + '/archive/' + uid + '-' + day + '-' + feedType + '.wzc'
+
+#The timestamped GeoJSONs a case wrote for a feed type on a day, as (timestamp, filename, size) in time order
+def dailySnapshotFiles(uid,day,feedType):
+	files = []
+	prefix = gcsPath + uid + '/' + uid + '-'
+	suffix = '-' + feedType + '.geojson'
+	for stat in gcs.listbucket(prefix):
+		timestamp = stat.filename[len(prefix):-len(suffix)]
+		if not stat.filename.endswith(suffix) or not timestamp.isdigit():
+			continue
+		if datetime.datetime.utcfromtimestamp(int(timestamp)).strftime("%Y-%m-%d") == day:
+			files.append((int(timestamp), stat.filename, stat.st_size))
+	return sorted(files)
+
+#Roll a day's timestamped GeoJSONs of one feed type into one compressed columnar archive, then
+#delete them. Snapshots already in an archive from an earlier, interrupted run are carried over.
+def compactFeed(uid,day,feedType):
+	files = dailySnapshotFiles(uid,day,feedType)
+	if not files:
+		return
+	filename = archivePath(uid,day,feedType)
+	previous = None
+	try:
+		previous = ArchiveReader(gcs.open(filename))
+	except gcs.NotFoundError:
+		pass
+	archive = ArchiveWriter(gcs.open(filename,
+		'w',
+		content_type='application/octet-stream',
+		retry_params=writeRetryParams))
+	#Snapshots are read into memory one at a time, as they are added to the archive
+	written = set()
+	if previous:
+		for timestamp, features in previous.readRange():
+			archive.addSnapshot(timestamp,features)
+			written.add(timestamp)
+		previous.close()
+	for timestamp, source, size in files:
+		if timestamp not in written:
+			archive.addSnapshot(timestamp,readGeoJSONFeatures(source))
+			written.add(timestamp)
+	archive.close()
+	for timestamp, source, size in files:
+		gcs.delete(source,retry_params=writeRetryParams)
+	logging.info(json.dumps({'compacted': feedType, 'case': uid, 'day': day, 'snapshots': len(written),
+		'sourceBytes': sum(size for timestamp, source, size in files), 'archiveBytes': archive.offset}))
+
+#Read the features of a GeoJSON in GCS
+def readGeoJSONFeatures(filename):
+	gcs_file = gcs.open(filename)
+	features = json.loads(gcs_file.read())['features']
+	gcs_file.close()
+	return features
+
 #Write the GeoJSON to GCS
 def writeGeoJSON(geoJSON,filename):
 	gcs_file = gcs.open(filename,
@@ -858,6 +1230,30 @@ def writeGeoJSON(geoJSON,filename):
 	gcs_file.write(geoJSON)
 	gcs_file.close()
 
+#Write one tile to GCS
+def writeTile(filename,content):
+	gcs_file = gcs.open(filename,
+	'w',
+	content_type='application/json',
+	retry_params=writeRetryParams)
+	gcs_file.write(content)
+	gcs_file.close()
+
+#Delete a tile that no longer holds any features
+def deleteTile(filename):
+	try:
+		gcs.delete(filename,retry_params=writeRetryParams)
+	except gcs.NotFoundError:
+		pass
+
+#Open a new GeoJSON in GCS that features can be written to one at a time
+def openGeoJSON(filename):
+	gcs_file = gcs.open(filename,
+	'w',
+	content_type='application/json',
+	retry_params=writeRetryParams)
+	return FeatureCollectionWriter(gcs_file,geometryEncoder(geometryEncoding,coordinatePrecision))
+
 """ **** Remove this line and the quotes here and at the bottom of this block to also use Carto ***
 def writeSQLError(sql,filename):
 	gcs_file = gcs.open(filename,
@@ -866,9 +1262,25 @@ def writeSQLError(sql,filename):
 	retry_params=writeRetryParams)
 	gcs_file.write(sql)
 	gcs_file.close()
+
+cartoFields = {
+	'alerts': cartoAlertsFields,
+	'jams': cartoJamsFields,
+	'irregularities': cartoIrregularitiesFields,
+}
+
+#The Carto columns of each feed type, in the order of cartoFields
+cartoColumns = dict((feedType, fields[1:-1].split(',')) for feedType, fields in cartoFields.items())
 """
 
 app = webapp2.WSGIApplication([
     ('/newCase/', newCase),
-    ('/{guid}/', updateCaseStudies)
+    ('/{guid}/', updateCaseStudies),
+    ('/{guid}/migrateUnique/', migrateUnique),
+    ('/{guid}/dedupStats/', dedupStats),
+    ('/{guid}/stats/', runStats),
+    ('/{guid}/purgeDedup/', purgeDedup),
+    ('/{guid}/purgeSnapshots/', purgeSnapshots),
+    ('/{guid}/load/', loadCaseStudies),
+    ('/{guid}/compact/', compactCaseStudies)
     ], debug=True)
\ No newline at end of file
@@ -0,0 +1,100 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#CopySink against the local stand-in of Carto's COPY API in benchmarks/standins.py.
+#Run from the repository root: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feedgen import generateFeed
+from benchmarks.standins import CartoStandIn, parseCopyCSV
+from waze import schemas, timeutil
+from waze.carto import CopySink, chunkCSV
+from waze.extract import Extractor
+
+columns = 'city,turntype,level,country,speedKMH,delay,length,street,ms,ts,endNode,type,id,speed,uuid,startNode,the_geom'.split(',')
+
+def jamRows(count):
+	extractor = Extractor('jams', schemas.jamsFields)
+	items, timestamps = timeutil.filterAndFormat(generateFeed(alerts=0, jams=count, irregularities=0, vertices=4)['jams'], extractor.timeFields, 0)
+	rows = [extractor.extract(item, itemTimestamps, True)[1] for item, itemTimestamps in zip(items, timestamps)]
+	#Values that need escaping, an empty string and a null
+	rows[0]['street'] = u'O\'Brien "Ave", Stra\u00dfe\nNorth'
+	rows[1]['street'] = u''
+	rows[2]['street'] = None
+	return rows
+
+class CopySinkTest(unittest.TestCase):
+	def testValuesArriveIntact(self):
+		rows = jamRows(50)
+		with CartoStandIn() as standIn:
+			copied, failures = CopySink(standIn.url, 'key').copyRows('jams_test', columns, rows)
+		self.assertEqual(copied, len(rows))
+		self.assertEqual(failures, [])
+		received = standIn.tables['jams_test']
+		self.assertEqual(len(received), len(rows))
+		for row, copy in zip(rows, received):
+			for column in columns:
+				if column == 'the_geom':
+					self.assertEqual(copy[column], 'SRID=4326;' + row['geoWKT'])
+				elif row.get(column) is None:
+					self.assertIsNone(copy[column])
+				else:
+					self.assertEqual(copy[column], u'%s' % (repr(row[column]) if isinstance(row[column], float) else row[column]))
+
+	def testChunksStayUnderTheLimit(self):
+		rows = jamRows(200)
+		maxBytes = 8 * 1024
+		chunks = list(chunkCSV(rows, columns, maxBytes))
+		self.assertTrue(len(chunks) > 1)
+		self.assertTrue(all(len(body) <= maxBytes for body, count in chunks))
+		self.assertEqual(sum(count for body, count in chunks), len(rows))
+		with CartoStandIn(maxBytes=maxBytes) as standIn:
+			copied, failures = CopySink(standIn.url, 'key', maxBytes=maxBytes).copyRows('jams_test', columns, rows)
+		self.assertEqual((copied, failures), (len(rows), []))
+		self.assertEqual(standIn.requests, len(chunks))
+		self.assertEqual([row['uuid'] for row in standIn.tables['jams_test']], [row['uuid'] for row in rows])
+
+	def testUnavailableChunksAreRetried(self):
+		rows = jamRows(20)
+		with CartoStandIn(failFirst=2) as standIn:
+			copied, failures = CopySink(standIn.url, 'key', backoff=0).copyRows('jams_test', columns, rows)
+		self.assertEqual((copied, failures), (len(rows), []))
+		self.assertEqual(standIn.requests, 3)
+		self.assertEqual(len(standIn.tables['jams_test']), len(rows))
+
+	def testFailedChunksAreReturned(self):
+		rows = jamRows(20)
+		with CartoStandIn(failFirst=5) as standIn:
+			copied, failures = CopySink(standIn.url, 'key', attempts=2, backoff=0).copyRows('jams_test', columns, rows)
+		self.assertEqual(copied, 0)
+		self.assertEqual(len(failures), 1)
+		body, status, content = failures[0]
+		self.assertEqual(status, 503)
+		self.assertEqual(len(parseCopyCSV(body.decode('utf-8'))), len(rows))
+
+	def testRefusedChunksAreNotRetried(self):
+		with CartoStandIn(maxBytes=10) as standIn:
+			copied, failures = CopySink(standIn.url, 'key', maxBytes=1024, backoff=0).copyRows('jams_test', columns, jamRows(5))
+		self.assertEqual(copied, 0)
+		self.assertTrue(failures)
+		self.assertEqual(set(status for body, status, content in failures), set([400]))
+		self.assertEqual(standIn.requests, len(failures))
+
+if __name__ == '__main__':
+	unittest.main()
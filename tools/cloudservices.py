@@ -0,0 +1,155 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#The services of waze.pipeline.CasePipeline for tools/daemon.py (Python 3), following what the App
+#Engine services in main.py do: rows are streamed to the case's BigQuery tables with
+#google-cloud-bigquery, the GeoJSONs and tiles written to Cloud Storage with google-cloud-storage,
+#and what the App Engine services keep in Datastore (feed states, tile hashes and the unique ids of
+#each case) is kept in a local SQLite file, so a restarted daemon carries on where it stopped.
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from waze import bqstream, schemas
+from waze.extract import feedSpecs
+from waze.geojson import FeatureCollectionWriter
+from waze.lifecycle import eventID
+from waze.tiles import changedTiles
+
+#File object uploading what is written to a Cloud Storage object once closed
+class StorageFile(object):
+	def __init__(self,blob):
+		self.blob = blob
+		self.parts = []
+
+	def write(self,data):
+		self.parts.append(data)
+
+	def close(self):
+		self.blob.upload_from_string(''.join(self.parts), content_type='application/json')
+
+#The state the App Engine services keep in Datastore, as JSON values in a SQLite file. Connections
+#are shared by the daemon's threads, so every call holds the lock.
+class SQLiteState(object):
+	def __init__(self,path):
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.lock = threading.Lock()
+		with self.lock, self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)')
+
+	def getMulti(self,keys):
+		with self.lock:
+			values = dict(self.connection.execute('SELECT key, value FROM state WHERE key IN (' + ','.join('?' * len(keys)) + ')', keys))
+		return [json.loads(values[key]) if key in values else None for key in keys]
+
+	def putMulti(self,entities):
+		with self.lock, self.connection:
+			self.connection.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)', [(key, json.dumps(value)) for key, value in entities.items()])
+
+	#Record keys in one transaction, returning the indexes of the ones that weren't recorded before
+	def addNew(self,keys):
+		newIndexes = []
+		with self.lock, self.connection:
+			for n, key in enumerate(keys):
+				if self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (key,)).rowcount:
+					newIndexes.append(n)
+		return newIndexes
+
+class CloudServices(object):
+	#gcsPath is 'bucket/folder/', like gcsPath in main.py without the leading '/'
+	def __init__(self,dataset,gcsPath,statePath,encoder=None):
+		from google.cloud import bigquery, storage
+		from google.cloud.exceptions import Conflict
+		self.bigquery = bigquery
+		self.Conflict = Conflict
+		self.client = bigquery.Client()
+		self.dataset = dataset
+		bucketName, self.prefix = (gcsPath.strip('/') + '/').split('/', 1)
+		self.bucket = storage.Client().bucket(bucketName)
+		self.state = SQLiteState(statePath)
+		self.encoder = encoder
+		self.tables = {}
+		self.tablesLock = threading.Lock()
+
+	#The case's table of a feed type (or 'events'), created the first time it is written to
+	def table(self,feedType,uid):
+		name = feedType + '_' + uid.replace('-', '_')
+		with self.tablesLock:
+			table = self.tables.get(name)
+			if table is None:
+				fields = schemas.eventsFields if feedType == 'events' else schemas.feedFields[feedType]
+				tableID = self.client.project + '.' + self.dataset + '.' + name
+				try:
+					table = self.client.create_table(self.bigquery.Table(tableID,
+						schema=[self.bigquery.SchemaField(fieldName, fieldType, mode='NULLABLE') for fieldName, fieldType in fields]))
+				except self.Conflict:
+					table = self.client.get_table(tableID)
+				self.tables[name] = table
+		return table
+
+	def loadFeedStates(self,uid,feedTypes,stats):
+		stats.add('datastoreRPCs')
+		return self.state.getMulti(['caseFeedState:' + uid + ':' + feedType for feedType in feedTypes])
+
+	def saveFeedStates(self,uid,states,stats):
+		stats.add('datastoreRPCs')
+		self.state.putMulti(dict(('caseFeedState:' + uid + ':' + feedType, state) for feedType, state in states.items()))
+
+	def _timestampedPath(self,uid,feedType,now):
+		return self.prefix + uid + '/' + uid + '-' + now + '-' + feedType + '.geojson'
+
+	def openGeoJSON(self,uid,feedType,now):
+		return FeatureCollectionWriter(StorageFile(self.bucket.blob(self._timestampedPath(uid, feedType, now))), self.encoder)
+
+	#Update the latest GeoJSON with a server-side copy of the timestamped one
+	def publishGeoJSON(self,uid,feedType,now):
+		self.bucket.copy_blob(self.bucket.blob(self._timestampedPath(uid, feedType, now)), self.bucket, self.prefix + uid + '/' + uid + '-' + feedType + '.geojson')
+
+	def filterUnique(self,feedType,uid,itemIDs,stats):
+		stats.add('datastoreRPCs')
+		return self.state.addNew(['unique:' + feedType + ':' + uid + ':' + itemID for itemID in itemIDs])
+
+	#Rows that still fail after the retries are kept in Cloud Storage rather than lost
+	def _streamRows(self,feedType,uid,now,rows,rowIDs,stats):
+		start = time.time()
+		failures = bqstream.streamRows(self.client, self.table(feedType, uid), rows, rowIDs)
+		stats.add('bigqueryMillis',int((time.time() - start) * 1000),feedType)
+		stats.add('bigqueryRows',len(rows) - len(failures),feedType)
+		if failures:
+			logging.warning('%d rows failed to stream to %s: %r', len(failures), feedType + '_' + uid, failures[0][1])
+			self.bucket.blob(self.prefix + 'bq_errors/' + uid + '-' + now + '-' + feedType + '.json').upload_from_string(
+				'\n'.join(json.dumps(row) for row, errors in failures), content_type='application/json')
+
+	#Rows are streamed whatever the case's ingestMode, the daemon has no load job schedule
+	def writeRows(self,feedType,uid,now,rows,ingestMode='stream',stats=None):
+		dedupID = feedSpecs[feedType]['dedupID']
+		self._streamRows(feedType,uid,now,rows,[uid + ':' + dedupID(row) for row in rows],stats)
+
+	def writeEvents(self,uid,now,rows,ingestMode='stream',stats=None):
+		self._streamRows('events',uid,now,rows,[uid + ':' + eventID(row) for row in rows],stats)
+
+	def writeTiles(self,feedType,uid,tiles,stats):
+		stats.add('datastoreRPCs',2)
+		key = 'caseTileState:' + uid + ':' + feedType
+		changed, removed, hashes = changedTiles(tiles, self.state.getMulti([key])[0])
+		for name, content in changed:
+			self.bucket.blob(self.prefix + uid + '/tiles/' + feedType + '/' + name + '.geojson').upload_from_string(content, content_type='application/json')
+		stats.add('tilesWritten',len(changed),feedType)
+		for name in removed:
+			self.bucket.blob(self.prefix + uid + '/tiles/' + feedType + '/' + name + '.geojson').delete()
+		self.state.putMulti({key: hashes})
@@ -0,0 +1,243 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Long-running ingestion service (Python 3), an alternative to cron.yaml calling /{guid}/ and one
+#deferred task per case. An asyncio scheduler polls the feed, and each new snapshot is fanned out
+#to every case through the same pipeline as main.py (waze/pipeline.py), at most --concurrency
+#cases at a time. Rows go to BigQuery --dataset, GeoJSONs and tiles to Cloud Storage --gcs-path, and
+#the feed states and unique ids to the SQLite file --state (see tools/cloudservices.py), unless
+#another services factory is given with --services module:name.
+#
+#The fetch validators and the snapshot each case was last updated from are checkpointed to a JSON
+#file after every case, so a restarted daemon skips what it already did. SIGINT or SIGTERM stops
+#polling, lets the case updates already running finish, saves the checkpoint and exits.
+#
+#Try it locally against a stand-in feed that changes every 30 seconds, writing to the in-memory
+#stand-ins of benchmarks/standins.py, which keep nothing across restarts:
+#  python3 tools/daemon.py --standin-feed 2000 --interval 10 --checkpoint /tmp/daemon.json
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import functools
+import importlib
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from waze import feed, schemas
+from waze.extract import Extractor
+from waze.pipeline import CasePipeline
+from waze.spatial import Area, GridIndex, parseArea
+from waze.stats import RunStats
+
+feedTypes = ['alerts', 'jams', 'irregularities']
+
+Case = collections.namedtuple('Case', 'uid name day ingestMode area')
+
+#Read cases from a JSON list of {"uid", "name", "day", "ingestMode", "bbox" or "polygon"}
+def loadCases(path):
+	with open(path) as casesFile:
+		entries = json.load(casesFile)
+	return [Case(entry['uid'], entry.get('name', ''), entry.get('day') or datetime.date.today().isoformat(),
+		entry.get('ingestMode', 'stream'), parseArea(entry.get('bbox'), entry.get('polygon'))) for entry in entries]
+
+#A services object from 'module:name', where name is a class or factory taking no arguments
+def makeServices(spec):
+	module, name = spec.split(':')
+	return getattr(importlib.import_module(module), name)()
+
+class IngestDaemon(object):
+	def __init__(self,url,cases,pipeline,checkpointPath,interval=60,concurrency=4,fetchTimeout=30,fetchAttempts=3,fetchBackoff=2):
+		self.url = url
+		self.cases = cases
+		self.pipeline = pipeline
+		self.checkpointPath = checkpointPath
+		self.interval = interval
+		self.concurrency = concurrency
+		self.fetchTimeout = fetchTimeout
+		self.fetchAttempts = fetchAttempts
+		self.fetchBackoff = fetchBackoff
+		self.checkpoint = self.loadCheckpoint()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.stopping = asyncio.Event()
+
+	def loadCheckpoint(self):
+		if self.checkpointPath and os.path.exists(self.checkpointPath):
+			with open(self.checkpointPath) as checkpointFile:
+				return json.load(checkpointFile)
+		return {'fetch': {}, 'cases': {}}
+
+	#Written to a temporary file first, so a crash never leaves half a checkpoint
+	def saveCheckpoint(self):
+		if not self.checkpointPath:
+			return
+		temporary = self.checkpointPath + '.tmp'
+		with open(temporary, 'w') as checkpointFile:
+			json.dump(self.checkpoint, checkpointFile)
+		os.replace(temporary, self.checkpointPath)
+
+	def stop(self):
+		if not self.stopping.is_set():
+			logging.info('Stopping once the running case updates finish')
+			self.stopping.set()
+
+	#One conditional, compressed fetch, run in the executor
+	def fetchOnce(self,etag,lastModified):
+		request = urllib.request.Request(self.url, headers=feed.requestHeaders(etag, lastModified))
+		start = time.time()
+		try:
+			response = urllib.request.urlopen(request, timeout=self.fetchTimeout)
+			status, content, headers = response.getcode(), response.read(), dict(response.headers)
+		except urllib.error.HTTPError as e:
+			status, content, headers = e.code, e.read(), dict(e.headers)
+		return status, content, headers, int((time.time() - start) * 1000)
+
+	#Fetch the feed with retries, returning a waze.feed.FetchResult
+	async def fetch(self):
+		loop = asyncio.get_event_loop()
+		state = self.checkpoint['fetch']
+		#A case left behind by a restart still needs the last snapshot, so the fetch can't be conditional
+		if any(self.checkpoint['cases'].get(case.uid) != state.get('snapshotHash') for case in self.cases):
+			state = {}
+		elapsed = 0
+		for attempt in range(1, self.fetchAttempts + 1):
+			if attempt > 1:
+				await asyncio.sleep(self.fetchBackoff * 2 ** (attempt - 2))
+			try:
+				status, content, headers, millis = await loop.run_in_executor(self.executor, self.fetchOnce, state.get('etag'), state.get('lastModified'))
+			except (OSError, urllib.error.URLError) as e:
+				logging.warning('Fetching the feed failed: %r, attempt %d', e, attempt)
+				continue
+			elapsed += millis
+			if status < 500:
+				return feed.fetchResult(status, content, headers, elapsed, attempt)
+			logging.warning('Feed returned %d, attempt %d', status, attempt)
+		return feed.FetchResult(None, None, None, None, elapsed, 0, self.fetchAttempts)
+
+	#Poll once and update every case that isn't at the new snapshot yet
+	async def tick(self):
+		result = await self.fetch()
+		logging.info(json.dumps({"feed": "fetch", "status": result.statusCode, "elapsedMillis": result.elapsedMillis,
+			"wireBytes": result.wireBytes, "bytes": len(result.content or b''), "attempts": result.attempts}))
+		if result.statusCode != 200:
+			return
+		snapshotHash = feed.contentHash(result.content)
+		self.checkpoint['fetch'] = {'etag': result.etag, 'lastModified': result.lastModified, 'snapshotHash': snapshotHash}
+		self.saveCheckpoint()
+		cases = [case for case in self.cases if self.checkpoint['cases'].get(case.uid) != snapshotHash]
+		if not cases:
+			return
+		data = json.loads(result.content.decode('utf-8'))
+		#The grid index is built once per snapshot and shared by every case with a study area
+		index = GridIndex(data, feedTypes) if any(case.area for case in cases) else None
+		fetchInfo = {'fetchMillis': result.elapsedMillis, 'wireBytes': result.wireBytes, 'payloadBytes': len(result.content)}
+		await asyncio.gather(*[self.updateCase(case, snapshotHash, data, index, fetchInfo) for case in cases])
+
+	async def updateCase(self,case,snapshotHash,data,index,fetchInfo):
+		async with self.semaphore:
+			if self.stopping.is_set():
+				return
+			stats = RunStats(case=case.uid, snapshot=snapshotHash)
+			for name, value in fetchInfo.items():
+				stats.add(name, value)
+			area = Area(case.area) if case.area else None
+			loop = asyncio.get_event_loop()
+			try:
+				await loop.run_in_executor(self.executor, functools.partial(self.pipeline.updateCase, case, data, area, index, stats))
+			except Exception:
+				logging.exception('Updating case %s failed', case.uid)
+				return
+			stats.log(logging)
+			self.checkpoint['cases'][case.uid] = snapshotHash
+			self.saveCheckpoint()
+
+	#Poll every interval until stopped; a tick that overruns the interval delays the next one
+	async def run(self):
+		while not self.stopping.is_set():
+			started = time.time()
+			try:
+				await self.tick()
+			except Exception:
+				logging.exception('Tick failed')
+			try:
+				await asyncio.wait_for(self.stopping.wait(), max(0, self.interval - (time.time() - started)))
+			except asyncio.TimeoutError:
+				pass
+		self.saveCheckpoint()
+		self.executor.shutdown(wait=True)
+
+def main():
+	parser = argparse.ArgumentParser(description='Poll the Waze CCP feed and update every case, without App Engine')
+	parser.add_argument('--url', help='Waze CCP feed URL')
+	parser.add_argument('--cases', help='JSON file listing the cases, by default one case covering the whole feed')
+	parser.add_argument('--dataset', help='BigQuery dataset of the case tables')
+	parser.add_argument('--gcs-path', help='bucket/folder/ the GeoJSONs and tiles are written to')
+	parser.add_argument('--state', default='daemon-state.sqlite', help='SQLite file keeping the feed states and unique ids')
+	parser.add_argument('--services', help='module:name of another services factory')
+	parser.add_argument('--checkpoint', default='daemon-checkpoint.json')
+	parser.add_argument('--interval', type=float, default=60, help='seconds between polls')
+	parser.add_argument('--concurrency', type=int, default=4, help='cases updated at the same time')
+	parser.add_argument('--tile-zooms', type=int, nargs='*', default=[])
+	parser.add_argument('--lifecycles', action='store_true', help='also track item lifecycles and write closed events')
+	parser.add_argument('--standin-feed', type=int, metavar='ITEMS', help='poll a local stand-in feed of this many alerts and jams')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+	cases = loadCases(args.cases) if args.cases else [Case('local', 'local', datetime.date.today().isoformat(), 'stream', None)]
+	extractors = dict((feedType, Extractor(feedType, schemas.feedFields[feedType])) for feedType in feedTypes)
+	if args.services:
+		services = makeServices(args.services)
+	elif args.dataset and args.gcs_path:
+		from tools.cloudservices import CloudServices
+		services = CloudServices(args.dataset, args.gcs_path, args.state)
+	elif args.standin_feed:
+		services = makeServices('benchmarks.standins:MemoryServices')
+	else:
+		parser.error('--dataset and --gcs-path, or --services, are required unless polling a --standin-feed')
+	pipeline = CasePipeline(services, extractors, feedTypes, args.tile_zooms, None, args.lifecycles)
+
+	standIn = None
+	url = args.url
+	if args.standin_feed:
+		from benchmarks.standins import WazeFeedStandIn
+		standIn = WazeFeedStandIn(alerts=args.standin_feed, jams=args.standin_feed, irregularities=max(1, args.standin_feed // 10), changeEvery=30).__enter__()
+		url = standIn.url
+	if not url:
+		parser.error('--url or --standin-feed is required')
+
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	daemon = IngestDaemon(url, cases, pipeline, args.checkpoint, args.interval, args.concurrency)
+	for signalNumber in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(signalNumber, daemon.stop)
+	try:
+		loop.run_until_complete(daemon.run())
+	finally:
+		loop.close()
+		if standIn:
+			standIn.__exit__()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,225 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Rebuild a case's BigQuery rows from its archived snapshots: the timestamped GeoJSONs and the
+#daily archives written by the compaction job. Snapshots are spread over a process pool and go
+#through the same extraction as the process* functions in main.py. Rows are deduplicated across
+#the whole replay, like the live pipeline does, and handed to a sink in bulk.
+#
+#It reads a local copy of the case's folder, e.g.
+#  gsutil -m rsync -r gs://{gcsPath}/{uid} /tmp/{uid}
+#  python tools/replay.py --case {uid} --source /tmp/{uid} --output /tmp/{uid}-rows
+#then load the newline-delimited JSON files with bq load, or use --sink bigquery to load them directly.
+#Snapshots written with geometryEncoding 'quantized' or 'polyline' give rows with the rounded coordinates.
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from waze import schemas, timeutil
+from waze.columnar import ArchiveReader
+from waze.extract import Extractor
+from waze.geometry import decodeFeature
+from waze.pipeline import extractRows
+
+feedTypes = ['alerts', 'jams', 'irregularities']
+
+#Every snapshot of a case in a local folder, as (timestamp, feed type, path, archived) tuples in time order
+def snapshotTasks(source,uid,feeds,start=None,end=None):
+	tasks = []
+	pattern = re.compile('^' + re.escape(uid) + r'-(\d+)-(\w+)\.geojson$')
+	for name in os.listdir(source):
+		match = pattern.match(name)
+		if match and match.group(2) in feeds:
+			tasks.append((int(match.group(1)), match.group(2), os.path.join(source, name), False))
+	archives = os.path.join(source, 'archive')
+	pattern = re.compile('^' + re.escape(uid) + r'-\d{4}-\d{2}-\d{2}-(\w+)\.wzc$')
+	if os.path.isdir(archives):
+		for name in os.listdir(archives):
+			match = pattern.match(name)
+			if match and match.group(1) in feeds:
+				path = os.path.join(archives, name)
+				reader = ArchiveReader(open(path, 'rb'))
+				tasks.extend((timestamp, match.group(1), path, True) for timestamp in reader.times)
+				reader.close()
+	tasks = [task for task in tasks if (start is None or task[0] >= start) and (end is None or task[0] <= end)]
+	#A snapshot both archived and still on its own (from an interrupted compaction) is only read once
+	seen = set()
+	unique = []
+	for task in sorted(tasks):
+		if task[:2] not in seen:
+			seen.add(task[:2])
+			unique.append(task)
+	return unique
+
+_extractors = {}
+
+#Runs in the pool: read one snapshot, rebuild its items and extract their rows
+def extractSnapshot(args):
+	(timestamp, feedType, path, archived), cutoffMillis = args
+	extractor = _extractors.get(feedType)
+	if extractor is None:
+		extractor = _extractors[feedType] = Extractor(feedType, schemas.feedFields[feedType])
+	if archived:
+		reader = ArchiveReader(open(path, 'rb'))
+		features = reader.readSnapshot(timestamp)
+		reader.close()
+	else:
+		with open(path) as geoJSON:
+			features = json.load(geoJSON)['features']
+	items = [extractor.item(decodeFeature(feature)) for feature in features]
+	ids, rows = extractRows(extractor, items, cutoffMillis)
+	return timestamp, feedType, ids, rows
+
+#Writes rows as newline-delimited JSON files of at most maxRows rows, ready for bq load
+class NDJSONSink(object):
+	def __init__(self,output,maxRows=100000,**options):
+		self.output = output
+		self.maxRows = maxRows
+		self.files = {}
+		self.counts = {}
+		self.paths = []
+		if not os.path.isdir(output):
+			os.makedirs(output)
+
+	def write(self,feedType,rows):
+		for row in rows:
+			fileobj = self.files.get(feedType)
+			if fileobj is None or self.counts[feedType] >= self.maxRows:
+				if fileobj is not None:
+					fileobj.close()
+				path = os.path.join(self.output, '%s-%05d.json' % (feedType, len([p for p in self.paths if p[0] == feedType])))
+				self.paths.append((feedType, path))
+				fileobj = self.files[feedType] = io.open(path, 'w', encoding='utf-8')
+				self.counts[feedType] = 0
+			fileobj.write(json.dumps(row, ensure_ascii=False) + u'\n')
+			self.counts[feedType] += 1
+
+	def close(self):
+		for fileobj in self.files.values():
+			fileobj.close()
+
+#Loads rows into BigQuery with one load job per batch of rows, into the case's tables
+#('<feed type>_<uid>') or, with --table-prefix, into '<prefix><feed type>'
+class BigQuerySink(object):
+	def __init__(self,dataset,uid,tablePrefix=None,maxRows=100000,**options):
+		from google.cloud import bigquery
+		self.bigquery = bigquery
+		self.client = bigquery.Client()
+		self.dataset = self.client.dataset(dataset)
+		self.uid = uid
+		self.tablePrefix = tablePrefix
+		self.maxRows = maxRows
+		self.pending = dict((feedType, []) for feedType in feedTypes)
+
+	def tableName(self,feedType):
+		if self.tablePrefix is not None:
+			return self.tablePrefix + feedType
+		return feedType + '_' + self.uid.replace('-', '_')
+
+	def flush(self,feedType):
+		rows = self.pending[feedType]
+		if not rows:
+			return
+		jobConfig = self.bigquery.LoadJobConfig()
+		jobConfig.source_format = self.bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+		jobConfig.write_disposition = self.bigquery.WriteDisposition.WRITE_APPEND
+		data = io.BytesIO(u''.join(json.dumps(row, ensure_ascii=False) + u'\n' for row in rows).encode('utf-8'))
+		job = self.client.load_table_from_file(data, self.dataset.table(self.tableName(feedType)), job_config=jobConfig)
+		job.result()
+		print('Loaded %d %s rows' % (len(rows), feedType))
+		self.pending[feedType] = []
+
+	def write(self,feedType,rows):
+		self.pending[feedType].extend(rows)
+		if len(self.pending[feedType]) >= self.maxRows:
+			self.flush(feedType)
+
+	def close(self):
+		for feedType in feedTypes:
+			self.flush(feedType)
+
+sinks = {
+	'ndjson': NDJSONSink,
+	'bigquery': BigQuerySink,
+}
+
+#A sink by name, or any class given as 'module:Class' taking the same keyword arguments
+def makeSink(name,**options):
+	if name in sinks:
+		return sinks[name](**options)
+	module, className = name.split(':')
+	return getattr(importlib.import_module(module), className)(**options)
+
+#Replay the snapshots through the pool and write the rows not seen before. Returns counters.
+def replay(tasks,sink,processes=None,cutoffMillis=0,caseID=None):
+	seen = dict((feedType, set()) for feedType in feedTypes)
+	stats = {'snapshots': 0, 'rows': 0, 'uniqueRows': 0}
+	pool = multiprocessing.Pool(processes)
+	try:
+		#Results come back in snapshot order, so the first snapshot holding an item is the one whose row is kept
+		for timestamp, feedType, ids, rows in pool.imap(extractSnapshot, [(task, cutoffMillis) for task in tasks], chunksize=4):
+			newRows = []
+			for dedupID, row in zip(ids, rows):
+				if dedupID not in seen[feedType]:
+					seen[feedType].add(dedupID)
+					if caseID is not None:
+						row[schemas.caseIDField[0]] = caseID
+					newRows.append(row)
+			sink.write(feedType, newRows)
+			stats['snapshots'] += 1
+			stats['rows'] += len(rows)
+			stats['uniqueRows'] += len(newRows)
+	finally:
+		pool.close()
+		pool.join()
+	sink.close()
+	return stats
+
+def main():
+	parser = argparse.ArgumentParser(description='Replay archived snapshots of a case into BigQuery rows')
+	parser.add_argument('--case', required=True, help='uid of the case')
+	parser.add_argument('--source', required=True, help='local copy of the case folder in GCS')
+	parser.add_argument('--feeds', nargs='+', default=feedTypes, choices=feedTypes)
+	parser.add_argument('--start', type=int, help='first snapshot time, in seconds since the epoch')
+	parser.add_argument('--end', type=int, help='last snapshot time, in seconds since the epoch')
+	parser.add_argument('--day', help='day the case was created (YYYY-MM-DD); older items are dropped as they were live')
+	parser.add_argument('--case-id', action='store_true', help='add the case_id column, for shared tables')
+	parser.add_argument('--processes', type=int, default=None)
+	parser.add_argument('--sink', default='ndjson', help="'ndjson', 'bigquery' or module:Class")
+	parser.add_argument('--output', default='replay', help='folder for the ndjson sink')
+	parser.add_argument('--dataset', help='BigQuery dataset for the bigquery sink')
+	parser.add_argument('--table-prefix', help='load into <prefix><feed type> instead of the case tables')
+	parser.add_argument('--max-rows', type=int, default=100000, help='rows per file or load job')
+	args = parser.parse_args()
+
+	start = time.time()
+	tasks = snapshotTasks(args.source, args.case, args.feeds, args.start, args.end)
+	sink = makeSink(args.sink, output=args.output, dataset=args.dataset, uid=args.case, tablePrefix=args.table_prefix, maxRows=args.max_rows)
+	stats = replay(tasks, sink, args.processes, timeutil.dayStartMillis(args.day) if args.day else 0, args.case if args.case_id else None)
+	stats['seconds'] = round(time.time() - start, 1)
+	print(json.dumps(stats))
+
+if __name__ == '__main__':
+	main()
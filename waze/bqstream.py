@@ -0,0 +1,77 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+import logging
+import time
+
+#Streaming insert limits. BigQuery accepts up to 10MB and 50,000 rows per request but recommends
+#about 500 rows, the byte limit leaves headroom for the request envelope.
+maxRowsPerRequest = 500
+maxBytesPerRequest = 9 * 1024 * 1024
+
+#insertAll error reasons worth sending again. 'stopped' marks valid rows that were rejected only
+#because another row of the same request was invalid.
+retryableReasons = frozenset(['stopped', 'backendError', 'internalError', 'timeout', 'rateLimitExceeded'])
+
+#Split rows into requests under both the row count and the (estimated) byte limits
+def chunkRows(rows,maxRows=maxRowsPerRequest,maxBytes=maxBytesPerRequest):
+	chunk = []
+	chunkBytes = 0
+	for n, row in enumerate(rows):
+		rowBytes = len(json.dumps(row, default=str)) + 64
+		if chunk and (len(chunk) >= maxRows or chunkBytes + rowBytes > maxBytes):
+			yield chunk
+			chunk = []
+			chunkBytes = 0
+		chunk.append(n)
+		chunkBytes += rowBytes
+	if chunk:
+		yield chunk
+
+def _retryable(errors):
+	return all(error.get('reason') in retryableReasons for error in errors)
+
+#Stream rows with client.insert_rows in size-bounded requests. rowIDs are sent as insertIds so a
+#retried row is not stored twice. Only the rows that failed with a retryable reason (or every row of
+#a request that raised) are sent again, with exponential backoff.
+#Returns a list of (row, errors) for the rows that could not be inserted.
+def streamRows(client,table,rows,rowIDs,maxAttempts=5,backoff=0.5,sleep=time.sleep):
+	failures = []
+	for chunk in chunkRows(rows):
+		pending = chunk
+		for attempt in range(maxAttempts):
+			if attempt:
+				sleep(backoff * 2 ** (attempt - 1))
+			try:
+				errors = client.insert_rows(table, [rows[n] for n in pending], row_ids=[rowIDs[n] for n in pending])
+			except Exception as e:
+				logging.warning('insert_rows raised ' + repr(e) + ', attempt ' + str(attempt + 1))
+				lastErrors = dict((n, [{'reason': 'exception', 'message': repr(e)}]) for n in pending)
+				continue
+			retry = []
+			lastErrors = {}
+			for error in errors:
+				n = pending[error['index']]
+				if _retryable(error.get('errors', [])):
+					retry.append(n)
+					lastErrors[n] = error.get('errors')
+				else:
+					failures.append((rows[n], error.get('errors')))
+			pending = retry
+			if not pending:
+				break
+		else:
+			failures.extend((rows[n], lastErrors[n]) for n in pending)
+	return failures
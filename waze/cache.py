@@ -0,0 +1,61 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import collections
+import threading
+import time
+
+#Bounded in-memory cache of keys with least-recently-used eviction and a per-entry time to live.
+#Counts hits and misses so the size can be tuned from the logs.
+class LRUCache(object):
+	def __init__(self,maxSize,ttl,clock=time.time):
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.clock = clock
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	#Return True if key was added within the last ttl seconds, refreshing its recency
+	def contains(self,key):
+		with self._lock:
+			expires = self._entries.pop(key, None)
+			if expires is None or expires < self.clock():
+				self.misses += 1
+				return False
+			self._entries[key] = expires
+			self.hits += 1
+			return True
+
+	def add(self,key):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = self.clock() + self.ttl
+			while len(self._entries) > self.maxSize:
+				self._entries.popitem(last=False)
+
+	def addMany(self,keys):
+		for key in keys:
+			self.add(key)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		return {"size": len(self._entries), "maxSize": self.maxSize, "hits": self.hits, "misses": self.misses}
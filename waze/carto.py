@@ -0,0 +1,136 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+import time
+
+try:
+	from urllib import urlencode
+	from urllib2 import Request, urlopen, HTTPError, URLError
+except ImportError:
+	from urllib.parse import urlencode
+	from urllib.request import Request, urlopen
+	from urllib.error import HTTPError, URLError
+
+#Bulk loading of rows to Carto through its COPY API (/api/v2/sql/copyfrom), sending them as CSV
+#in requests of bounded size instead of one INSERT statement per poll.
+#The HTTP call is passed in, so the same code runs with urlfetch on App Engine, with urllib
+#elsewhere, or against a local stand-in.
+
+maxBytesPerRequest = 4 * 1024 * 1024
+#Tries per chunk, and seconds to wait before the second one (doubled for each one after that)
+attemptsPerChunk = 3
+retryBackoff = 1
+
+try:
+	textType = unicode
+except NameError:
+	textType = str
+
+#Format one value for PostgreSQL's CSV COPY format. Unquoted empty fields are read as null, so
+#strings are always quoted, which keeps empty strings apart from nulls.
+def csvValue(value):
+	if value is None:
+		return u''
+	if isinstance(value, bool):
+		return u'true' if value else u'false'
+	if isinstance(value, (dict, list)):
+		value = json.dumps(value)
+	elif not isinstance(value, textType):
+		if isinstance(value, bytes):
+			value = value.decode('utf-8')
+		else:
+			return textType(repr(value) if isinstance(value, float) else value)
+	return u'"' + value.replace(u'"', u'""') + u'"'
+
+#Format one BigQuery row as a CSV line, with the_geom taken from the row's geoWKT as EWKT
+def csvRow(row,columns):
+	values = []
+	for column in columns:
+		if column == 'the_geom':
+			values.append(csvValue('SRID=4326;' + row['geoWKT'] if row.get('geoWKT') else None))
+		else:
+			values.append(csvValue(row.get(column)))
+	return u','.join(values) + u'\n'
+
+#Split rows into UTF-8 CSV bodies of at most maxBytes each (a single longer row gets its own body).
+#Yields (body, number of rows).
+def chunkCSV(rows,columns,maxBytes=maxBytesPerRequest):
+	lines = []
+	size = 0
+	for row in rows:
+		line = csvRow(row, columns).encode('utf-8')
+		if lines and size + len(line) > maxBytes:
+			yield b''.join(lines), len(lines)
+			lines = []
+			size = 0
+		lines.append(line)
+		size += len(line)
+	if lines:
+		yield b''.join(lines), len(lines)
+
+def copyStatement(table,columns):
+	return 'COPY ' + table + ' (' + ','.join(columns) + ') FROM STDIN WITH (FORMAT csv)'
+
+#POST with urllib, for running outside App Engine. Returns (status code, content), with a None
+#status code when the request didn't get a response.
+def urllibPost(url,body,headers):
+	try:
+		response = urlopen(Request(url, data=body, headers=headers))
+		return response.getcode(), response.read()
+	except HTTPError as e:
+		return e.code, e.read()
+	except URLError as e:
+		return None, str(e)
+
+#Copies rows into Carto tables. post(url, body, headers) makes the request and returns
+#(status code, content), the status code being None when there was no response. Chunks that get
+#no response or a 5xx are tried again, up to attempts times.
+class CopySink(object):
+	def __init__(self,copyURL,apiKey,post=urllibPost,maxBytes=maxBytesPerRequest,attempts=attemptsPerChunk,backoff=retryBackoff):
+		self.copyURL = copyURL
+		self.apiKey = apiKey
+		self.post = post
+		self.maxBytes = maxBytes
+		self.attempts = attempts
+		self.backoff = backoff
+
+	def copyURLFor(self,table,columns):
+		return self.copyURL + '?' + urlencode({'q': copyStatement(table, columns), 'api_key': self.apiKey})
+
+	#Send the rows in size-bounded chunks. Returns the number of rows Carto reported as copied, and
+	#the (CSV body, status code, content) of every chunk that failed, so the caller can keep them.
+	def copyRows(self,table,columns,rows):
+		url = self.copyURLFor(table, columns)
+		copied = 0
+		failures = []
+		for body, count in chunkCSV(rows, columns, self.maxBytes):
+			status, content = self.postChunk(url, body)
+			if status == 200:
+				try:
+					copied += json.loads(content)['total_rows']
+				except (ValueError, KeyError, TypeError):
+					copied += count
+			else:
+				failures.append((body, status, content))
+		return copied, failures
+
+	def postChunk(self,url,body):
+		for attempt in range(1, self.attempts + 1):
+			if attempt > 1:
+				time.sleep(self.backoff * 2 ** (attempt - 2))
+			status, content = self.post(url, body, {'Content-Type': 'text/csv; charset=utf-8'})
+			if status is not None and status < 500:
+				break
+		return status, content
@@ -0,0 +1,148 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+import struct
+import zlib
+
+#Compressed, column-oriented daily archives of GeoJSON snapshots.
+#
+#A file holds a series of snapshots, each stored as one zlib-compressed JSON array per column:
+#every feature property, plus the geometry type and coordinates. The end of the file holds a JSON
+#index giving, for each snapshot, its timestamp, feature count and the offset and length of each
+#column, followed by the index length and the magic number. A reader can then seek straight to
+#the columns of the snapshots it needs without decompressing the rest of the day.
+#
+#Properties a feature doesn't have are read back as null.
+
+magic = b'WZC1'
+trailerFormat = '>Q4s'
+trailerSize = struct.calcsize(trailerFormat)
+geometryTypeColumn = 'geometry.type'
+geometryCoordinatesColumn = 'geometry.coordinates'
+
+def _encode(value):
+	return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), 6)
+
+def _decode(data):
+	return json.loads(zlib.decompress(data).decode('utf-8'))
+
+#Turn a snapshot's features into columns
+def featureColumns(features):
+	names = []
+	seen = set()
+	for feature in features:
+		for name in feature.get('properties') or {}:
+			if name not in seen:
+				seen.add(name)
+				names.append(name)
+	columns = dict((name, []) for name in names)
+	types = []
+	coordinates = []
+	for feature in features:
+		properties = feature.get('properties') or {}
+		for name in names:
+			columns[name].append(properties.get(name))
+		geometry = feature.get('geometry')
+		types.append(geometry.get('type') if geometry else None)
+		coordinates.append(geometry.get('coordinates') if geometry else None)
+	columns[geometryTypeColumn] = types
+	columns[geometryCoordinatesColumn] = coordinates
+	return columns
+
+#Turn columns back into features
+def columnFeatures(columns,count):
+	names = [name for name in columns if name not in (geometryTypeColumn, geometryCoordinatesColumn)]
+	types = columns.get(geometryTypeColumn) or [None] * count
+	coordinates = columns.get(geometryCoordinatesColumn) or [None] * count
+	features = []
+	for n in range(count):
+		geometry = {"type": types[n], "coordinates": coordinates[n]} if types[n] else None
+		features.append({"type": "Feature", "properties": dict((name, columns[name][n]) for name in names), "geometry": geometry})
+	return features
+
+#Writes snapshots one at a time to a file object opened for writing, holding only one in memory
+class ArchiveWriter(object):
+	def __init__(self,fileobj):
+		self.fileobj = fileobj
+		self.snapshots = []
+		self.offset = 0
+		self._write(magic)
+
+	def _write(self,data):
+		self.fileobj.write(data)
+		self.offset += len(data)
+
+	def addSnapshot(self,timestamp,features):
+		entry = {"time": timestamp, "count": len(features), "columns": {}}
+		for name, values in featureColumns(features).items():
+			data = _encode(values)
+			entry["columns"][name] = [self.offset, len(data)]
+			self._write(data)
+		self.snapshots.append(entry)
+
+	#Write the index and trailer, then close the file
+	def close(self):
+		index = json.dumps({"snapshots": self.snapshots}, separators=(',', ':')).encode('utf-8')
+		self._write(index)
+		self._write(struct.pack(trailerFormat, len(index), magic))
+		self.fileobj.close()
+
+#Reads snapshots from a file object that supports seek and read, such as a local file opened in
+#binary mode or a cloudstorage file opened for reading
+class ArchiveReader(object):
+	def __init__(self,fileobj):
+		self.fileobj = fileobj
+		fileobj.seek(0, 2)
+		size = fileobj.tell()
+		fileobj.seek(size - trailerSize)
+		indexLength, trailerMagic = struct.unpack(trailerFormat, fileobj.read(trailerSize))
+		if trailerMagic != magic:
+			raise ValueError('Not a snapshot archive')
+		fileobj.seek(size - trailerSize - indexLength)
+		self.snapshots = json.loads(fileobj.read(indexLength).decode('utf-8'))["snapshots"]
+		self.times = [entry["time"] for entry in self.snapshots]
+
+	def _entry(self,timestamp):
+		for entry in self.snapshots:
+			if entry["time"] == timestamp:
+				return entry
+		raise KeyError(timestamp)
+
+	def _readColumns(self,entry,names=None):
+		columns = {}
+		for name, (offset, length) in entry["columns"].items():
+			if names is not None and name not in names:
+				continue
+			self.fileobj.seek(offset)
+			columns[name] = _decode(self.fileobj.read(length))
+		return columns
+
+	#Only the named columns of one snapshot, e.g. ['uuid', 'geometry.coordinates']
+	def readColumns(self,timestamp,names=None):
+		return self._readColumns(self._entry(timestamp), names)
+
+	#The features of one snapshot
+	def readSnapshot(self,timestamp):
+		entry = self._entry(timestamp)
+		return columnFeatures(self._readColumns(entry), entry["count"])
+
+	#(timestamp, features) for each snapshot taken between start and end, inclusive
+	def readRange(self,start=None,end=None):
+		for entry in self.snapshots:
+			if (start is None or entry["time"] >= start) and (end is None or entry["time"] <= end):
+				yield entry["time"], columnFeatures(self._readColumns(entry), entry["count"])
+
+	def close(self):
+		self.fileobj.close()
@@ -0,0 +1,58 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import collections
+import hashlib
+import json
+
+#How each feed type identifies an item across polls
+itemKeys = {
+	'alerts': lambda item: item.get('uuid'),
+	'jams': lambda item: item.get('uuid'),
+	'irregularities': lambda item: None if item.get('id') is None else str(item.get('id')),
+}
+
+#added, changed and unchanged hold feed items, removed holds the keys of items that left the feed,
+#and state maps every current item key to its fingerprint, to be compared against on the next poll.
+Delta = collections.namedtuple('Delta', ['added', 'changed', 'unchanged', 'removed', 'state'])
+
+#Short fingerprint of a feed item, stable across polls while none of its fields change
+def fingerprint(item):
+	return hashlib.md5(json.dumps(item, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:12]
+
+#Classify the items of a new snapshot against the fingerprints kept from the previous one.
+#Items without a key can't be matched across polls and are always treated as added.
+def computeDelta(previous,items,feedType):
+	keyFunc = itemKeys[feedType]
+	previous = previous or {}
+	state = {}
+	added = []
+	changed = []
+	unchanged = []
+	for item in items:
+		key = keyFunc(item)
+		itemFingerprint = fingerprint(item)
+		if key is None:
+			added.append(item)
+			continue
+		state[key] = itemFingerprint
+		previousFingerprint = previous.get(key)
+		if previousFingerprint is None:
+			added.append(item)
+		elif previousFingerprint != itemFingerprint:
+			changed.append(item)
+		else:
+			unchanged.append(item)
+	removed = [key for key in previous if key not in state]
+	return Delta(added, changed, unchanged, removed, state)
@@ -0,0 +1,173 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import re
+
+from waze import timeutil
+
+#Schema-driven extraction of Waze CCP feed items.
+#For each feed type an extract function is generated once from the BigQuery schema, reading every
+#field of an item a single time and returning its GeoJSON feature and, when asked, its BigQuery row.
+#Both outputs are built straight from the same local variables, so no intermediate dicts are copied.
+
+#How BigQuery columns are read from a feed item when they aren't the item field of the same name.
+#'timestamps[n]' refers to the formatted value of the n-th entry of timeFields.
+#Columns of type GEOGRAPHY, and geoWKT, always hold the WKT of the item's geometry.
+#properties renames columns in the GeoJSON output, extraProperties are only written to GeoJSON.
+#bucketColumn holds the publication time that puts an item's dedup state in a day bucket; it doesn't
+#change while the item is in the feed, so every poll looks the item up in the same bucket.
+feedSpecs = {
+	'alerts': {
+		'geometry': 'Point',
+		'timeFields': ['pubMillis'],
+		'sources': {
+			'ms': "get('pubMillis')",
+			'ts': "timestamps[0]",
+		},
+		'properties': {'ms': 'pubMillis', 'ts': 'timestamp'},
+		'extraProperties': {},
+		'dedupID': lambda row: str(row['uuid']),
+		'bucketColumn': 'ms',
+	},
+	'jams': {
+		'geometry': 'LineString',
+		'timeFields': ['pubMillis'],
+		'sources': {
+			'turntype': "get('turnType')",
+			'ms': "get('pubMillis')",
+			'ts': "timestamps[0]",
+		},
+		'properties': {'turntype': 'turnType', 'ms': 'pubMillis', 'ts': 'timestamp'},
+		'extraProperties': {'segments': "get('segments')", 'roadType': "get('roadType')"},
+		'dedupID': lambda row: str(row['uuid']),
+		'bucketColumn': 'ms',
+	},
+	'irregularities': {
+		'geometry': 'LineString',
+		'timeFields': ['detectionDateMillis', 'updateDateMillis'],
+		'sources': {
+			'detectionDateMS': "get('detectionDateMillis')",
+			'detectionDateTS': "timestamps[0]",
+			'updateDateMS': "get('updateDateMillis')",
+			'updateDateTS': "timestamps[1]",
+			'causeAlertUUID': "(get('causeAlert') or {}).get('uuid')",
+		},
+		'properties': {},
+		'extraProperties': {},
+		'dedupID': lambda row: str(row['id']) + str(row['updateDateMS']),
+		'bucketColumn': 'detectionDateMS',
+	},
+}
+
+geometryColumns = ('geo', 'geoWKT')
+
+def pointCoordinates(location):
+	location = location or {}
+	return [location.get('x'), location.get('y')]
+
+def lineCoordinates(line):
+	return [[vertex.get('x'), vertex.get('y')] for vertex in line or []]
+
+def pointWKT(coordinates):
+	return 'Point(' + str(coordinates[0]) + ' ' + str(coordinates[1]) + ')'
+
+def lineWKT(coordinates):
+	return 'LineString(' + ', '.join([str(x) + ' ' + str(y) for x, y in coordinates]) + ')'
+
+geometryReaders = {
+	'Point': ("pointCoordinates(get('location'))", 'pointWKT'),
+	'LineString': ("lineCoordinates(get('line'))", 'lineWKT'),
+}
+
+#Extractor for one feed type. extract(item, timestamps, withRow) returns (feature, row), where
+#row is None unless withRow is set; dedupID(row) gives the id used to skip items already written,
+#and dedupKey(row) the same id prefixed with its day bucket, as 'YYYYMMDD:<id>'.
+class Extractor(object):
+	def __init__(self,feedType,schema):
+		spec = feedSpecs[feedType]
+		self.feedType = feedType
+		self.timeFields = spec['timeFields']
+		self.dedupID = spec['dedupID']
+		self.bucketColumn = spec['bucketColumn']
+		self.columns = [field.name if hasattr(field, 'name') else field[0] for field in schema]
+		self.source = self._generate(spec)
+		namespace = {
+			'pointCoordinates': pointCoordinates,
+			'lineCoordinates': lineCoordinates,
+			'pointWKT': pointWKT,
+			'lineWKT': lineWKT,
+		}
+		exec(compile(self.source, '<' + feedType + ' extractor>', 'exec'), namespace)
+		self.extract = namespace['extract']
+		self.itemFields = self._itemFields(spec)
+
+	def dedupKey(self,row):
+		return timeutil.dayBucket(row.get(self.bucketColumn)) + ':' + self.dedupID(row)
+
+	#Where each feature property came from in the feed item, as (property, item field, nested field),
+	#for the properties that were copied from an item field. Used to rebuild items from GeoJSON.
+	def _itemFields(self,spec):
+		sources = [(spec['properties'].get(column, column), spec['sources'].get(column, 'get(' + repr(column) + ')'))
+			for column in self.columns if column not in geometryColumns]
+		sources += sorted(spec['extraProperties'].items())
+		fields = []
+		for name, source in sources:
+			match = re.match(r"^get\('(\w+)'\)$", source) or re.match(r"^\(get\('(\w+)'\) or \{\}\)\.get\('(\w+)'\)$", source)
+			if match:
+				fields.append((name, match.group(1), match.group(2) if match.lastindex > 1 else None))
+		return fields
+
+	#Rebuild the feed item a GeoJSON feature was extracted from, so archived snapshots can go through
+	#extract() again. Fields that aren't kept in the GeoJSON are left out.
+	def item(self,feature):
+		properties = feature.get('properties') or {}
+		item = {}
+		for name, field, nested in self.itemFields:
+			value = properties.get(name)
+			if value is None:
+				continue
+			if nested:
+				item.setdefault(field, {})[nested] = value
+			else:
+				item[field] = value
+		geometry = feature.get('geometry') or {}
+		coordinates = geometry.get('coordinates')
+		if geometry.get('type') == 'Point' and coordinates:
+			item['location'] = {'x': coordinates[0], 'y': coordinates[1]}
+		elif geometry.get('type') == 'LineString' and coordinates:
+			item['line'] = [{'x': x, 'y': y} for x, y in coordinates]
+		return item
+
+	#Build the source of the extract function: one local per column, then both outputs as dict literals
+	def _generate(self,spec):
+		coordinatesSource, wktFunction = geometryReaders[spec['geometry']]
+		valueColumns = [column for column in self.columns if column not in geometryColumns]
+		variables = dict((column, 'c' + str(n)) for n, column in enumerate(valueColumns))
+		lines = [
+			'def extract(item, timestamps, withRow):',
+			'\tget = item.get',
+		]
+		for column in valueColumns:
+			lines.append('\t' + variables[column] + ' = ' + spec['sources'].get(column, 'get(' + repr(column) + ')'))
+		lines.append('\tcoordinates = ' + coordinatesSource)
+		properties = [repr(spec['properties'].get(column, column)) + ': ' + variables[column] for column in valueColumns]
+		properties += [repr(name) + ': ' + source for name, source in sorted(spec['extraProperties'].items())]
+		lines.append('\tfeature = {"type": "Feature", "properties": {' + ', '.join(properties) + '}, '
+			+ '"geometry": {"type": ' + repr(spec['geometry']) + ', "coordinates": coordinates}}')
+		lines.append('\tif not withRow:')
+		lines.append('\t\treturn feature, None')
+		lines.append('\twkt = ' + wktFunction + '(coordinates)')
+		row = [repr(column) + ': ' + (variables[column] if column in variables else 'wkt') for column in self.columns]
+		lines.append('\treturn feature, {' + ', '.join(row) + '}')
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,98 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import collections
+import gzip
+import hashlib
+import io
+import zlib
+
+from waze.delta import itemKeys
+
+#Outcome of fetching a Waze CCP feed. statusCode is None when every attempt failed, content holds
+#the decompressed payload bytes (None unless the feed returned 200), wireBytes is what was transferred.
+FetchResult = collections.namedtuple('FetchResult', ['statusCode', 'content', 'etag', 'lastModified', 'elapsedMillis', 'wireBytes', 'attempts'])
+
+#Headers asking for a compressed response, and for no body at all if the feed hasn't changed
+#since the validators returned by the previous fetch
+def requestHeaders(etag=None,lastModified=None):
+	headers = {'Accept-Encoding': 'gzip'}
+	if etag:
+		headers['If-None-Match'] = etag
+	if lastModified:
+		headers['If-Modified-Since'] = lastModified
+	return headers
+
+def _header(headers,name):
+	for key in headers:
+		if key.lower() == name.lower():
+			return headers[key]
+	return None
+
+#Decompress a response body. Some HTTP clients decompress on their own and keep the
+#Content-Encoding header, so the gzip magic number is checked as well.
+def decodeBody(content,headers):
+	encoding = (_header(headers, 'Content-Encoding') or '').lower()
+	if content[:2] == b'\x1f\x8b':
+		return gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+	if encoding == 'deflate':
+		try:
+			return zlib.decompress(content)
+		except zlib.error:
+			return zlib.decompress(content, -zlib.MAX_WBITS)
+	return content
+
+#Build the FetchResult of a completed HTTP response
+def fetchResult(statusCode,content,headers,elapsedMillis,attempts):
+	return FetchResult(
+		statusCode=statusCode,
+		content=decodeBody(content, headers) if statusCode == 200 else None,
+		etag=_header(headers, 'ETag'),
+		lastModified=_header(headers, 'Last-Modified'),
+		elapsedMillis=elapsedMillis,
+		wireBytes=len(content or b''),
+		attempts=attempts)
+
+#Content hash identifying a feed payload
+def contentHash(content):
+	return hashlib.sha1(content).hexdigest()
+
+#Merge the parsed snapshots of several feeds into one. Feeds of neighbouring areas overlap at their
+#borders, so an item found in more than one of them is kept once, from the first snapshot it is in.
+#Items without a key are all kept. The merged snapshot spans the time of all of its parts.
+#Returns the merged snapshot and the number of items dropped as duplicates.
+def mergeSnapshots(snapshots,feedTypes):
+	merged = {}
+	duplicates = 0
+	for feedType in feedTypes:
+		parts = [snapshot[feedType] for snapshot in snapshots if snapshot.get(feedType) is not None]
+		if not parts:
+			continue
+		keyFunc = itemKeys[feedType]
+		seen = set()
+		items = merged[feedType] = []
+		for part in parts:
+			for item in part:
+				key = keyFunc(item)
+				if key is not None:
+					if key in seen:
+						duplicates += 1
+						continue
+					seen.add(key)
+				items.append(item)
+	for field, function in (('startTimeMillis', min), ('endTimeMillis', max)):
+		values = [snapshot[field] for snapshot in snapshots if snapshot.get(field) is not None]
+		if values:
+			merged[field] = function(values)
+	return merged, duplicates
@@ -0,0 +1,41 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+
+#Writes a GeoJSON FeatureCollection to a file object one feature at a time, so the
+#collection is never held in memory as a whole. encoder, if given, rewrites each feature's
+#geometry before it is written (see waze.geometry.geometryEncoder).
+class FeatureCollectionWriter(object):
+	def __init__(self,fileobj,encoder=None):
+		self.fileobj = fileobj
+		self.encoder = encoder
+		self.count = 0
+		self.bytesWritten = 0
+		self._write('{"type":"FeatureCollection","features":[')
+
+	def _write(self,data):
+		self.fileobj.write(data)
+		self.bytesWritten += len(data)
+
+	def write(self,feature):
+		if self.encoder is not None:
+			feature = self.encoder(feature)
+		data = json.dumps(feature, separators=(',', ':'))
+		self._write(data if self.count == 0 else ',' + data)
+		self.count += 1
+
+	def close(self):
+		self._write(']}')
+		self.fileobj.close()
@@ -0,0 +1,94 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Compact geometry encodings for the GeoJSON written to GCS.
+#'full' keeps the coordinates as they come in the feed. 'quantized' rounds them to a number of
+#decimals (5 is about 1 meter). 'polyline' replaces line geometries with an encoded polyline string
+#(the Google polyline algorithm) in the feature's properties, and quantizes points.
+#All three produce valid GeoJSON.
+encodings = ('full', 'quantized', 'polyline')
+
+def quantizeCoordinates(coordinates,precision):
+	if coordinates and isinstance(coordinates[0], list):
+		return [[round(x, precision), round(y, precision)] for x, y in coordinates]
+	return [None if value is None else round(value, precision) for value in coordinates]
+
+def _encodeValue(value,output):
+	value = ~(value << 1) if value < 0 else value << 1
+	while value >= 0x20:
+		output.append(chr((0x20 | (value & 0x1f)) + 63))
+		value >>= 5
+	output.append(chr(value + 63))
+
+#Encode [[lon, lat], ...] as a polyline string (latitude first, as the algorithm expects)
+def encodePolyline(coordinates,precision=5):
+	factor = 10 ** precision
+	output = []
+	previousLat = 0
+	previousLon = 0
+	for lon, lat in coordinates:
+		lat = int(round(lat * factor))
+		lon = int(round(lon * factor))
+		_encodeValue(lat - previousLat, output)
+		_encodeValue(lon - previousLon, output)
+		previousLat = lat
+		previousLon = lon
+	return ''.join(output)
+
+#Decode a polyline string back to [[lon, lat], ...]
+def decodePolyline(encoded,precision=5):
+	factor = float(10 ** precision)
+	coordinates = []
+	values = [0, 0]
+	index = 0
+	while index < len(encoded):
+		for n in range(2):
+			shift = 0
+			result = 0
+			while True:
+				byte = ord(encoded[index]) - 63
+				index += 1
+				result |= (byte & 0x1f) << shift
+				shift += 5
+				if byte < 0x20:
+					break
+			values[n] += ~(result >> 1) if result & 1 else result >> 1
+		coordinates.append([values[1] / factor, values[0] / factor])
+	return coordinates
+
+#Return a function rewriting a feature's geometry in place for the given encoding, or None for 'full'
+def geometryEncoder(encoding,precision=5):
+	if encoding not in encodings:
+		raise ValueError('Unknown geometry encoding ' + repr(encoding))
+	if encoding == 'full':
+		return None
+
+	def encode(feature):
+		geometry = feature['geometry']
+		if encoding == 'polyline' and geometry['type'] == 'LineString':
+			feature['properties']['polyline'] = encodePolyline(geometry['coordinates'], precision)
+			feature['properties']['polylinePrecision'] = precision
+			feature['geometry'] = None
+		else:
+			geometry['coordinates'] = quantizeCoordinates(geometry['coordinates'], precision)
+		return feature
+	return encode
+
+#Turn a feature written with any of the encodings back into full GeoJSON geometry
+def decodeFeature(feature):
+	properties = feature.get('properties') or {}
+	if feature.get('geometry') is None and 'polyline' in properties:
+		coordinates = decodePolyline(properties.pop('polyline'), properties.pop('polylinePrecision', 5))
+		feature['geometry'] = {"type": "LineString", "coordinates": coordinates}
+	return feature
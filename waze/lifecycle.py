@@ -0,0 +1,137 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from waze import timeutil
+from waze.delta import itemKeys
+from waze.shards import shardMapping, mergeShards
+
+#How an item of each feed type is summed up over the polls it stays in the feed: the fields kept
+#from the poll it was first seen in, as (event column, item field), and the running aggregates,
+#as (event column, item field, min or max). pubMillis is the time the item was published.
+lifecycleSpecs = {
+	'alerts': {
+		'attributes': [('type', 'type'), ('subtype', 'subtype'), ('street', 'street'), ('city', 'city'),
+			('roadType', 'roadType'), ('pubMillis', 'pubMillis')],
+		'aggregates': [('maxReliability', 'reliability', max), ('maxConfidence', 'confidence', max),
+			('maxThumbsUp', 'nThumbsUp', max)],
+	},
+	'jams': {
+		'attributes': [('type', 'type'), ('street', 'street'), ('city', 'city'), ('roadType', 'roadType'),
+			('pubMillis', 'pubMillis')],
+		'aggregates': [('maxLevel', 'level', max), ('maxDelay', 'delay', max), ('minSpeed', 'speedKMH', min),
+			('maxLength', 'length', max)],
+	},
+	'irregularities': {
+		'attributes': [('type', 'type'), ('street', 'street'), ('city', 'city'), ('pubMillis', 'detectionDateMillis')],
+		'aggregates': [('maxLevel', 'jamLevel', max), ('maxDelay', 'delaySeconds', max), ('minSpeed', 'speed', min),
+			('maxLength', 'length', max)],
+	},
+}
+
+#The start point of an item as WKT: an alert's location, or the first vertex of a jam or irregularity
+def startWKT(item):
+	point = item.get('location') or (item.get('line') or [None])[0]
+	if not point or point.get('x') is None or point.get('y') is None:
+		return None
+	return 'Point(' + str(point.get('x')) + ' ' + str(point.get('y')) + ')'
+
+#min or max of two values, ignoring a missing one
+def _aggregate(function,current,value):
+	if value is None:
+		return current
+	if current is None:
+		return value
+	return function(current, value)
+
+#An item's lifecycle record is kept as a list to keep the state small, updates being the number
+#of polls it was added or changed in:
+#[first seen millis, updates, start WKT] + attribute values + aggregate values
+def _newRecord(spec,item,polledMillis):
+	return ([polledMillis, 1, startWKT(item)] + [item.get(field) for column, field in spec['attributes']]
+		+ [item.get(field) for column, field, function in spec['aggregates']])
+
+def _updateRecord(spec,record,item):
+	record = list(record)
+	record[1] += 1
+	offset = 3 + len(spec['attributes'])
+	for n, (column, field, function) in enumerate(spec['aggregates']):
+		record[offset + n] = _aggregate(function, record[offset + n], item.get(field))
+	return record
+
+#The row of an item that left the feed, for the events table (see waze.schemas.eventsFields)
+def eventRow(feedType,key,record,lastSeenMillis):
+	spec = lifecycleSpecs[feedType]
+	firstSeenMillis, updates, geo = record[:3]
+	attributes = dict(zip([column for column, field in spec['attributes']], record[3:3 + len(spec['attributes'])]))
+	pubMillis = attributes.pop('pubMillis')
+	pubTS, firstSeenTS, lastSeenTS = timeutil.formatMillis([pubMillis, firstSeenMillis, lastSeenMillis])
+	row = {
+		'feed': feedType,
+		'id': key,
+		'pubMS': pubMillis,
+		'pubTS': pubTS,
+		'firstSeenTS': firstSeenTS,
+		'lastSeenTS': lastSeenTS,
+		'durationSeconds': (lastSeenMillis - firstSeenMillis) // 1000,
+		'updates': updates,
+		'geo': geo,
+	}
+	row.update(attributes)
+	row.update(zip([column for column, field, function in spec['aggregates']], record[3 + len(spec['attributes']):]))
+	return row
+
+#Id of an event row, used as its BigQuery insert id
+def eventID(row):
+	return row['feed'] + ':' + row['id'] + ':' + str(row['firstSeenTS'])
+
+#Carry the lifecycle state of a case and feed type over to a new poll, given the poll's delta
+#(see waze.delta.computeDelta) and time. state is {'polled': millis, 'items': {item key: record}}
+#as returned by the previous call, or None. Only added and changed items can move an aggregate,
+#so unchanged ones are skipped unless they aren't tracked yet (as when tracking was just turned on).
+#An item that left the feed was last seen in the previous poll.
+#Returns the new state and the event rows of the items that left the feed.
+def updateLifecycles(state,delta,feedType,polledMillis):
+	spec = lifecycleSpecs[feedType]
+	keyFunc = itemKeys[feedType]
+	state = state or {}
+	previousPoll = state.get('polled')
+	tracked = dict(state.get('items') or {})
+	closed = []
+	for key in delta.removed:
+		record = tracked.pop(key, None)
+		if record is not None:
+			closed.append(eventRow(feedType, key, record, previousPoll or record[0]))
+	for items, untrackedOnly in ((delta.added, False), (delta.changed, False), (delta.unchanged, True)):
+		for item in items:
+			key = keyFunc(item)
+			if key is None:
+				continue
+			record = tracked.get(key)
+			if record is None:
+				tracked[key] = _newRecord(spec, item, polledMillis)
+			elif not untrackedOnly:
+				tracked[key] = _updateRecord(spec, record, item)
+	return {'polled': polledMillis, 'items': tracked}, closed
+
+#Split a lifecycle state into shards small enough to be stored as separate entities (see
+#waze/shards.py), each a state holding part of the items
+def shardLifecycles(state,maxBytes):
+	return [{'polled': state.get('polled'), 'items': items} for items in shardMapping(state.get('items') or {}, maxBytes)]
+
+#Put the shards of a lifecycle state back together, None if there are none
+def mergeLifecycleShards(shards):
+	shards = [shard for shard in shards or [] if shard]
+	if not shards:
+		return None
+	return {'polled': max(shard.get('polled') for shard in shards), 'items': mergeShards([shard.get('items') or {} for shard in shards])}
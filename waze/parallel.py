@@ -0,0 +1,48 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import logging
+import threading
+
+#Run callables concurrently, one thread each, and return their results in order once all have
+#finished. If any of them raised, the first exception is raised again after the others complete,
+#so one failing sink never leaves another half-written in the background.
+def runParallel(*calls):
+	if len(calls) == 1:
+		return [calls[0]()]
+	results = [None] * len(calls)
+	errors = []
+
+	def run(n,call):
+		try:
+			results[n] = call()
+		except Exception as e:
+			logging.exception('Concurrent call failed')
+			errors.append(e)
+
+	threads = [threading.Thread(target=run, args=(n, call)) for n, call in enumerate(calls)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+	return results
+
+#Run callables concurrently, at most limit at a time, and return their results in order
+def runBounded(calls,limit):
+	results = []
+	for start in range(0, len(calls), limit):
+		results.extend(runParallel(*calls[start:start + limit]))
+	return results
@@ -0,0 +1,162 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import datetime
+import json
+import logging
+import time
+
+from waze import timeutil
+from waze.delta import computeDelta
+from waze.lifecycle import updateLifecycles, shardLifecycles, mergeLifecycleShards
+from waze.shards import shardMapping, mergeShards
+from waze.parallel import runParallel
+from waze.stats import RunStats
+from waze.tiles import TileBuilder
+
+#The part of processing a feed that doesn't touch any service, shared by the App Engine handlers
+#and the standalone tools: drop items older than the case, format their time fields, and extract
+#each item's GeoJSON feature and, for the touched ones, its BigQuery row and bucketed dedup key.
+#onFeature, if given, is called with every feature as soon as it is extracted.
+#Returns the dedup keys and rows of the touched items, in feed order.
+def extractRows(extractor,items,cutoffMillis,touched=None,onFeature=None):
+	pendingIDs = []
+	pendingRows = []
+	#Drop items older than the case, and format the time fields of the rest in one batch (UTC)
+	items, itemTimestamps = timeutil.filterAndFormat(items,extractor.timeFields,cutoffMillis)
+	for item, timestamps in zip(items, itemTimestamps):
+		#Items unchanged since the previous poll were already checked and written, so they only need a feature
+		feature, row = extractor.extract(item,timestamps,touched is None or id(item) in touched)
+		if onFeature is not None:
+			onFeature(feature)
+		if row is not None:
+			pendingIDs.append(extractor.dedupKey(row))
+			pendingRows.append(row)
+	return pendingIDs, pendingRows
+
+#Identify the items that need dedup and row creation: all of them unless a delta against
+#the previous poll is known, in which case only the added and changed ones
+def touchedItems(items,delta):
+	if delta is None:
+		return set(id(item) for item in items)
+	return set(id(item) for item in delta.added + delta.changed)
+
+#Updates cases from feed snapshots, writing through a services object:
+#  loadFeedStates(uid,feedTypes,stats) -> the (fingerprint shards, lifecycle shards) each feed type was left with, or None
+#  saveFeedStates(uid,states,stats) with states as {feed type: (fingerprint shards, lifecycle shards or None)}
+#  openGeoJSON(uid,feedType,now) -> a FeatureCollectionWriter for the timestamped GeoJSON
+#  publishGeoJSON(uid,feedType,now) makes it the case's latest GeoJSON
+#  filterUnique(feedType,uid,itemIDs,stats) -> indexes of the ids not seen before, recording them
+#  writeRows(feedType,uid,now,rows,ingestMode,stats) writes new rows to BigQuery (and Carto)
+#  writeTiles(feedType,uid,tiles,stats) writes the tiles of a TileBuilder
+#  writeEvents(uid,now,rows,ingestMode,stats) writes the rows of items that left the feed to the events table
+#stats is the waze.stats.RunStats of the run, where services count their RPCs and BigQuery writes.
+#main.py has the App Engine services, benchmarks/standins.py has local ones.
+#With trackLifecycles set, every item is also followed across polls (see waze/lifecycle.py), and
+#written once more as a consolidated event when it leaves the feed. The fingerprints and lifecycles
+#are saved in shards of at most stateShardBytes each (see waze/shards.py).
+class CasePipeline(object):
+	def __init__(self,services,extractors,feedTypes,tileZooms=None,tilePrecision=None,trackLifecycles=False,stateShardBytes=500000):
+		self.services = services
+		self.extractors = extractors
+		self.feedTypes = feedTypes
+		self.tileZooms = tileZooms
+		self.tilePrecision = tilePrecision
+		self.trackLifecycles = trackLifecycles
+		self.stateShardBytes = stateShardBytes
+
+	#Update a case from a parsed snapshot. Items are compared with the case's previous snapshot first,
+	#so that only added and changed items go through dedup and row creation. Cases with a study area
+	#only get the items inside it, looked up in the snapshot's grid index. Returns the run's stats.
+	def updateCase(self,case,data,area=None,index=None,stats=None):
+		stats = stats or RunStats(case=case.uid)
+		states = self.services.loadFeedStates(case.uid,self.feedTypes,stats)
+		polledMillis = data.get('endTimeMillis') or int(time.time() * 1000)
+		events = []
+
+		#Run the pipeline of one feed type, returning its new fingerprint and lifecycle shards
+		def updateFeed(feedType,state):
+			#Get the component from the Waze CCP JSON Response
+			items = data.get(feedType)
+			if items is None:
+				return None
+			if area:
+				items = index.itemsIn(feedType,area)
+			fingerprintShards, previousShards = state or (None, None)
+			delta = computeDelta(mergeShards(fingerprintShards), items, feedType)
+			#The state is sharded before any event is written, so the state that closed them is known to fit
+			fingerprintShards = shardMapping(delta.state,self.stateShardBytes)
+			shards = None
+			if self.trackLifecycles:
+				lifecycles, closed = updateLifecycles(mergeLifecycleShards(previousShards), delta, feedType, polledMillis)
+				shards = shardLifecycles(lifecycles,self.stateShardBytes)
+				stats.add('events',len(closed),feedType)
+				events.extend(closed)
+			stats.add('unchanged',len(delta.unchanged),feedType)
+			stats.add('removed',len(delta.removed),feedType)
+			self.processFeed(feedType,items,case.uid,case.day,delta,case.ingestMode,stats)
+			logging.info(json.dumps({"case": case.uid, "feed": feedType, "added": len(delta.added), "changed": len(delta.changed),
+				"unchanged": len(delta.unchanged), "removed": delta.removed}))
+			return fingerprintShards, shards
+
+		#The alerts, jams and irregularities pipelines run concurrently, so a case takes about as long as its slowest feed type
+		newStates = runParallel(*[lambda args=args: updateFeed(*args) for args in zip(self.feedTypes, states)])
+		#Events are written before the state that closed them is saved, so a failed run closes them again
+		if events:
+			self.services.writeEvents(case.uid,datetime.datetime.now().strftime("%s"),events,case.ingestMode,stats)
+		self.services.saveFeedStates(case.uid,dict((feedType, state) for feedType, state in zip(self.feedTypes, newStates) if state is not None),stats)
+		return stats
+
+	#Process one component of the Waze CCP JSON Response: write every item to the GeoJSONs, and the
+	#items not seen before to the row sinks
+	def processFeed(self,feedType,items,uid,day,delta=None,ingestMode='stream',stats=None):
+		stats = stats or RunStats(case=uid)
+		now = datetime.datetime.now().strftime("%s")
+		extractor = self.extractors[feedType]
+		touched = touchedItems(items,delta)
+		#Features are streamed to the timestamped GeoJSON as they are produced
+		geoJSON = self.services.openGeoJSON(uid,feedType,now)
+		tiles = TileBuilder(self.tileZooms,self.tilePrecision) if self.tileZooms else None
+		#Tiles are cut before the GeoJSON writer encodes the feature's geometry
+		def onFeature(feature):
+			if tiles:
+				tiles.add(feature)
+			geoJSON.write(feature)
+		with stats.timed('extractMillis',feedType):
+			pendingIDs, pendingRows = extractRows(extractor,items,timeutil.dayStartMillis(day),touched,onFeature)
+
+		#Finish the timestamped GeoJSON, then publish it as the latest one while the new rows are
+		#deduplicated and written to their sinks
+		geoJSON.close()
+		stats.add('seen',len(items),feedType)
+		stats.add('filteredByDate',len(items) - geoJSON.count,feedType)
+		stats.add('candidates',len(pendingIDs),feedType)
+		stats.add('geojsonBytes',geoJSON.bytesWritten,feedType)
+		sinks = [
+			lambda: self.services.publishGeoJSON(uid,feedType,now),
+			lambda: self.writeNewRows(feedType,uid,now,pendingIDs,pendingRows,ingestMode,stats)]
+		if tiles:
+			sinks.append(lambda: self.services.writeTiles(feedType,uid,tiles,stats))
+		runParallel(*sinks)
+
+	#Check a snapshot's candidate rows against the dedup state in one batch, then write the new ones
+	def writeNewRows(self,feedType,uid,now,pendingIDs,pendingRows,ingestMode='stream',stats=None):
+		stats = stats or RunStats(case=uid)
+		with stats.timed('dedupMillis',feedType):
+			newIndexes = self.services.filterUnique(feedType,uid,pendingIDs,stats)
+		stats.add('new',len(newIndexes),feedType)
+		stats.add('duplicates',len(pendingIDs) - len(newIndexes),feedType)
+		rows = [pendingRows[n] for n in newIndexes]
+		if rows:
+			self.services.writeRows(feedType,uid,now,rows,ingestMode,stats)
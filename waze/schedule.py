@@ -0,0 +1,40 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import heapq
+
+#Split the cases due for an update into shards, each updated by one task, from the expected cost of
+#each case in milliseconds, given as (case, cost) pairs. There are as many shards as it takes to keep
+#each one at about budgetMillis of work. Cases are placed from the most expensive down, each on the
+#shard with the least work so far, so that slow cases end up on different shards and no shard is
+#left waiting on two of them. A case costing more than the budget gets a shard to itself.
+#Returns the shards as lists of cases, the slowest case of each shard first.
+def planShards(costs,budgetMillis):
+	if not costs:
+		return []
+	total = sum(cost for case, cost in costs)
+	count = min(len(costs), max(1, -(-int(total) // int(budgetMillis))))
+	shards = [[] for n in range(count)]
+	loads = [(0, n) for n in range(count)]
+	for case, cost in sorted(costs, key=lambda pair: -pair[1]):
+		load, n = heapq.heappop(loads)
+		shards[n].append(case)
+		heapq.heappush(loads, (load + cost, n))
+	return shards
+
+#Exponentially smoothed run duration, so one slow run doesn't move a case to a shard of its own
+def smoothedDuration(previous,millis,weight=0.3):
+	if previous is None:
+		return int(millis)
+	return int(previous + weight * (millis - previous))
@@ -0,0 +1,131 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+#Columns of the three BigQuery tables, as (name, type). main.py turns these into
+#bigquery.SchemaField lists, and the extractors in waze.extract are generated from them.
+
+jamsFields = [
+	('city', 'STRING'),
+	('turntype', 'STRING'),
+	('level', 'INT64'),
+	('country', 'STRING'),
+	('speedKMH', 'FLOAT64'),
+	('delay', 'INT64'),
+	('length', 'INT64'),
+	('street', 'STRING'),
+	('ms', 'INT64'),
+	('ts', 'TIMESTAMP'),
+	('endNode', 'STRING'),
+	('geo', 'GEOGRAPHY'),
+	('geoWKT', 'STRING'),
+	('type', 'STRING'),
+	('id', 'INT64'),
+	('speed', 'FLOAT64'),
+	('uuid', 'STRING'),
+	('startNode', 'STRING'),
+]
+
+alertsFields = [
+	('city', 'STRING'),
+	('confidence', 'INT64'),
+	('nThumbsUp', 'INT64'),
+	('street', 'STRING'),
+	('uuid', 'STRING'),
+	('country', 'STRING'),
+	('type', 'STRING'),
+	('subtype', 'STRING'),
+	('roadType', 'INT64'),
+	('reliability', 'INT64'),
+	('magvar', 'INT64'),
+	('reportRating', 'INT64'),
+	('ms', 'INT64'),
+	('ts', 'TIMESTAMP'),
+	('reportDescription', 'STRING'),
+	('geo', 'GEOGRAPHY'),
+	('geoWKT', 'STRING'),
+]
+
+irregularitiesFields = [
+	('trend', 'INT64'),
+	('street', 'STRING'),
+	('endNode', 'STRING'),
+	('nImages', 'INT64'),
+	('speed', 'FLOAT64'),
+	('id', 'STRING'),
+	('severity', 'INT64'),
+	('type', 'STRING'),
+	('highway', 'BOOL'),
+	('nThumbsUp', 'INT64'),
+	('seconds', 'INT64'),
+	('alertsCount', 'INT64'),
+	('detectionDateMS', 'INT64'),
+	('detectionDateTS', 'TIMESTAMP'),
+	('driversCount', 'INT64'),
+	('geo', 'GEOGRAPHY'),
+	('geoWKT', 'STRING'),
+	('startNode', 'STRING'),
+	('updateDateMS', 'INT64'),
+	('updateDateTS', 'TIMESTAMP'),
+	('regularSpeed', 'FLOAT64'),
+	('country', 'STRING'),
+	('length', 'INT64'),
+	('delaySeconds', 'INT64'),
+	('jamLevel', 'INT64'),
+	('nComments', 'INT64'),
+	('city', 'STRING'),
+	('causeType', 'STRING'),
+	('causeAlertUUID', 'STRING'),
+]
+
+#Columns of the table of consolidated events, one row per alert, jam or irregularity once it left the
+#feed (see waze/lifecycle.py). Aggregates that don't apply to an item's feed type are left empty.
+eventsFields = [
+	('feed', 'STRING'),
+	('id', 'STRING'),
+	('type', 'STRING'),
+	('subtype', 'STRING'),
+	('street', 'STRING'),
+	('city', 'STRING'),
+	('roadType', 'INT64'),
+	('pubMS', 'INT64'),
+	('pubTS', 'TIMESTAMP'),
+	('firstSeenTS', 'TIMESTAMP'),
+	('lastSeenTS', 'TIMESTAMP'),
+	('durationSeconds', 'INT64'),
+	('updates', 'INT64'),
+	('maxLevel', 'INT64'),
+	('maxDelay', 'INT64'),
+	('minSpeed', 'FLOAT64'),
+	('maxLength', 'INT64'),
+	('maxReliability', 'INT64'),
+	('maxConfidence', 'INT64'),
+	('maxThumbsUp', 'INT64'),
+	('geo', 'GEOGRAPHY'),
+]
+
+feedFields = {
+	'alerts': alertsFields,
+	'jams': jamsFields,
+	'irregularities': irregularitiesFields,
+}
+
+#Extra column of the optional shared tables holding every case, and how those tables are laid out
+caseIDField = ('case_id', 'STRING')
+clusteringFields = ['case_id', 'type']
+partitionFields = {
+	'alerts': 'ts',
+	'jams': 'ts',
+	'irregularities': 'detectionDateTS',
+	'events': 'lastSeenTS',
+}
@@ -0,0 +1,52 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import hashlib
+import json
+import zlib
+
+#Per-case state that can grow with the feed (the fingerprints of waze.delta, the lifecycles of
+#waze.lifecycle) is split into shards, so that no stored entity outgrows Datastore's entity limit.
+
+#Size of a value once stored in a compressed JsonProperty
+def encodedSize(value):
+	return len(zlib.compress(json.dumps(value).encode('utf-8')))
+
+def _shardOf(key,count):
+	return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % count
+
+#Split a dict into shards small enough to be stored as separate entities. Keys go to a shard by
+#their hash, and the number of shards, a power of two, is doubled until every shard fits in maxBytes
+#once stored. Returns the shards, as dicts.
+def shardMapping(mapping,maxBytes):
+	count = 1
+	while count < -(-encodedSize(mapping) // maxBytes):
+		count *= 2
+	while True:
+		shards = [{} for n in range(count)]
+		for key, value in mapping.items():
+			shards[_shardOf(key, count)][key] = value
+		if count >= len(mapping) or all(encodedSize(shard) <= maxBytes for shard in shards):
+			return shards
+		count *= 2
+
+#Put the shards of a dict back together, None if there are none
+def mergeShards(shards):
+	shards = [shard for shard in shards or [] if shard is not None]
+	if not shards:
+		return None
+	merged = {}
+	for shard in shards:
+		merged.update(shard)
+	return merged
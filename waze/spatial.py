@@ -0,0 +1,162 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+import math
+
+#Study areas for cases, and a uniform grid index over a snapshot's items, so that each case
+#only looks at the items near its area instead of testing every item in the feed.
+
+def _isPosition(position):
+	return (isinstance(position, list) and len(position) >= 2
+		and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in position[:2]))
+
+#Read a case's study area from a 'minLon,minLat,maxLon,maxLat' bounding box or a GeoJSON Polygon
+#or MultiPolygon geometry, returning it as a GeoJSON geometry. Raises ValueError if it isn't valid.
+def parseArea(bbox=None,polygon=None):
+	if bbox:
+		values = [float(value) for value in bbox.split(',')]
+		if len(values) != 4 or values[0] >= values[2] or values[1] >= values[3]:
+			raise ValueError('bbox must be minLon,minLat,maxLon,maxLat')
+		minX, minY, maxX, maxY = values
+		return {'type': 'Polygon', 'coordinates': [[[minX, minY], [maxX, minY], [maxX, maxY], [minX, maxY], [minX, minY]]]}
+	if polygon:
+		geometry = json.loads(polygon) if not isinstance(polygon, dict) else polygon
+		if not isinstance(geometry, dict):
+			raise ValueError('polygon must be a GeoJSON Polygon or MultiPolygon')
+		if geometry.get('type') == 'Polygon':
+			polygons = [geometry.get('coordinates')]
+		elif geometry.get('type') == 'MultiPolygon':
+			polygons = geometry.get('coordinates')
+		else:
+			raise ValueError('polygon must be a GeoJSON Polygon or MultiPolygon')
+		if not isinstance(polygons, list):
+			raise ValueError('polygon coordinates must be a list')
+		for rings in polygons or [None]:
+			if not isinstance(rings, list) or not rings or any(not isinstance(ring, list) or len(ring) < 4 for ring in rings):
+				raise ValueError('polygon rings need at least four positions')
+			for ring in rings:
+				if any(not _isPosition(position) for position in ring):
+					raise ValueError('polygon positions must be [lon, lat] numbers')
+		return {'type': geometry['type'], 'coordinates': geometry['coordinates']}
+	return None
+
+#The x/y positions of a feed item: its location for alerts, the vertices of its line otherwise
+def itemCoordinates(item):
+	location = item.get('location')
+	if location is not None:
+		vertices = [location]
+	else:
+		vertices = item.get('line') or []
+	coordinates = []
+	for vertex in vertices:
+		x = vertex.get('x')
+		y = vertex.get('y')
+		if x is None or y is None:
+			return []
+		coordinates.append((x, y))
+	return coordinates
+
+def _inRing(x,y,ring):
+	inside = False
+	j = len(ring) - 1
+	for i in range(len(ring)):
+		xi, yi = ring[i][0], ring[i][1]
+		xj, yj = ring[j][0], ring[j][1]
+		if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / float(yj - yi) + xi:
+			inside = not inside
+		j = i
+	return inside
+
+def _orientation(a,b,c):
+	value = (b[1] - a[1]) * (c[0] - b[0]) - (b[0] - a[0]) * (c[1] - b[1])
+	return (value > 0) - (value < 0)
+
+def _segmentsCross(a,b,c,d):
+	return _orientation(a, b, c) != _orientation(a, b, d) and _orientation(c, d, a) != _orientation(c, d, b)
+
+#A case's study area, answering whether an item's point or line falls inside it
+class Area(object):
+	def __init__(self,geometry):
+		self.polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+		xs = [position[0] for rings in self.polygons for position in rings[0]]
+		ys = [position[1] for rings in self.polygons for position in rings[0]]
+		self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+	def containsPoint(self,x,y):
+		minX, minY, maxX, maxY = self.bounds
+		if x < minX or x > maxX or y < minY or y > maxY:
+			return False
+		for rings in self.polygons:
+			if _inRing(x, y, rings[0]) and not any(_inRing(x, y, hole) for hole in rings[1:]):
+				return True
+		return False
+
+	#An item is in the area if any of its positions is, or if its line crosses the area's edge
+	def intersects(self,coordinates):
+		if any(self.containsPoint(x, y) for x, y in coordinates):
+			return True
+		for a, b in zip(coordinates, coordinates[1:]):
+			for rings in self.polygons:
+				for ring in rings:
+					for c, d in zip(ring, ring[1:]):
+						if _segmentsCross(a, b, c, d):
+							return True
+		return False
+
+#Uniform grid over the items of a snapshot, built once and shared by every case with a study area.
+#Each item is filed under every cell its bounding box touches.
+class GridIndex(object):
+	def __init__(self,data,feedTypes,cellSize=0.01):
+		self.cellSize = float(cellSize)
+		self.items = {}
+		self.coordinates = {}
+		self.cells = {}
+		for feedType in feedTypes:
+			items = data.get(feedType) or []
+			self.items[feedType] = items
+			coordinates = self.coordinates[feedType] = [itemCoordinates(item) for item in items]
+			cells = self.cells[feedType] = {}
+			for n, itemCoordinatesList in enumerate(coordinates):
+				if not itemCoordinatesList:
+					continue
+				xs = [x for x, y in itemCoordinatesList]
+				ys = [y for x, y in itemCoordinatesList]
+				for cell in self._cellsCovering(min(xs), min(ys), max(xs), max(ys)):
+					cells.setdefault(cell, []).append(n)
+
+	def _cell(self,value):
+		return int(math.floor(value / self.cellSize))
+
+	def _cellsCovering(self,minX,minY,maxX,maxY):
+		for cx in range(self._cell(minX), self._cell(maxX) + 1):
+			for cy in range(self._cell(minY), self._cell(maxY) + 1):
+				yield (cx, cy)
+
+	#The items of a feed type inside an area, in feed order
+	def itemsIn(self,feedType,area):
+		cells = self.cells.get(feedType, {})
+		candidates = set()
+		minX, minY, maxX, maxY = area.bounds
+		if (self._cell(maxX) - self._cell(minX) + 1) * (self._cell(maxY) - self._cell(minY) + 1) > len(cells):
+			#The area covers more cells than hold items, so walk the occupied cells instead
+			for (cx, cy), indexes in cells.items():
+				if self._cell(minX) <= cx <= self._cell(maxX) and self._cell(minY) <= cy <= self._cell(maxY):
+					candidates.update(indexes)
+		else:
+			for cell in self._cellsCovering(minX, minY, maxX, maxY):
+				candidates.update(cells.get(cell, ()))
+		items = self.items[feedType]
+		coordinates = self.coordinates[feedType]
+		return [items[n] for n in sorted(candidates) if area.intersects(coordinates[n])]
@@ -0,0 +1,87 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import json
+import threading
+import time
+
+#Counters and timings of one case update, filled in by the pipeline and its services from any
+#thread, and emitted as one structured log record at the end of the run.
+
+#Counters kept for each feed type, and for the run as a whole. Timings are in milliseconds.
+feedCounters = ['seen', 'filteredByDate', 'unchanged', 'removed', 'candidates', 'new', 'duplicates',
+	'events', 'geojsonBytes', 'tilesWritten', 'bigqueryRows', 'bigqueryMillis', 'extractMillis', 'dedupMillis']
+runCounters = ['runs', 'fetchMillis', 'wireBytes', 'payloadBytes', 'datastoreRPCs', 'memcacheRPCs', 'totalMillis']
+
+class RunStats(object):
+	def __init__(self,**fields):
+		self.fields = fields
+		self.counters = {}
+		self.feeds = {}
+		self.lock = threading.Lock()
+		self.started = time.time()
+
+	#Add to a counter of the run, or of a feed type
+	def add(self,name,value=1,feedType=None):
+		with self.lock:
+			counters = self.feeds.setdefault(feedType, {}) if feedType else self.counters
+			counters[name] = counters.get(name, 0) + value
+
+	#Context manager adding the time spent in its block to a counter, in milliseconds
+	def timed(self,name,feedType=None):
+		return _Timer(self, name, feedType)
+
+	#The record of the run, with its total duration
+	def record(self):
+		with self.lock:
+			record = dict(self.fields)
+			record.update(self.counters)
+			record['totalMillis'] = int((time.time() - self.started) * 1000)
+			record['feeds'] = dict((feedType, dict(counters)) for feedType, counters in self.feeds.items())
+		return record
+
+	def log(self,logger):
+		logger.info(json.dumps(dict(self.record(), stats='caseRun'), sort_keys=True))
+
+class _Timer(object):
+	def __init__(self,stats,name,feedType):
+		self.stats = stats
+		self.name = name
+		self.feedType = feedType
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self,*args):
+		self.stats.add(self.name, int((time.time() - self.start) * 1000), self.feedType)
+
+#Flatten a run record to integer counters named 'name' or '<feed type>.name', for summing across runs
+def flatten(record):
+	counters = dict((name, int(record.get(name, 0))) for name in runCounters if name != 'runs')
+	counters['runs'] = 1
+	for feedType, feedValues in record.get('feeds', {}).items():
+		for name in feedCounters:
+			counters[feedType + '.' + name] = int(feedValues.get(name, 0))
+	return counters
+
+#Names of every flattened counter for the given feed types
+def counterNames(feedTypes):
+	return runCounters + [feedType + '.' + name for feedType in feedTypes for name in feedCounters]
+
+#Totals summed across runs, with the average per run of each
+def summarize(totals):
+	runs = totals.get('runs') or 0
+	averages = dict((name, round(float(value) / runs, 1)) for name, value in totals.items() if name != 'runs' and runs)
+	return {'runs': runs, 'totals': totals, 'perRun': averages}
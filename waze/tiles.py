@@ -0,0 +1,146 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import hashlib
+import json
+import math
+
+#Splits features into z/x/y web mercator tiles, clipping lines at the tile edges, so a map only has
+#to download the tiles it shows. Tiles are GeoJSON FeatureCollections, and each one comes with a
+#content hash so that unchanged tiles don't need to be written again.
+
+maxLatitude = 85.0511287798
+
+def lonLatToTile(lon,lat,zoom):
+	lat = max(-maxLatitude, min(maxLatitude, lat))
+	n = 2 ** zoom
+	x = (lon + 180.0) / 360.0 * n
+	y = (1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n
+	return min(n - 1, max(0, int(x))), min(n - 1, max(0, int(y)))
+
+def _tileLatitude(y,zoom):
+	return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / 2 ** zoom))))
+
+#(minLon, minLat, maxLon, maxLat) of a tile
+def tileBounds(zoom,x,y):
+	n = 2 ** zoom
+	return (x * 360.0 / n - 180.0, _tileLatitude(y + 1, zoom), (x + 1) * 360.0 / n - 180.0, _tileLatitude(y, zoom))
+
+#Liang-Barsky clipping of one segment to a box, returning the clipped segment or None
+def _clipSegment(a,b,bounds):
+	minX, minY, maxX, maxY = bounds
+	dx = b[0] - a[0]
+	dy = b[1] - a[1]
+	t0 = 0.0
+	t1 = 1.0
+	for p, q in ((-dx, a[0] - minX), (dx, maxX - a[0]), (-dy, a[1] - minY), (dy, maxY - a[1])):
+		if p == 0:
+			if q < 0:
+				return None
+			continue
+		t = float(q) / p
+		if p < 0:
+			if t > t1:
+				return None
+			t0 = max(t0, t)
+		else:
+			if t < t0:
+				return None
+			t1 = min(t1, t)
+	return [a[0] + t0 * dx, a[1] + t0 * dy], [a[0] + t1 * dx, a[1] + t1 * dy]
+
+#Clip a line to a box, returning the list of parts of the line inside it
+def clipLine(coordinates,bounds):
+	parts = []
+	current = None
+	for a, b in zip(coordinates, coordinates[1:]):
+		segment = _clipSegment(a, b, bounds)
+		if segment is None:
+			current = None
+			continue
+		start, end = segment
+		if current is not None and current[-1] == start:
+			current.append(end)
+		else:
+			current = [start, end]
+			parts.append(current)
+	if not parts and len(coordinates) == 1:
+		x, y = coordinates[0]
+		if bounds[0] <= x <= bounds[2] and bounds[1] <= y <= bounds[3]:
+			parts.append([coordinates[0], coordinates[0]])
+	return parts
+
+def _round(coordinates,precision):
+	if precision is None:
+		return coordinates
+	if coordinates and isinstance(coordinates[0], list):
+		return [_round(coordinate, precision) for coordinate in coordinates]
+	return [round(value, precision) for value in coordinates]
+
+#Collects features into tiles at the given zoom levels. Each tile's features are serialized as soon
+#as they are added, so the caller is free to modify a feature once add() returns.
+class TileBuilder(object):
+	def __init__(self,zooms,precision=None):
+		self.zooms = zooms
+		self.precision = precision
+		self.tiles = {}
+
+	def _add(self,tile,properties,geometry):
+		geometry = dict(geometry, coordinates=_round(geometry['coordinates'], self.precision))
+		self.tiles.setdefault(tile, []).append(json.dumps({"type": "Feature", "properties": properties, "geometry": geometry}, separators=(',', ':'), sort_keys=True))
+
+	def add(self,feature):
+		geometry = feature.get('geometry')
+		if not geometry or not geometry.get('coordinates'):
+			return
+		coordinates = geometry['coordinates']
+		if geometry['type'] == 'Point':
+			if coordinates[0] is None or coordinates[1] is None:
+				return
+			for zoom in self.zooms:
+				x, y = lonLatToTile(coordinates[0], coordinates[1], zoom)
+				self._add((zoom, x, y), feature['properties'], geometry)
+			return
+		lons = [coordinate[0] for coordinate in coordinates]
+		lats = [coordinate[1] for coordinate in coordinates]
+		for zoom in self.zooms:
+			minX, minY = lonLatToTile(min(lons), max(lats), zoom)
+			maxX, maxY = lonLatToTile(max(lons), min(lats), zoom)
+			for x in range(minX, maxX + 1):
+				for y in range(minY, maxY + 1):
+					parts = clipLine(coordinates, tileBounds(zoom, x, y))
+					if len(parts) == 1:
+						self._add((zoom, x, y), feature['properties'], {"type": "LineString", "coordinates": parts[0]})
+					elif parts:
+						self._add((zoom, x, y), feature['properties'], {"type": "MultiLineString", "coordinates": parts})
+
+	#Yield ('z/x/y', content hash, GeoJSON text) for every tile holding at least one feature
+	def build(self):
+		for (zoom, x, y), features in self.tiles.items():
+			features.sort()
+			content = '{"type":"FeatureCollection","features":[' + ','.join(features) + ']}'
+			yield '%d/%d/%d' % (zoom, x, y), hashlib.sha1(content.encode('utf-8')).hexdigest(), content
+
+#Compare built tiles with the hashes kept from the previous poll. Returns the tiles to write,
+#the tile names to delete, and the new hashes to keep.
+def changedTiles(builder,previousHashes):
+	previousHashes = previousHashes or {}
+	hashes = {}
+	changed = []
+	for name, contentHash, content in builder.build():
+		hashes[name] = contentHash
+		if previousHashes.get(name) != contentHash:
+			changed.append((name, content))
+	removed = [name for name in previousHashes if name not in hashes]
+	return changed, removed, hashes
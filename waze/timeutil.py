@@ -0,0 +1,77 @@
+'''Copyright 2018 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+import calendar
+import time
+
+#NumPy is optional: when it is available (with datetime64 support) timestamps are formatted as one
+#array operation, otherwise a pure Python batch formatter is used. Both produce UTC times.
+try:
+	import numpy
+	if not hasattr(numpy, 'datetime_as_string'):
+		numpy = None
+except ImportError:
+	numpy = None
+
+#Midnight UTC of a case's 'YYYY-MM-DD' day, as epoch milliseconds
+def dayStartMillis(day):
+	return calendar.timegm(time.strptime(day, '%Y-%m-%d')) * 1000
+
+#The UTC day of epoch milliseconds as 'YYYYMMDD', the time bucket dedup state is kept in.
+#Values without a time go to the '00000000' bucket.
+def dayBucket(millis):
+	if millis is None:
+		return '00000000'
+	return time.strftime('%Y%m%d', time.gmtime(millis // 1000))
+
+#Format epoch milliseconds as UTC 'YYYY-MM-DD HH:MM:SS' strings, None stays None.
+#The date part is computed once per distinct day rather than once per value.
+def formatMillis(millis):
+	if numpy is not None and millis:
+		return _formatMillisNumpy(millis)
+	days = {}
+	formatted = []
+	for ms in millis:
+		if ms is None:
+			formatted.append(None)
+			continue
+		seconds = int(ms // 1000)
+		day, secondOfDay = divmod(seconds, 86400)
+		prefix = days.get(day)
+		if prefix is None:
+			prefix = days[day] = time.strftime('%Y-%m-%d ', time.gmtime(day * 86400))
+		formatted.append('%s%02d:%02d:%02d' % (prefix, secondOfDay // 3600, secondOfDay // 60 % 60, secondOfDay % 60))
+	return formatted
+
+def _formatMillisNumpy(millis):
+	missing = numpy.array([ms is None for ms in millis])
+	values = numpy.array([0 if ms is None else ms for ms in millis], dtype='int64')
+	seconds = numpy.floor_divide(values, 1000).astype('datetime64[s]')
+	formatted = numpy.char.replace(numpy.datetime_as_string(seconds), 'T', ' ').tolist()
+	if missing.any():
+		formatted = [None if isMissing else value for value, isMissing in zip(formatted, missing.tolist())]
+	return formatted
+
+#Keep the items whose first time field is at or after cutoffMillis, and format all of their time
+#fields in one batch. Returns the kept items and, for each of them, a tuple of formatted timestamps.
+def filterAndFormat(items,timeFields,cutoffMillis):
+	firstField = timeFields[0]
+	if numpy is not None and items:
+		millis = numpy.array([item.get(firstField) for item in items], dtype='float64')
+		keep = (millis >= cutoffMillis).tolist()
+		kept = [item for item, isKept in zip(items, keep) if isKept]
+	else:
+		kept = [item for item in items if item.get(firstField) is not None and item.get(firstField) >= cutoffMillis]
+	columns = [formatMillis([item.get(field) for item in kept]) for field in timeFields]
+	return kept, list(zip(*columns))